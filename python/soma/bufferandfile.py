@@ -87,7 +87,11 @@ class BufferAndFile(object):
         Adds data at the begining of the internal buffer. Data in the internal
         buffer will be returned by all subsequent read acces until the buffer is empty.
         '''
-        self.__buffer = string_value + self.__buffer
+        if self.__buffer:
+            self.__buffer = string_value + self.__buffer
+        else:
+            # the buffer may contain bytes for a file opened in binary mode
+            self.__buffer = string_value
 
     def change_file(self, file_object):
         '''
@@ -108,8 +112,13 @@ class BufferAndFile(object):
         '''
         Read the file
         '''
+        if not self.__buffer:
+            if size is None:
+                return self.__file.read()
+            return self.__file.read(size)
         if size is None:
             result = self.__buffer + self.__file.read()
+            self.__buffer = ''
         else:
             buffer_size = len(self.__buffer)
             if buffer_size >= size:
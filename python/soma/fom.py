@@ -159,7 +159,17 @@ import re
 import pprint
 import sqlite3
 import json
+import copy
+import hashlib
+import tempfile
+import struct
+import mmap
+import collections
+import array
+import threading
+import multiprocessing
 import six
+from six.moves.urllib.request import pathname2url
 try:
     import bz2
 except ImportError:
@@ -202,7 +212,13 @@ try:
 except ImportError:
     import json as json_reader
 
-from soma.path import split_path
+from soma.path import split_path, replace_file
+from soma.sqlite_tools import ThreadSafeSQLiteConnection
+
+try:
+    from os import scandir
+except ImportError:
+    scandir = None
 
 if sys.version_info[0] >= 3:
     basestring = str
@@ -245,11 +261,280 @@ def read_json(file_name):
                          (file_name, str(e), extra_msg))
 
 
+class DirectoryScanner(object):
+
+    '''
+    Scan a directory tree and build the nested dict used by
+    :class:`DirectoryAsDict` and :class:`DirectoriesCache`.
+
+    Directories are read with :func:`os.scandir` (when available) and
+    sub-directories are dispatched over a bounded pool of threads, which
+    hides most of the latency of network file systems.
+
+    workers: int
+        number of scanning threads. A positive number is used as is, 0 means
+        the number of CPU cores, and a negative number means all CPU cores
+        except this given number. With 1, the scan runs in the calling
+        thread.
+    stat_files: bool
+        if False, entries that the directory listing already identifies as
+        regular files are not stat'ed and get a None stat (as in
+        :meth:`DirectoryAsDict.paths_to_dict`). Directories are always
+        stat'ed.
+    debug: logger
+        if given, progress is reported every 100 entries using
+        ``debug.info()``.
+    '''
+
+    def __init__(self, workers=0, stat_files=True, debug=None):
+        if workers == 0:
+            workers = multiprocessing.cpu_count()
+        elif workers < 0:
+            workers = max(1, multiprocessing.cpu_count() + workers)
+        self.workers = workers
+        self.stat_files = stat_files
+        self.debug = debug
+        self._lock = threading.Lock()
+        self.reset_statistics()
+
+    def reset_statistics(self):
+        self.directories = 0
+        self.files = 0
+        self.links = 0
+        self.files_size = 0
+        self.path_size = 0
+        self.errors = 0
+        self.count = 0
+
+    def scan(self, directory):
+        '''Return the content of directory as a nested dict, or None if it
+        cannot be read.
+        '''
+        root = [None, {}]
+        if self.workers == 1:
+            stack = [(directory, root)]
+            while stack:
+                stack.extend(self.scan_one(*stack.pop()))
+        else:
+            q = six.moves.queue.Queue()
+            # first exception raised in a worker (scan_one only catches
+            # OSError), re-raised once the queue is drained
+            errors = []
+            threads = []
+            for i in range(self.workers):
+                t = threading.Thread(target=self._worker, args=(q, errors))
+                t.daemon = True
+                t.start()
+                threads.append(t)
+            q.put((directory, root))
+            q.join()
+            for t in threads:
+                q.put(None)
+            for t in threads:
+                t.join()
+            if errors:
+                six.reraise(*errors[0])
+        return root[1]
+
+    def _worker(self, q, errors):
+        while True:
+            item = q.get()
+            try:
+                if item is None:
+                    break
+                if errors:
+                    # the scan failed: only drain the queue
+                    continue
+                for job in self.scan_one(*item):
+                    q.put(job)
+            except Exception:
+                with self._lock:
+                    errors.append(sys.exc_info())
+            finally:
+                q.task_done()
+
+    def scan_one(self, directory, st_content):
+        '''Fill the content of a single directory in st_content (a
+        ``[stat, content]`` list) and return a list of ``(path, st_content)``
+        for its sub-directories, which still have to be scanned.
+        '''
+        content = st_content[1]
+        try:
+            entries = self.list_directory(directory)
+        except OSError:
+            with self._lock:
+                self.errors += 1
+            st_content[1] = None
+            return []
+        subdirectories = []
+        directories = files = links = files_size = path_size = 0
+        for name, st, is_dir in entries:
+            path_size += len(name)
+            if is_dir:
+                directories += 1
+                sub_st_content = [st, {}]
+                subdirectories.append((osp.join(directory, name),
+                                       sub_st_content))
+                content[name] = sub_st_content
+            else:
+                if st is None or stat.S_ISREG(st[0]):
+                    files += 1
+                    if st is not None:
+                        files_size += st[6]
+                else:
+                    links += 1
+                content[name] = [st, None]
+        with self._lock:
+            self.directories += directories
+            self.files += files
+            self.links += links
+            self.files_size += files_size
+            self.path_size += path_size
+            count = self.count
+            self.count += len(entries)
+            if self.debug and (count // 100 != self.count // 100
+                               or count == 0):
+                self.debug.info('%s files=%d, directories=%d, size=%d'
+                                % (time.asctime(), self.files + self.links,
+                                   self.directories, self.files_size))
+        return subdirectories
+
+    def iter_listings(self, directory):
+        '''Generate ``(path, entries)`` for directory and all its
+        sub-directories, where entries is the name-sorted list of
+        ``(raw_name, name, stat_tuple, is_directory)`` of path, or None if
+        path cannot be read (raw_name is the UTF-8 encoded name).
+
+        Listings are produced by the scanning threads while the previous
+        ones are consumed, and at most twice the number of workers listings
+        are pending, so that the whole tree is never held in memory. The
+        order of the listings is unspecified, except that directory comes
+        first.
+        '''
+        if self.workers == 1:
+            paths = collections.deque([directory])
+            while paths:
+                path = paths.popleft()
+                entries = self._sorted_listing(path)
+                if entries:
+                    paths.extend(osp.join(path, name)
+                                 for raw_name, name, st, is_dir in entries
+                                 if is_dir)
+                yield path, entries
+            return
+        paths = six.moves.queue.Queue()
+        listings = six.moves.queue.Queue(2 * self.workers)
+        stop = threading.Event()
+        threads = []
+        for i in range(self.workers):
+            t = threading.Thread(target=self._listing_worker,
+                                 args=(paths, listings, stop))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        paths.put(directory)
+        pending = 1
+        try:
+            while pending:
+                path, entries = listings.get()
+                pending -= 1
+                if entries:
+                    for raw_name, name, st, is_dir in entries:
+                        if is_dir:
+                            paths.put(osp.join(path, name))
+                            pending += 1
+                yield path, entries
+        finally:
+            # the consumer may stop early: skip the remaining directories
+            # and unblock the workers waiting for room in listings
+            stop.set()
+            for t in threads:
+                paths.put(None)
+            for t in threads:
+                while t.is_alive():
+                    try:
+                        listings.get(timeout=0.01)
+                    except six.moves.queue.Empty:
+                        pass
+
+    def _listing_worker(self, paths, listings, stop):
+        while True:
+            path = paths.get()
+            if path is None:
+                break
+            if not stop.is_set():
+                listings.put((path, self._sorted_listing(path)))
+
+    def _sorted_listing(self, path):
+        try:
+            entries = self.list_directory(path)
+        except OSError:
+            return None
+        return sorted((_encode_name(name), name, st, is_dir)
+                      for name, st, is_dir in entries)
+
+    @staticmethod
+    def list_names(directory):
+        '''Return a list of ``(name, is_directory)`` for the entries of a
+        single directory. When the file system provides the entry types,
+        nothing is stat'ed. Raises OSError if directory cannot be read.
+        '''
+        if scandir is None:
+            return [(name, osp.isdir(osp.join(directory, name))
+                     and not osp.islink(osp.join(directory, name)))
+                    for name in os.listdir(directory)]
+        result = []
+        it = scandir(directory)
+        try:
+            for entry in it:
+                try:
+                    result.append((entry.name,
+                                   entry.is_dir(follow_symlinks=False)))
+                except OSError:
+                    continue
+        finally:
+            close = getattr(it, 'close', None)
+            if close is not None:
+                close()
+        return result
+
+    def list_directory(self, directory):
+        '''Return a list of ``(name, stat_tuple, is_directory)`` for the
+        entries of a single directory (stat_tuple may be None, see
+        stat_files). Raises OSError if directory cannot be read.
+        '''
+        result = []
+        if scandir is None:
+            for name in os.listdir(directory):
+                st = os.lstat(osp.join(directory, name))
+                result.append((name, tuple(st), stat.S_ISDIR(st.st_mode)))
+            return result
+        it = scandir(directory)
+        try:
+            for entry in it:
+                try:
+                    if not self.stat_files \
+                            and entry.is_file(follow_symlinks=False):
+                        result.append((entry.name, None, False))
+                        continue
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    # entry removed during the scan
+                    continue
+                result.append((entry.name, tuple(st),
+                               stat.S_ISDIR(st.st_mode)))
+        finally:
+            close = getattr(it, 'close', None)
+            if close is not None:
+                close()
+        return result
+
+
 class DirectoryAsDict(object):
 
     def __new__(cls, directory, cache=None):
         if osp.isdir(directory):
-            return super(DirectoryAsDict, cls).__new__(cls, directory, cache)
+            return super(DirectoryAsDict, cls).__new__(cls)
         else:
             return json.load(open(directory))
 
@@ -279,7 +564,7 @@ class DirectoryAsDict(object):
                 full_path = osp.join(self.directory, name)
                 st_content = self.cache.get_directory(full_path)
                 if st_content is not None:
-                    yield st_content
+                    yield (name, st_content)
                 else:
                     st = os.stat(full_path)
                     if stat.S_ISDIR(st.st_mode):
@@ -288,46 +573,25 @@ class DirectoryAsDict(object):
                         yield (name, [tuple(st), None])
 
     @staticmethod
-    def get_directory(directory, debug=None):
-        return DirectoryAsDict._get_directory(
-            directory, debug, 0, 0, 0, 0, 0, 0, 0)[0]
-
-    @staticmethod
-    def _get_directory(directory, debug, directories, files, links,
-                       files_size, path_size, errors, count):
-        try:
-            listdir = os.listdir(directory)
-            result = {}
-        except OSError:
-            errors += 1
-            result = None
-        if result is not None:
-            for name in listdir:
-                if debug and count % 100 == 0:
-                    debug.info('%s files=%d, directories=%d, size=%d'
-                               % (time.asctime(), files + links, directories,
-                                  files_size))
-                path_size += len(name)
-                count += 1
-                full_path = osp.join(directory, name)
-                st = os.lstat(full_path)
-                if stat.S_ISREG(st.st_mode):
-                    files += 1
-                    files_size += st.st_size
-                    result[name] = [tuple(st), None]
-                elif stat.S_ISDIR(st.st_mode):
-                    content, directories, files, links, files_size, \
-                        path_size, errors, count =  \
-                        DirectoryAsDict._get_directory(full_path, debug,
-                                                       directories +
-                                                       1, files, links, files_size,
-                                                       path_size, errors, count)
-                    result[name] = [tuple(st), content]
-                else:
-                    links += 1
-                    result[name] = [tuple(st), None]
-        return result, directories, files, links, files_size, path_size, \
-            errors, count
+    def get_directory(directory, debug=None, workers=0, stat_files=True,
+                      compact=False):
+        '''Return the content of a directory as a nested dict
+        ``{name: [stat, content]}`` where content is None for files and a
+        similar dict for sub-directories.
+
+        See :class:`DirectoryScanner` for the meaning of workers and
+        stat_files. If compact is True, the result is a read-only view on a
+        :class:`CompactDirectoryTree`, which uses much less memory.
+        '''
+        if compact:
+            tree = CompactDirectoryTree.from_directory(
+                directory, workers=workers, stat_files=stat_files,
+                debug=debug)
+            if tree is None:
+                return None
+            return tree.get_directory()
+        return DirectoryScanner(workers=workers, stat_files=stat_files,
+                                debug=debug).scan(directory)
 
     @staticmethod
     def paths_to_dict(*paths):
@@ -382,15 +646,505 @@ class DirectoryAsDict(object):
                 count)
 
 
+class DirectoryDelta(object):
+
+    '''
+    Changes found by :meth:`DirectoriesCache.refresh` in a cached directory.
+
+    added, removed and modified are lists of paths relative to directory,
+    using "/" as separator (as FOM patterns do). Entries of an added or
+    removed sub-directory are listed individually. Only non-directory
+    entries can be modified.
+    '''
+
+    def __init__(self, directory, content):
+        self.directory = directory
+        self.content = content
+        self.added = []
+        self.removed = []
+        self.modified = []
+
+    def __repr__(self):
+        return '<DirectoryDelta( %s, added=%d, removed=%d, modified=%d )>' \
+            % (repr(self.directory), len(self.added), len(self.removed),
+               len(self.modified))
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.modified)
+    __nonzero__ = __bool__
+
+    def get_directory(self):
+        '''Return a nested ``{name: [stat, content]}`` dict containing only
+        the added and modified entries (and their parent directories), that
+        can be given to :meth:`PathToAttributes.parse_directory`.
+        '''
+        result = {}
+        for path in self.added + self.modified:
+            current_dir = result
+            cached_dir = self.content
+            path_list = path.split('/')
+            for name in path_list[:-1]:
+                st_content = cached_dir[name]
+                cached_dir = st_content[1]
+                current_dir = current_dir.setdefault(
+                    name, [st_content[0], {}])[1]
+            st_content = cached_dir[path_list[-1]]
+            if st_content[1] is None:
+                current_dir[path_list[-1]] = [st_content[0], None]
+            else:
+                current_dir.setdefault(path_list[-1], [st_content[0], {}])
+        return result
+
+
+class _MappedDirectory(object):
+
+    '''
+    Read-only, lazy view on a directory stored in a binary
+    :class:`DirectoriesCache` snapshot or in a :class:`CompactDirectoryTree`.
+    It behaves like the content dict of :meth:`DirectoryAsDict.get_directory`:
+    values are ``[stat, content]`` lists where content is None or another
+    _MappedDirectory. Names and stats are only read when accessed.
+
+    snapshot is the storage object, which provides children(node),
+    name(node), raw_name(node) and st_content(node) for integer nodes. The
+    children of a node are contiguous and sorted by raw_name.
+    '''
+
+    def __init__(self, snapshot, node):
+        self._snapshot = snapshot
+        self._first, self._count = snapshot.children(node)
+
+    def __repr__(self):
+        return '<_MappedDirectory( %d entries )>' % self._count
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        snapshot = self._snapshot
+        for node in xrange(self._first, self._first + self._count):
+            yield snapshot.name(node)
+
+    keys = iterkeys = __iter__
+
+    def iteritems(self):
+        snapshot = self._snapshot
+        for node in xrange(self._first, self._first + self._count):
+            yield snapshot.name(node), snapshot.st_content(node)
+
+    items = iteritems
+
+    def itervalues(self):
+        for name, st_content in self.iteritems():
+            yield st_content
+
+    values = itervalues
+
+    def _find(self, name):
+        snapshot = self._snapshot
+        key = _encode_name(name)
+        lo = self._first
+        hi = self._first + self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if snapshot.raw_name(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._first + self._count and snapshot.raw_name(lo) == key:
+            return lo
+        return None
+
+    def __contains__(self, name):
+        return self._find(name) is not None
+
+    def __getitem__(self, name):
+        node = self._find(name)
+        if node is None:
+            raise KeyError(name)
+        return self._snapshot.st_content(node)
+
+    def get(self, name, default=None):
+        node = self._find(name)
+        if node is None:
+            return default
+        return self._snapshot.st_content(node)
+
+    def to_dict(self):
+        '''Return a fully loaded (and modifiable) copy of the directory'''
+        result = {}
+        for name, (st, content) in self.iteritems():
+            if content is not None:
+                content = content.to_dict()
+            result[name] = [st, content]
+        return result
+
+
+class CompactDirectoryTree(object):
+
+    '''
+    In-memory directory tree using a few typed arrays instead of one list,
+    one stat tuple and one dict per entry. Names are stored in a shared
+    UTF-8 pool, only the stat fields used by FOMs (mode, size, mtime) and by
+    :meth:`DirectoriesCache.refresh` (inode, ctime) are kept, and the
+    children of a directory are a contiguous range of nodes.
+    Repeated names (such as "t1mri" in every subject directory) are stored
+    once, as long as they are found among the last name_indices_size
+    distinct names: the table used to share them is bounded, so that
+    building a tree never needs one dict entry per name.
+
+    :meth:`get_directory` returns a read-only view with the API of the dicts
+    returned by :meth:`DirectoryAsDict.get_directory`. Its stats are
+    ``tuple(os.stat())``-like tuples in which fields other than st_mode,
+    st_ino, st_size, st_mtime and st_ctime are 0. Entries without stat (st_mode == 0) get a
+    None stat.
+    '''
+
+    name_indices_size = 65536
+
+    def __init__(self):
+        self._name_pool = bytearray()
+        self._name_offsets = array.array('Q', [0])
+        self._name_indices = {}
+        self.name_index = array.array('I')
+        self.mode = array.array('I')
+        self.ino = array.array('Q')
+        self.size = array.array('q')
+        self.mtime = array.array('q')
+        self.ctime = array.array('q')
+        # -1 for entries which are not directories
+        self.first_child = array.array('q')
+        self.n_children = array.array('I')
+
+    def __len__(self):
+        return len(self.name_index)
+
+    @classmethod
+    def from_dict(cls, dirdict):
+        '''Build a tree from a ``{name: [stat, content]}`` dict'''
+        tree = cls()
+        tree._add_node('', None, dirdict is not None)
+        queue = collections.deque([(0, dirdict)])
+        while queue:
+            node, content = queue.popleft()
+            if content is None:
+                continue
+            children = sorted(
+                (_encode_name(name), name, st_content[0], st_content[1])
+                for name, st_content in six.iteritems(content))
+            tree.first_child[node] = len(tree.name_index)
+            tree.n_children[node] = len(children)
+            for raw_name, name, st, sub_content in children:
+                if sub_content is not None:
+                    queue.append((len(tree.name_index), sub_content))
+                tree._add_node(name, st, sub_content is not None)
+        tree._name_indices = None
+        return tree
+
+    @classmethod
+    def from_directory(cls, directory, workers=0, stat_files=True,
+                       debug=None):
+        '''Scan directory and build a tree without building the
+        intermediate nested dict. Directories are listed in parallel by a
+        :class:`DirectoryScanner` and each listing is added to the tree, then
+        dropped, as soon as it is read.
+        '''
+        scanner = DirectoryScanner(workers=workers, stat_files=stat_files,
+                                   debug=debug)
+        tree = cls()
+        tree._add_node('', None, True)
+        # directories listed by the scanner but not yet added to the tree
+        nodes = {directory: 0}
+        listed = 0
+        for path, entries in scanner.iter_listings(directory):
+            node = nodes.pop(path)
+            if entries is None:
+                tree.first_child[node] = -1
+                continue
+            tree.first_child[node] = len(tree.name_index)
+            tree.n_children[node] = len(entries)
+            for raw_name, name, st, is_dir in entries:
+                if is_dir:
+                    nodes[osp.join(path, name)] = len(tree.name_index)
+                tree._add_node(name, st, is_dir)
+            listed += 1
+            if debug and listed % 100 == 0:
+                debug.info('%s entries=%d, directories to scan=%d'
+                           % (time.asctime(), len(tree.name_index),
+                              len(nodes)))
+        tree._name_indices = None
+        if tree.first_child[0] == -1:
+            return None
+        return tree
+
+    def _add_node(self, name, st, is_directory):
+        raw_name = _encode_name(name)
+        index = self._name_indices.get(raw_name)
+        if index is None:
+            if len(self._name_indices) >= self.name_indices_size:
+                self._name_indices.clear()
+            index = self._name_indices[raw_name] = len(self._name_offsets) - 1
+            self._name_pool.extend(raw_name)
+            self._name_offsets.append(len(self._name_pool))
+        self.name_index.append(index)
+        if st is None:
+            self.mode.append(0)
+            self.ino.append(0)
+            self.size.append(0)
+            self.mtime.append(0)
+            self.ctime.append(0)
+        else:
+            self.mode.append(st[0])
+            self.ino.append(st[1])
+            self.size.append(st[6])
+            self.mtime.append(int(st[8]))
+            self.ctime.append(int(st[9]))
+        self.first_child.append(-1 if not is_directory else 0)
+        self.n_children.append(0)
+
+    def get_directory(self):
+        '''Return the content of the root directory as a read-only
+        dict-like object, or None if the root could not be read.
+        '''
+        if self.first_child[0] == -1:
+            return None
+        return _MappedDirectory(self, 0)
+
+    def children(self, node):
+        return self.first_child[node], self.n_children[node]
+
+    def raw_name(self, node):
+        index = self.name_index[node]
+        return bytes(self._name_pool[self._name_offsets[index]:
+                                     self._name_offsets[index + 1]])
+
+    def name(self, node):
+        return _decode_name(self.raw_name(node))
+
+    def st_content(self, node):
+        mode = self.mode[node]
+        if mode:
+            st = (mode, self.ino[node], 0, 0, 0, 0, self.size[node], 0,
+                  self.mtime[node], self.ctime[node])
+        else:
+            st = None
+        if self.first_child[node] == -1:
+            content = None
+        else:
+            content = _MappedDirectory(self, node)
+        return [st, content]
+
+
+class _DirectoriesSnapshot(object):
+
+    '''
+    Binary :class:`DirectoriesCache` file format. All integers are little
+    endian. The file contains:
+
+    * a header: magic, format version, number of roots, nodes and names,
+      and the offsets of the following sections;
+    * the roots table: (path name index, node index) for each cached
+      directory;
+    * the name table: an array of n_names + 1 uint64 offsets followed by the
+      UTF-8 encoded names. Each name is stored only once;
+    * the nodes table: (name index, first child, children count, flags) for
+      each entry. Children of a directory are contiguous and sorted by
+      name, which allows binary search lookups;
+    * the stats table: the 10 fields of ``tuple(os.stat())`` for each node.
+    '''
+
+    magic = b'SOMADCS\0'
+    version = 1
+    header = struct.Struct('<8sIIIIQQQQ')
+    root = struct.Struct('<II')
+    offset = struct.Struct('<Q')
+    node = struct.Struct('<IIII')
+    stat = struct.Struct('<QQQQQQqqqq')
+    has_stat = 1
+    is_directory = 2
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.n_roots, self.n_nodes, self.n_names,
+         self.names_pos, self.name_data_pos, self.nodes_pos,
+         self.stats_pos) = self.header.unpack_from(self.mmap, 0)
+        if magic != self.magic:
+            raise ValueError('%s is not a binary directories cache' % path)
+        if version != self.version:
+            raise ValueError('%s: unsupported directories cache version %d'
+                             % (path, version))
+
+    def close(self):
+        self.mmap.close()
+        self.file.close()
+
+    def roots(self):
+        pos = self.header.size
+        for i in xrange(self.n_roots):
+            name_index, node = self.root.unpack_from(self.mmap, pos)
+            pos += self.root.size
+            yield _decode_name(self.raw_name_at(name_index)), node
+
+    def raw_name_at(self, index):
+        begin, = self.offset.unpack_from(
+            self.mmap, self.names_pos + index * self.offset.size)
+        end, = self.offset.unpack_from(
+            self.mmap, self.names_pos + (index + 1) * self.offset.size)
+        return self.mmap[self.name_data_pos + begin:self.name_data_pos + end]
+
+    def raw_name(self, node):
+        name_index = self.node.unpack_from(
+            self.mmap, self.nodes_pos + node * self.node.size)[0]
+        return self.raw_name_at(name_index)
+
+    def name(self, node):
+        return _decode_name(self.raw_name(node))
+
+    def children(self, node):
+        name_index, first, count, flags = self.node.unpack_from(
+            self.mmap, self.nodes_pos + node * self.node.size)
+        return first, count
+
+    def st_content(self, node):
+        name_index, first, count, flags = self.node.unpack_from(
+            self.mmap, self.nodes_pos + node * self.node.size)
+        if flags & self.has_stat:
+            st = self.stat.unpack_from(
+                self.mmap, self.stats_pos + node * self.stat.size)
+        else:
+            st = None
+        if flags & self.is_directory:
+            content = _MappedDirectory(self, node)
+        else:
+            content = None
+        return [st, content]
+
+    @classmethod
+    def write(cls, directories, path):
+        names = {}
+        name_list = []
+
+        def name_index(name):
+            index = names.get(name)
+            if index is None:
+                index = names[name] = len(name_list)
+                name_list.append(name)
+            return index
+
+        nodes = []
+        stats = []
+        roots = []
+        queue = collections.deque()
+
+        def add_node(name, st_content):
+            st, content = st_content
+            flags = 0
+            if st is not None:
+                flags |= cls.has_stat
+                st = tuple(st)
+            if content is not None:
+                flags |= cls.is_directory
+                queue.append((len(nodes), content))
+            nodes.append([name_index(_encode_name(name)), 0, 0, flags])
+            stats.append(st)
+
+        for directory, st_content in six.iteritems(directories):
+            roots.append((name_index(_encode_name(directory)), len(nodes)))
+            add_node(directory, st_content)
+        while queue:
+            node, content = queue.popleft()
+            children = sorted((_encode_name(name), name, st_content)
+                              for name, st_content in six.iteritems(content))
+            nodes[node][1] = len(nodes)
+            nodes[node][2] = len(children)
+            for raw_name, name, st_content in children:
+                add_node(name, st_content)
+
+        roots_pos = cls.header.size
+        names_pos = roots_pos + len(roots) * cls.root.size
+        name_data_pos = names_pos + (len(name_list) + 1) * cls.offset.size
+        name_data_size = sum(len(i) for i in name_list)
+        nodes_pos = name_data_pos + name_data_size
+        nodes_pos += -nodes_pos % 8
+        stats_pos = nodes_pos + len(nodes) * cls.node.size
+
+        tmp = path + '.tmp'
+        f = open(tmp, 'wb')
+        try:
+            f.write(cls.header.pack(cls.magic, cls.version, len(roots),
+                                    len(nodes), len(name_list), names_pos,
+                                    name_data_pos, nodes_pos, stats_pos))
+            for root in roots:
+                f.write(cls.root.pack(*root))
+            offset = 0
+            for name in name_list:
+                f.write(cls.offset.pack(offset))
+                offset += len(name)
+            f.write(cls.offset.pack(offset))
+            f.write(b''.join(name_list))
+            f.write(b'\0' * (nodes_pos - name_data_pos - name_data_size))
+            for node in nodes:
+                f.write(cls.node.pack(*node))
+            no_stat = cls.stat.pack(*((0, ) * 10))
+            for st in stats:
+                if st is None:
+                    f.write(no_stat)
+                else:
+                    f.write(cls.stat.pack(*st[:10]))
+        finally:
+            f.close()
+        # replace the file rather than overwrite it: it may be memory-mapped
+        replace_file(tmp, path)
+
+
+def _encode_name(name):
+    if isinstance(name, bytes):
+        return name
+    if sys.version_info[0] >= 3:
+        return name.encode('utf-8', 'surrogateescape')
+    return name.encode('utf-8')
+
+
+def _decode_name(raw_name):
+    if sys.version_info[0] >= 3:
+        return raw_name.decode('utf-8', 'surrogateescape')
+    return raw_name.decode('utf-8')
+
+
 class DirectoriesCache(object):
 
+    # stat fields used to detect a directory change: inode, mtime, ctime
+    _directory_change_fields = (1, 8, 9)
+    # stat fields used to detect a file change: mode, inode, size, mtime,
+    # ctime
+    _file_change_fields = (0, 1, 6, 8, 9)
+
     def __init__(self):
         self.directories = {}
+        self._snapshot = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
-    def add_directory(self, directory, content=None, debug=None):
+    def close(self):
+        '''Release the memory-mapped snapshot opened by :meth:`load`, if
+        any. Directories read from the snapshot cannot be accessed anymore,
+        except those which have been refreshed since the load.
+        '''
+        if self._snapshot is not None:
+            self._snapshot.close()
+            self._snapshot = None
+
+    def add_directory(self, directory, content=None, debug=None,
+                      compact=False):
         if content is None:
             st = tuple(os.stat(directory))
-            content = DirectoryAsDict.get_directory(directory, debug=debug)
+            content = DirectoryAsDict.get_directory(directory, debug=debug,
+                                                    compact=compact)
         else:
             st = None
         self.directories[directory] = [st, content]
@@ -398,33 +1152,388 @@ class DirectoriesCache(object):
     def remove_directory(self, directory):
         del self.directories[directory]
 
+    def refresh(self, directory, debug=None, workers=0):
+        '''Update the cached content of directory and return a
+        :class:`DirectoryDelta`.
+
+        Every cached sub-directory is stat'ed, but only those whose inode,
+        mtime or ctime changed are listed again. New sub-directories are
+        scanned with a :class:`DirectoryScanner`. As with any mtime based
+        check, a file rewritten in place within an unchanged directory is
+        not detected, and stat times have a one second resolution.
+
+        If directory is not in the cache yet, it is added and all its
+        entries are reported as added.
+        '''
+        scanner = DirectoryScanner(workers=workers, debug=debug)
+        st_content = self.directories.get(directory)
+        if st_content is None:
+            self.add_directory(directory, debug=debug)
+            st_content = self.directories[directory]
+            delta = DirectoryDelta(directory, st_content[1])
+            self._all_entries(st_content[1], '', delta.added)
+            return delta
+        if isinstance(st_content[1], _MappedDirectory):
+            st_content[1] = st_content[1].to_dict()
+        try:
+            st = tuple(os.stat(directory))
+        except OSError:
+            st = None
+        delta = DirectoryDelta(directory, st_content[1])
+        if st is None:
+            self._all_entries(st_content[1], '', delta.removed)
+            st_content[1] = {}
+            delta.content = st_content[1]
+            return delta
+        if st_content[1] is None:
+            st_content[1] = {}
+        stack = [(directory, '', st_content, st)]
+        while stack:
+            full_path, path, st_content, st = stack.pop()
+            old_st, content = st_content
+            st_content[0] = st
+            if old_st is None or content is None \
+                    or self._changed(old_st, st,
+                                     self._directory_change_fields):
+                if content is None:
+                    content = st_content[1] = {}
+                stack.extend(self._refresh_listing(
+                    scanner, full_path, path, content, delta))
+            else:
+                subdirectories = []
+                for name, sub_st_content in six.iteritems(content):
+                    if sub_st_content[1] is None:
+                        continue
+                    sub_full_path = osp.join(full_path, name)
+                    try:
+                        sub_st = tuple(os.lstat(sub_full_path))
+                    except OSError:
+                        sub_st = None
+                    if sub_st is None or not stat.S_ISDIR(sub_st[0]):
+                        # cannot happen without a parent mtime change,
+                        # except on some network file systems
+                        subdirectories = self._refresh_listing(
+                            scanner, full_path, path, content, delta)
+                        break
+                    subdirectories.append((sub_full_path, path + name + '/',
+                                           sub_st_content, sub_st))
+                stack.extend(subdirectories)
+        return delta
+
+    def _refresh_listing(self, scanner, full_path, path, content, delta):
+        try:
+            entries = scanner.list_directory(full_path)
+        except OSError:
+            entries = []
+        subdirectories = []
+        names = set()
+        for name, st, is_dir in entries:
+            names.add(name)
+            sub_path = path + name
+            old_st_content = content.get(name)
+            if old_st_content is not None \
+                    and (old_st_content[1] is not None) != is_dir:
+                # type change: report removal then addition
+                delta.removed.append(sub_path)
+                if old_st_content[1]:
+                    self._all_entries(old_st_content[1], sub_path + '/',
+                                      delta.removed)
+                old_st_content = None
+            if old_st_content is None:
+                delta.added.append(sub_path)
+                if is_dir:
+                    sub_content = scanner.scan(osp.join(full_path, name))
+                    content[name] = [st, sub_content]
+                    if sub_content:
+                        self._all_entries(sub_content, sub_path + '/',
+                                          delta.added)
+                else:
+                    content[name] = [st, None]
+            elif is_dir:
+                subdirectories.append((osp.join(full_path, name),
+                                       sub_path + '/', old_st_content, st))
+            else:
+                old_st = old_st_content[0]
+                if old_st is not None and self._changed(
+                        old_st, st, self._file_change_fields):
+                    delta.modified.append(sub_path)
+                old_st_content[0] = st
+        for name in [i for i in content if i not in names]:
+            sub_path = path + name
+            delta.removed.append(sub_path)
+            sub_content = content.pop(name)[1]
+            if sub_content:
+                self._all_entries(sub_content, sub_path + '/', delta.removed)
+        return subdirectories
+
+    @staticmethod
+    def _changed(old_st, st, fields):
+        for i in fields:
+            if old_st[i] != st[i]:
+                return True
+        return False
+
+    @staticmethod
+    def _all_entries(content, path, result):
+        stack = [(content, path)]
+        while stack:
+            content, path = stack.pop()
+            for name, st_content in six.iteritems(content):
+                result.append(path + name)
+                if st_content[1]:
+                    stack.append((st_content[1], path + name + '/'))
+
     def has_directory(self, directory):
         return directory in self.directories
 
     def get_directory(self, directory):
-        return self.directories.get(directory)
-
-    def save(self, path):
+        '''Return ``[stat, content]`` for a cached directory or for any
+        directory below a cached one, or None.
+        '''
+        st_content = self.directories.get(directory)
+        if st_content is not None:
+            return st_content
+        for root, st_content in six.iteritems(self.directories):
+            if directory.startswith(root) \
+                    and directory[len(root):len(root) + 1] == os.sep:
+                for name in split_path(directory[len(root) + 1:]):
+                    content = st_content[1]
+                    if not content:
+                        return None
+                    st_content = content.get(name)
+                    if st_content is None:
+                        return None
+                return st_content
+        return None
+
+    def save(self, path, format='json'):
+        '''Save the cache in a file. format may be "json" (bz2 compressed
+        JSON when the bz2 module is available) or "binary" (see
+        :class:`_DirectoriesSnapshot`), which is much faster to load and is
+        memory-mapped by :meth:`load`.
+        '''
+        if format == 'binary':
+            _DirectoriesSnapshot.write(self.directories, path)
+            return
+        elif format != 'json':
+            raise ValueError('Unknown directories cache format: %s' % format)
+        directories = dict(
+            (directory, [st, content.to_dict()
+                         if isinstance(content, _MappedDirectory)
+                         else content])
+            for directory, (st, content) in six.iteritems(self.directories))
         if bz2:
             f = bz2.BZ2File(path, 'w')
+            f.write(json.dumps(directories).encode('utf-8'))
         else:
             f = open(path, 'w')
-        json.dump(self.directories, f)
+            json.dump(directories, f)
+        f.close()
 
     @classmethod
     def load(cls, path):
+        '''Load a cache saved with :meth:`save`. The format is
+        automatically detected. Binary caches are memory-mapped and their
+        content is only read when it is accessed; the mapping is released
+        by :meth:`close`.
+        '''
         result = cls()
+        result.read(path)
+        return result
+
+    def read(self, path):
+        '''Replace the content of this cache by the cache saved in path
+        (see :meth:`load`). A snapshot previously loaded in this cache is
+        closed.
+        '''
+        self.close()
+        with open(path, 'rb') as f:
+            magic = f.read(len(_DirectoriesSnapshot.magic))
+        if magic == _DirectoriesSnapshot.magic:
+            snapshot = _DirectoriesSnapshot(path)
+            self._snapshot = snapshot
+            self.directories = dict(
+                (directory, snapshot.st_content(node))
+                for directory, node in snapshot.roots())
+            return
         if bz2:
             try:
                 f = bz2.BZ2File(path, 'r')
-                result.directories = json.load(f)
+                self.directories = json.loads(f.read().decode('utf-8'))
             except IOError:
                 f = open(path, 'r')
-                result.directories = json.load(f)
+                self.directories = json.load(f)
         else:
             f = open(path, 'r')
-            result.directories = json.load(f)
-        return result
+            self.directories = json.load(f)
+        f.close()
+
+
+class DirectoryListingCache(object):
+
+    '''
+    Answer file existence queries with at most one listing per directory.
+    Directories below a root of directories_cache (a
+    :class:`DirectoriesCache`) are looked up in this snapshot, other ones are
+    listed on the file system on first use and their names are kept until
+    :meth:`clear` is called. listed counts the file system listings.
+    '''
+
+    def __init__(self, directories_cache=None):
+        self.directories_cache = directories_cache
+        self.listed = 0
+        self._listings = {}
+
+    def exists(self, path):
+        directory, name = osp.split(path)
+        if not name:
+            return osp.exists(path)
+        return name in self.listdir(directory)
+
+    def listdir(self, directory):
+        '''Return a container of the names of directory entries (empty if
+        the directory does not exist).
+        '''
+        names = self._listings.get(directory)
+        if names is None:
+            names = self._snapshot_names(directory)
+            if names is None:
+                try:
+                    names = frozenset(
+                        name for name, is_directory
+                        in DirectoryScanner.list_names(directory or os.curdir))
+                except OSError:
+                    names = frozenset()
+                self.listed += 1
+            self._listings[directory] = names
+        return names
+
+    def _snapshot_names(self, directory):
+        if self.directories_cache is None:
+            return None
+        for root in self.directories_cache.directories:
+            if directory == root or (directory.startswith(root)
+                                     and directory[len(root):len(root) + 1]
+                                     == os.sep):
+                st_content = self.directories_cache.get_directory(directory)
+                if st_content is None or not st_content[1]:
+                    return frozenset()
+                return st_content[1]
+        return None
+
+    def clear(self):
+        self._listings.clear()
+
+
+class LRUCache(object):
+
+    '''
+    Thread-safe bounded mapping which discards the least recently used items
+    first. hits and misses count the successful and failed :meth:`get`
+    calls.
+    '''
+
+    def __init__(self, max_size=128):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<LRUCache( size=%d/%d, hits=%d, misses=%d )>' \
+            % (len(self._items), self.max_size, self.hits, self.misses)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._items[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+def _encode_compiled_foms(value):
+    '''Return a JSON serializable copy of the FileOrganizationModels
+    state value. Sets are tagged, and dicts found several times (such as
+    rule attributes, which are shared by rules and patterns) are written
+    once and referenced afterwards, so that :class:`_CompiledFOMsDecoder`
+    restores them as shared objects.
+    '''
+    counts = {}
+    stack = [value]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, dict):
+            counts[id(item)] = counts.get(id(item), 0) + 1
+            if counts[id(item)] == 1:
+                stack.extend(six.itervalues(item))
+        elif isinstance(item, list):
+            stack.extend(item)
+    shared = {}
+
+    def encode(item):
+        if isinstance(item, dict):
+            index = shared.get(id(item))
+            if index is not None:
+                return {'__fom_ref__': index}
+            result = OrderedDict((k, encode(v)) for k, v in six.iteritems(item))
+            if counts[id(item)] > 1:
+                index = shared[id(item)] = len(shared)
+                result = OrderedDict([('__fom_shared__', index),
+                                      ('value', result)])
+            return result
+        if isinstance(item, (list, tuple)):
+            return [encode(i) for i in item]
+        if isinstance(item, (set, frozenset)):
+            return {'__fom_set__': [encode(i) for i in item]}
+        return item
+
+    return encode(value)
+
+
+class _CompiledFOMsDecoder(object):
+
+    '''object_pairs_hook for JSON files written with
+    :func:`_encode_compiled_foms`. JSON objects are read as OrderedDict.
+    '''
+
+    def __init__(self):
+        self.shared = {}
+
+    def __call__(self, pairs):
+        if len(pairs) == 1:
+            key, value = pairs[0]
+            if key == '__fom_set__':
+                return set(value)
+            if key == '__fom_ref__':
+                return self.shared[value]
+        elif len(pairs) == 2 and pairs[0][0] == '__fom_shared__':
+            value = self.shared[pairs[0][1]] = pairs[1][1]
+            return value
+        return OrderedDict(pairs)
 
 
 class FileOrganizationModelManager(object):
@@ -436,9 +1545,23 @@ class FileOrganizationModelManager(object):
     contained in a predefined set of directories (see find_fom method) and to
     instanciate a FileOrganizationModel for each identified file (see get_fom
     method).
+
+    If cache_directory is set, FOMs loaded by load_foms are also saved there,
+    fully expanded, in a JSON file. Later calls (in any process)
+    load this file instead of parsing the FOM files again, as long as none of
+    the FOM files that contributed to it (including imported ones) and none
+    of the directories of paths have changed.
     '''
 
-    def __init__(self, paths=None):
+    # version of the compiled FOMs files format
+    compiled_foms_version = 2
+    # version of the FOM directories catalogs format
+    catalog_version = 1
+    # FOM directories catalogs and parsed FOM files, shared by all managers
+    _catalogs = LRUCache(64)
+    _parsed_files = LRUCache(256)
+
+    def __init__(self, paths=None, cache_directory=None):
         '''
         Create a FOM manager that will use the given paths to find available FOMs.
         '''
@@ -446,44 +1569,138 @@ class FileOrganizationModelManager(object):
             paths = [osp.join(osp.dirname(osp.dirname(osp.dirname(__file__))),
                               'share', 'foms')]
         self.paths = paths
+        self.cache_directory = cache_directory
         self._cache = None
 
     def find_foms(self):
         '''Return a list of file organisation model (FOM) names.
         These FOMs can be loaded with load_foms. FOM files (or directories) are
-        looked for in self.paths.'''
-        #print('*** find_foms ***')
-        #import time
-        #t0 = time.time()
+        looked for in self.paths.
+
+        The FOM name and imports of each file are kept in a catalog of each
+        FOM directory (in memory, and in cache_directory if it is set), so
+        that only new or modified files are read.'''
         self._cache = {}
+        self._imports = {}
         for path in self.paths:
-            # print('   ', path)
             if os.path.isdir(path):
-                for i in os.listdir(path):
-                    full_path = osp.join(path, i)
-                    if osp.isdir(full_path):
-                        for ext in ('.json', '.yaml'):
-                            main_file = osp.join(full_path, i + ext)
-                            if osp.exists(main_file):
-                                d = read_json(main_file)
-                                name = d.get('fom_name')
-                                if not name:
-                                    raise ValueError(
-                                        'file %s does not contain fom_name'
-                                        % main_file)
-                                self._cache[name] = full_path
-                    elif i.endswith('.json') or i.endswith('.yaml'):
-                        d = read_json(full_path)
-                        if d:
-                            name = d.get('fom_name')
-                            if not name:
-                                raise ValueError(
-                                    'file %s does not contain fom_name'
-                                    % full_path)
-                            self._cache[name] = full_path
-        #print('    find_foms done: %f s' % (time.time() - t0))
+                for full_path, name, imports in self._directory_catalog(path):
+                    self._cache[name] = full_path
+                    self._imports[name] = imports
         return self._cache.keys()
 
+    def _directory_catalog(self, path):
+        '''Return a list of (full_path, fom_name, fom_import) for the FOMs of
+        a directory, in directory listing order. The directory is listed
+        again only if its mtime (or the mtime of a FOM sub-directory)
+        changed, and a FOM file is read again only if its mtime or size
+        changed.
+        '''
+        dir_mtime = os.stat(path).st_mtime
+        catalog = self._catalogs.get(path)
+        if catalog is None:
+            catalog = self._read_catalog(path)
+        old_entries = {}
+        files = None
+        if catalog is not None:
+            old_entries = dict((e['file'], e) for e in catalog['entries'])
+            if catalog['mtime'] == dir_mtime:
+                files = [(e['path'], e['file']) for e in catalog['entries']]
+                for subdirectory, mtime in six.iteritems(
+                        catalog['subdirectories']):
+                    try:
+                        if os.stat(subdirectory).st_mtime != mtime:
+                            files = None
+                            break
+                    except OSError:
+                        files = None
+                        break
+        changed = files is None
+        subdirectories = catalog['subdirectories'] if not changed else {}
+        if changed:
+            files = []
+            for i in os.listdir(path):
+                full_path = osp.join(path, i)
+                if osp.isdir(full_path):
+                    subdirectories[full_path] = os.stat(full_path).st_mtime
+                    for ext in ('.json', '.yaml'):
+                        main_file = osp.join(full_path, i + ext)
+                        if osp.exists(main_file):
+                            files.append((full_path, main_file))
+                elif i.endswith('.json') or i.endswith('.yaml'):
+                    files.append((full_path, full_path))
+        entries = []
+        for full_path, main_file in files:
+            try:
+                st = os.stat(main_file)
+            except OSError:
+                changed = True
+                continue
+            entry = old_entries.get(main_file)
+            if entry is None or entry['mtime'] != st.st_mtime \
+                    or entry['size'] != st.st_size:
+                d = read_json(main_file)
+                name = None
+                imports = []
+                if d:
+                    name = d.get('fom_name')
+                    if not name:
+                        raise ValueError('file %s does not contain fom_name'
+                                         % main_file)
+                    imports = list(d.get('fom_import', []))
+                entry = {'path': full_path, 'file': main_file,
+                         'mtime': st.st_mtime, 'size': st.st_size,
+                         'fom_name': name, 'fom_import': imports}
+                changed = True
+            entries.append(entry)
+        catalog = {'version': self.catalog_version, 'directory': path,
+                   'mtime': dir_mtime, 'subdirectories': subdirectories,
+                   'entries': entries}
+        self._catalogs.put(path, catalog)
+        if changed:
+            self._write_catalog(path, catalog)
+        return [(e['path'], e['fom_name'], e['fom_import'])
+                for e in entries if e['fom_name']]
+
+    def _catalog_file(self, path):
+        return osp.join(
+            self.cache_directory, 'catalog-%s.json'
+            % hashlib.sha1(osp.abspath(path).encode('utf-8')).hexdigest())
+
+    def _read_catalog(self, path):
+        if not self.cache_directory:
+            return None
+        try:
+            with open(self._catalog_file(path)) as f:
+                catalog = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if catalog.get('version') != self.catalog_version \
+                or catalog.get('directory') != path:
+            return None
+        return catalog
+
+    def _write_catalog(self, path, catalog):
+        if not self.cache_directory:
+            return
+        try:
+            if not osp.isdir(self.cache_directory):
+                os.makedirs(self.cache_directory)
+            fd, tmp = tempfile.mkstemp(dir=self.cache_directory,
+                                       suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(catalog, f)
+            replace_file(tmp, self._catalog_file(path))
+        except (IOError, OSError):
+            pass
+
+    def fom_imports(self, fom_name):
+        '''Return the list of FOMs directly imported by a FOM, without
+        reading it.'''
+        if self._cache is None:
+            self.find_foms()
+        return self._imports[fom_name]
+
     def fom_files(self):
         '''Return a list of file organisation model (FOM) names, as in
         :meth:`find_foms`, but does not clear and reload the cache.
@@ -497,25 +1714,138 @@ class FileOrganizationModelManager(object):
         self._cache = None
 
     def load_foms(self, *names):
+        if self.cache_directory:
+            foms = self._load_compiled_foms(names)
+            if foms is not None:
+                return foms
         if self._cache is None:
             self.find_foms()
         foms = FileOrganizationModels()
         for name in names:
             foms.import_file(self._cache[name], foms_manager=self)
+        if self.cache_directory:
+            self._save_compiled_foms(names, foms)
         return foms
 
+    def _compiled_foms_file(self, names):
+        key = repr((names, [osp.abspath(i) for i in self.paths]))
+        return osp.join(
+            self.cache_directory, 'fom-%s-py%d.json'
+            % (hashlib.sha1(key.encode('utf-8')).hexdigest(),
+               sys.version_info[0]))
+
+    @staticmethod
+    def _file_digest(path):
+        digest = hashlib.sha1()
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+        return digest.hexdigest()
+
+    def _fingerprints(self, foms):
+        '''(path, mtime, size, sha1) of the files used to build foms, and
+        (path, mtime, None, None) for the FOM directories.
+        '''
+        fingerprints = []
+        for path in foms.source_files:
+            st = os.stat(path)
+            fingerprints.append((path, st.st_mtime, st.st_size,
+                                 self._file_digest(path)))
+        for path in self.paths:
+            if osp.isdir(path):
+                fingerprints.append((path, os.stat(path).st_mtime, None,
+                                     None))
+            else:
+                fingerprints.append((path, None, None, None))
+        return fingerprints
+
+    def _fingerprint_valid(self, fingerprint):
+        path, mtime, size, digest = fingerprint
+        try:
+            st = os.stat(path)
+        except OSError:
+            return mtime is None
+        if st.st_mtime == mtime and (size is None or st.st_size == size):
+            return True
+        if digest is None or st.st_size != size:
+            return False
+        # touched but maybe not modified
+        return self._file_digest(path) == digest
+
+    def _load_compiled_foms(self, names):
+        path = self._compiled_foms_file(names)
+        try:
+            with open(path) as f:
+                version, fingerprints = json.loads(f.readline())
+                if version != self.compiled_foms_version:
+                    return None
+                for fingerprint in fingerprints:
+                    if not self._fingerprint_valid(fingerprint):
+                        return None
+                state = json.loads(f.readline(),
+                                   object_pairs_hook=_CompiledFOMsDecoder())
+            foms = FileOrganizationModels()
+            foms.__dict__.update(state)
+            return foms
+        except Exception:
+            # missing, obsolete or corrupted file
+            return None
+
+    def _save_compiled_foms(self, names, foms):
+        path = self._compiled_foms_file(names)
+        tmp = None
+        try:
+            fingerprints = self._fingerprints(foms)
+            state = dict((k, v) for k, v in six.iteritems(foms.__dict__)
+                         if not k.endswith('_regex'))
+            try:
+                header = json.dumps([self.compiled_foms_version,
+                                     fingerprints])
+                state = json.dumps(_encode_compiled_foms(state))
+            except TypeError:
+                # FOMs which cannot be written in JSON are just not cached
+                return
+            if not osp.isdir(self.cache_directory):
+                os.makedirs(self.cache_directory)
+            fd, tmp = tempfile.mkstemp(dir=self.cache_directory,
+                                       suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                f.write(header + '\n')
+                f.write(state + '\n')
+            # atomic replacement: other processes may be reading it
+            replace_file(tmp, path)
+            tmp = None
+        except (OSError, IOError, ValueError):
+            # the cache is only an optimization
+            pass
+        finally:
+            if tmp is not None and osp.exists(tmp):
+                os.remove(tmp)
+
     def file_name(self, fom):
         if self._cache is None:
             self.find_foms()
         return self._cache[fom]
 
+    def _read_fom_file(self, file_name):
+        '''Return a copy of the content of a FOM file. Parsed files are
+        kept in memory as long as their mtime and size do not change.
+        '''
+        st = os.stat(file_name)
+        key = (st.st_mtime, st.st_size)
+        parsed = self._parsed_files.get(file_name)
+        if parsed is None or parsed[0] != key:
+            parsed = (key, read_json(file_name))
+            self._parsed_files.put(file_name, parsed)
+        return copy.deepcopy(parsed[1])
+
     def read_definition(self, fom_name, done=None):
         jsons = OrderedDict()
         stack = [fom_name]
         while stack:
             fom_name = stack.pop(0)
             if fom_name not in jsons:
-                json = jsons[fom_name] = read_json(self.file_name(fom_name))
+                json = jsons[fom_name] = self._read_fom_file(
+                    self.file_name(fom_name))
                 stack.extend(json.get('fom_import', []))
         jsons = list(jsons.values())
         result = jsons.pop(0)
@@ -552,6 +1882,9 @@ class FileOrganizationModels(object):
         self.shared_patterns = {}
         self.patterns = {}
         self.rules = []
+        # files read by import_file, and whether dicts were also imported
+        self.source_files = []
+        self.imported_dicts = False
 
     def _expand_shared_pattern(self, pattern):
         expanded_pattern = []
@@ -574,8 +1907,11 @@ class FileOrganizationModels(object):
     def import_file(self, file_or_dict, foms_manager=None):
         if not isinstance_dict(file_or_dict):
             json_dict = read_json(file_or_dict)
+            if file_or_dict not in self.source_files:
+                self.source_files.append(file_or_dict)
         else:
             json_dict = file_or_dict
+            self.imported_dicts = True
 
         foms = json_dict.get('fom_import', [])
         if foms and foms_manager is None:
@@ -846,16 +2182,47 @@ class FileOrganizationModels(object):
             pprint.pprint(getattr(self, i), out)
 
 
+# state of the PathToAttributes parallel parsing run by a worker process
+_parse_state = None
+
+
+def _init_parse_worker(*state):
+    '''Pool initializer of PathToAttributes parallel parsing workers.'''
+    global _parse_state
+    _parse_state = state
+
+
+def _parse_task(index):
+    '''Run a PathToAttributes parallel parsing task in a worker process.'''
+    pta, tasks, single_match, all_unknown, log = _parse_state
+    return list(pta._run_parse_task(tasks[index], single_match, all_unknown,
+                                    log))
+
+
 class PathToAttributes(object):
 
     '''
     Utility class for file paths -> attributes set transformation.
     Part of the FOM engine.
+
+    Results of :meth:`parse_path` are cached in parse_path_cache, an
+    :class:`LRUCache` of parse_path_cache_size items (0 disables it).
     '''
 
-    def __init__(self, foms, selection=None):
+    # maximum number of compiled hierarchical_patterns nodes kept in cache
+    max_compiled_nodes = 10000
+
+    def __init__(self, foms, selection=None, parse_path_cache_size=1024):
+        self.parse_path_cache = LRUCache(parse_path_cache_size) \
+            if parse_path_cache_size else None
         self._attributes_regex = re.compile('<([^>]+)>')
+        self._bound_attributes_regex = re.compile(r'%\(([^)]+)\)s')
         self.hierarchical_patterns = OrderedDict()
+        # literal text at the begining of each pattern
+        self._pattern_prefixes = {}
+        # id(hierarchical_patterns node) -> (node, bound attributes, extensions)
+        self._nodes_info = {}
+        self._compiled_nodes = {}
         for rule_pattern, rule_attributes in foms.selected_rules(selection):
             rule_formats = rule_attributes.get('fom_formats', [])
             parent = self.hierarchical_patterns
@@ -893,6 +2260,12 @@ class PathToAttributes(object):
                 last = pattern[last_end:]
                 if last:
                     regex.append(re.escape(last))
+                first_match = self._attributes_regex.search(pattern)
+                if first_match is None:
+                    prefix = pattern
+                else:
+                    prefix = pattern[:first_match.start()]
+                self._pattern_prefixes[''.join(regex) + '$'] = prefix
                 if count == len(splited_pattern):
                     if rule_formats:
                         for format in rule_formats:
@@ -936,97 +2309,229 @@ class PathToAttributes(object):
         else:
             print('  ' * indent + '{}', file=file, end=' ')
 
-    def parse_directory(self, dirdict, single_match=False, all_unknown=False, log=None):
+    def parse_directory(self, dirdict, single_match=False, all_unknown=False,
+                        log=None, workers=1, split_depth=1):
+        '''Yield (path, stat, attributes) for the entries of dirdict.
+
+        When workers is not 1, the sub-directories found at split_depth are
+        parsed in a pool of forked processes (0 means one process per CPU, a
+        negative value means the number of CPUs minus this value). Results
+        are yielded in the same order as the serial parsing.
+        '''
         if isinstance(dirdict, basestring):
             dirdict = DirectoryAsDict.paths_to_dict(dirdict)
-        return self._parse_directory(dirdict, [([], self.hierarchical_patterns, {})], single_match, all_unknown, log)
+        parsing_list = [([], self.hierarchical_patterns, {})]
+        workers = self._parse_workers(workers)
+        if workers > 1:
+            return self._parallel_parse(
+                self._split_parse_directory(dirdict, parsing_list,
+                                            single_match, all_unknown, log,
+                                            split_depth),
+                workers, single_match, all_unknown, log)
+        return self._parse_directory(dirdict, parsing_list, single_match, all_unknown, log)
+
+    def parse_live_directory(self, directory, single_match=False,
+                             log=None, workers=1, split_depth=1):
+        '''Parse a directory on the file system, like
+        :meth:`parse_directory`, but without snapshoting it first: only
+        directories whose names match a pattern at their depth are listed,
+        and only matching entries are stat'ed. Results are yielded as the
+        directory is walked. Unknown files cannot be reported with this
+        method (see all_unknown in :meth:`parse_directory`). workers and
+        split_depth have the same meaning as in :meth:`parse_directory`.
+        '''
+        parsing_list = [([], self.hierarchical_patterns, {})]
+        workers = self._parse_workers(workers)
+        if workers > 1:
+            return self._parallel_parse(
+                self._split_parse_live_directory(directory, parsing_list,
+                                                 single_match, log,
+                                                 split_depth),
+                workers, single_match, False, log)
+        return self._parse_live_directory(directory, parsing_list,
+                                          single_match, log)
 
-    def _parse_directory(self, dirdict, parsing_list, single_match, all_unknown, log):
+    @staticmethod
+    def _parse_workers(workers):
+        if workers == 1 or not PathToAttributes._can_fork():
+            return 1
+        if workers == 0:
+            return multiprocessing.cpu_count()
+        if workers < 0:
+            return max(1, multiprocessing.cpu_count() + workers)
+        return workers
+
+    @staticmethod
+    def _can_fork():
+        '''Parsing is only run in forked processes when fork is the
+        multiprocessing start method and no other thread is running (a
+        forked process only gets a copy of the calling thread, and locks
+        held by other threads are never released in it).
+        '''
+        if not hasattr(os, 'fork') or threading.active_count() > 1:
+            return False
+        get_start_method = getattr(multiprocessing, 'get_start_method', None)
+        if get_start_method is None:
+            # Python 2 always forks on Unix
+            return True
+        method = get_start_method(allow_none=True)
+        if method is None:
+            method = multiprocessing.get_context().get_start_method()
+        return method == 'fork'
+
+    def _parallel_parse(self, segments, workers, single_match, all_unknown,
+                        log):
+        '''Yield the results of segments, a sequence of ('result', item)
+        and ('task', task), where tasks are run in a pool of forked
+        processes. Tasks are not pickled: workers inherit them from the
+        fork, through the pool initializer arguments. Tasks are run in the
+        calling process when forking is not safe (see :meth:`_can_fork`).
+        '''
+        segments = list(segments)
+        tasks = [item for kind, item in segments if kind == 'task']
+        if len(tasks) < 2 or not self._can_fork():
+            for kind, item in segments:
+                if kind == 'result':
+                    yield item
+                else:
+                    for i in self._run_parse_task(item, single_match,
+                                                  all_unknown, log):
+                        yield i
+            return
+        try:
+            context = multiprocessing.get_context('fork')
+        except AttributeError:
+            # Python 2 always forks on Unix
+            context = multiprocessing
+        # workers respawned by the pool get the same state
+        pool = context.Pool(min(workers, len(tasks)),
+                            initializer=_init_parse_worker,
+                            initargs=(self, tasks, single_match, all_unknown,
+                                      log))
+        try:
+            results = pool.imap(_parse_task, xrange(len(tasks)))
+            for kind, item in segments:
+                if kind == 'result':
+                    yield item
+                else:
+                    for i in next(results):
+                        yield i
+        finally:
+            pool.terminate()
+
+    def _run_parse_task(self, task, single_match, all_unknown, log):
+        kind, content, parsing_list = task
+        if kind == 'parse':
+            return self._parse_directory(content, parsing_list, single_match,
+                                         all_unknown, log)
+        elif kind == 'live':
+            return self._parse_live_directory(content, parsing_list,
+                                              single_match, log)
+        # parsing_list is the path of the unknown directory
+        return self._parse_unknown_directory(content, parsing_list, log)
+
+    def _split_parse_directory(self, dirdict, parsing_list, single_match,
+                               all_unknown, log, depth):
+        '''Same as :meth:`_parse_directory` down to depth, but yields
+        ('result', item) for results and ('task', task) for sub-directories
+        left to parse.
+        '''
+        path = parsing_list[-1][0]
         for name, content in six.iteritems(dirdict):
             st, content = content
-            # Split extention on left most dot
-            l = name.split('.')
-            possible_extension_split = [('.'.join(l[:i]), '.'.join(l[i:]))
-                                        for i in range(1, len(l) + 1)]
-            # split = name.split('.', 1)
-            # name_no_ext = split[0]
-            # if len(split) == 2:
-                # ext = split[1]
-            # else:
-                # ext = ''
-
-            matched_directories = []
-            matched = False
+            matches, recurse_parsing_list, matched = self._match_name(
+                name, parsing_list,
+                (st is None or stat.S_ISDIR(st[0])) and content is not None,
+                bool(content), single_match, log)
             sent = False
-            recurse_parsing_list = []
-            for path, hierarchical_patterns, pattern_attributes in parsing_list:
+            for full_path, yield_attributes in matches:
+                sent = True
+                yield 'result', (full_path, st, yield_attributes)
+            if recurse_parsing_list:
+                if depth > 1:
+                    for i in self._split_parse_directory(
+                            content, recurse_parsing_list, single_match,
+                            all_unknown, log, depth - 1):
+                        yield i
+                else:
+                    yield 'task', ('parse', content, recurse_parsing_list)
+            if not matched and all_unknown:
                 if log:
-                    log.debug('?? ' + name + ' ' + repr(
-                        pattern_attributes) + ' ' + repr(hierarchical_patterns.keys()))
-                branch_matched = False
-                for pattern, rules_subpattern \
-                        in six.iteritems(hierarchical_patterns):
-                    stop_parsing = False
-                    for name_no_ext, ext in possible_extension_split:
-                        ext_rules, subpattern = rules_subpattern
-                        pattern = pattern % pattern_attributes
-                        match = re.match(pattern, name_no_ext)
-                        if log:
-                            log.debug(
-                                'try %s for %s' % (repr(pattern), repr(name_no_ext)))
-                        if match:
-                            if log:
-                                log.debug('match ' + pattern)
-                            new_attributes = match.groupdict()
-                            new_attributes.update(pattern_attributes)
-
-                            rules = ext_rules.get(ext)
-                            if (subpattern and
-                                    not ext and
-                                    (st is None or
-                                     stat.S_ISDIR(st[0])) and
-                                    content is not None):
-                                matched = branch_matched = True
-                                stop_parsing = single_match
-                                full_path = path + [name]
-                                if log:
-                                    log.debug('directory matched: %s %s' % (
-                                        repr(full_path), (repr([i[0] for i in six.iteritems(content)]) if content else None)))
-                                matched_directories.append(
-                                    (full_path, subpattern, new_attributes))
-                            else:
-                                if log:
-                                    log.debug(
-                                        'no directory matched for %s' % repr(name))
-                            if rules is not None and ext:
-                                matched = branch_matched = True
-                                if log:
-                                    log.debug(
-                                        'extension matched: ' + repr(ext))
-                                for rule_attributes in rules:
-                                    yield_attributes = new_attributes.copy()
-                                    yield_attributes.update(rule_attributes)
-                                    stop_parsing = single_match or yield_attributes.pop(
-                                        'fom_stop_parsing', False)
-                                    if log:
-                                        log.debug(
-                                            '-> ' + '/'.join(path + [name]) + ' ' + repr(yield_attributes))
-                                    sent = True
-                                    yield path + [name], st, yield_attributes
-                                break
-                            else:
-                                if log:
-                                    log.debug(
-                                        'no extension matched: ' + repr(ext))
-                        if stop_parsing:
-                            break
-                    if stop_parsing:
-                        break
-                if branch_matched:
-                    for full_path, subpattern, new_attributes in matched_directories:
-                        if content:
-                            recurse_parsing_list.append(
-                                (full_path, subpattern, new_attributes))
+                    log.debug('-> ' + '/'.join(path + [name]) + ' None')
+                sent = True
+                yield 'result', (path + [name], st, None)
+                if content:
+                    yield 'task', ('unknown', content, path + [name])
+            if not sent and all_unknown:
+                if log:
+                    log.debug('-> ' + '/'.join(path + [name]) + ' None')
+                yield 'result', (path + [name], st, None)
+
+    def _split_parse_live_directory(self, directory, parsing_list,
+                                    single_match, log, depth):
+        '''Same as :meth:`_split_parse_directory` for
+        :meth:`_parse_live_directory`.
+        '''
+        try:
+            entries = DirectoryScanner.list_names(directory)
+        except OSError:
+            return
+        for name, is_directory in entries:
+            matches, recurse_parsing_list, matched = self._match_name(
+                name, parsing_list, is_directory, is_directory, single_match,
+                log)
+            full_path = osp.join(directory, name)
+            if matches:
+                try:
+                    st = tuple(os.lstat(full_path))
+                except OSError:
+                    continue
+                for path, attributes in matches:
+                    yield 'result', (path, st, attributes)
+            if recurse_parsing_list:
+                if depth > 1:
+                    for i in self._split_parse_live_directory(
+                            full_path, recurse_parsing_list, single_match,
+                            log, depth - 1):
+                        yield i
+                else:
+                    yield 'task', ('live', full_path, recurse_parsing_list)
+
+    def _parse_live_directory(self, directory, parsing_list, single_match,
+                              log):
+        try:
+            entries = DirectoryScanner.list_names(directory)
+        except OSError:
+            return
+        for name, is_directory in entries:
+            matches, recurse_parsing_list, matched = self._match_name(
+                name, parsing_list, is_directory, is_directory, single_match,
+                log)
+            full_path = osp.join(directory, name)
+            if matches:
+                try:
+                    st = tuple(os.lstat(full_path))
+                except OSError:
+                    continue
+                for path, attributes in matches:
+                    yield path, st, attributes
+            if recurse_parsing_list:
+                for i in self._parse_live_directory(
+                        full_path, recurse_parsing_list, single_match, log):
+                    yield i
+
+    def _parse_directory(self, dirdict, parsing_list, single_match, all_unknown, log):
+        path = parsing_list[-1][0]
+        for name, content in six.iteritems(dirdict):
+            st, content = content
+            matches, recurse_parsing_list, matched = self._match_name(
+                name, parsing_list,
+                (st is None or stat.S_ISDIR(st[0])) and content is not None,
+                bool(content), single_match, log)
+            sent = False
+            for full_path, yield_attributes in matches:
+                sent = True
+                yield full_path, st, yield_attributes
             if recurse_parsing_list:
                 for i in self._parse_directory(content, recurse_parsing_list, single_match, all_unknown, log):
                     yield i
@@ -1043,6 +2548,138 @@ class PathToAttributes(object):
                     log.debug('-> ' + '/'.join(path + [name]) + ' None')
                 yield path + [name], st, None
 
+    def _compile_node(self, hierarchical_patterns, pattern_attributes):
+        '''Return the patterns of a hierarchical_patterns node, with
+        attributes values already found in parent directories substituted and
+        compiled, as a list of (pattern, regex, prefix, ext_rules, subpattern),
+        and the set of non-empty extensions used in the node.
+
+        Compiled nodes are cached according to the values of the attributes
+        they actually use.
+        '''
+        node_info = self._nodes_info.get(id(hierarchical_patterns))
+        if node_info is None:
+            bound_attributes = set()
+            extensions = set()
+            for pattern, rules_subpattern \
+                    in six.iteritems(hierarchical_patterns):
+                bound_attributes.update(
+                    self._bound_attributes_regex.findall(pattern))
+                extensions.update(i for i in rules_subpattern[0] if i)
+            # the node is kept in node_info to keep its id valid
+            node_info = (hierarchical_patterns,
+                         tuple(sorted(bound_attributes)), extensions)
+            self._nodes_info[id(hierarchical_patterns)] = node_info
+        bound_attributes = node_info[1]
+        key = (id(hierarchical_patterns), ) + tuple(
+            pattern_attributes.get(i) for i in bound_attributes)
+        compiled = self._compiled_nodes.get(key)
+        if compiled is None:
+            patterns = []
+            for pattern, rules_subpattern \
+                    in six.iteritems(hierarchical_patterns):
+                ext_rules, subpattern = rules_subpattern
+                prefix = self._pattern_prefixes.get(pattern, '')
+                if bound_attributes:
+                    pattern = pattern % pattern_attributes
+                patterns.append((pattern, re.compile(pattern), prefix,
+                                 ext_rules, subpattern))
+            compiled = (patterns, node_info[2])
+            if len(self._compiled_nodes) >= self.max_compiled_nodes:
+                self._compiled_nodes.clear()
+            self._compiled_nodes[key] = compiled
+        return compiled
+
+    def _match_name(self, name, parsing_list, is_directory, has_content,
+                    single_match, log, files=True):
+        '''Match a directory entry name against the patterns of
+        parsing_list. is_directory tells if name can be a directory matching
+        a sub-pattern, and has_content if it has entries to parse. If files
+        is False, file matches are not built (but still stop the parsing as
+        they would).
+
+        Returns (matches, recurse_parsing_list, matched) where matches is a
+        list of (path, attributes) for rules matching name as a file and
+        recurse_parsing_list is the parsing list to use for its content.
+        '''
+        # Possible (name_no_ext, ext) splits on dots, from the left most
+        # one. Only splits giving a known extension of the node are tried,
+        # then the full name (without extension) for directories.
+        l = name.split('.')
+        possible_extension_split = [('.'.join(l[:i]), '.'.join(l[i:]))
+                                    for i in range(1, len(l))]
+
+        matches = []
+        matched_directories = []
+        matched = False
+        recurse_parsing_list = []
+        for path, hierarchical_patterns, pattern_attributes in parsing_list:
+            if log:
+                log.debug('?? ' + name + ' ' + repr(
+                    pattern_attributes) + ' ' + repr(hierarchical_patterns.keys()))
+            patterns, extensions = self._compile_node(hierarchical_patterns,
+                                                      pattern_attributes)
+            splits = [i for i in possible_extension_split
+                      if i[1] in extensions]
+            if is_directory:
+                splits.append((name, ''))
+            branch_matched = False
+            for pattern, regex, prefix, ext_rules, subpattern in patterns:
+                if prefix and not name.startswith(prefix):
+                    continue
+                stop_parsing = False
+                for name_no_ext, ext in splits:
+                    if ext:
+                        rules = ext_rules.get(ext)
+                        if rules is None:
+                            continue
+                    elif not subpattern:
+                        continue
+                    match = regex.match(name_no_ext)
+                    if log:
+                        log.debug(
+                            'try %s for %s' % (repr(pattern), repr(name_no_ext)))
+                    if not match:
+                        continue
+                    if log:
+                        log.debug('match ' + pattern)
+                    new_attributes = match.groupdict()
+                    new_attributes.update(pattern_attributes)
+                    if not ext:
+                        matched = branch_matched = True
+                        stop_parsing = single_match
+                        full_path = path + [name]
+                        if log:
+                            log.debug('directory matched: %s'
+                                      % repr(full_path))
+                        matched_directories.append(
+                            (full_path, subpattern, new_attributes))
+                    else:
+                        matched = branch_matched = True
+                        if log:
+                            log.debug('extension matched: ' + repr(ext))
+                        if not files:
+                            stop_parsing = single_match or bool(
+                                rules and rules[-1].get('fom_stop_parsing'))
+                            break
+                        for rule_attributes in rules:
+                            yield_attributes = new_attributes.copy()
+                            yield_attributes.update(rule_attributes)
+                            stop_parsing = single_match or yield_attributes.pop(
+                                'fom_stop_parsing', False)
+                            if log:
+                                log.debug(
+                                    '-> ' + '/'.join(path + [name]) + ' ' + repr(yield_attributes))
+                            matches.append((path + [name], yield_attributes))
+                        break
+                    if stop_parsing:
+                        break
+                if stop_parsing:
+                    break
+            if branch_matched and has_content:
+                recurse_parsing_list.extend(matched_directories)
+        return matches, recurse_parsing_list, matched
+
     def _parse_unknown_directory(self, dirdict, path, log):
         for name, content in six.iteritems(dirdict):
             st, content = content
@@ -1054,11 +2691,202 @@ class PathToAttributes(object):
                     yield i
 
     def parse_path(self, path, single_match=False, log=None):
-        dirdict = DirectoryAsDict.paths_to_dict(path)
+        '''Yield (path, None, attributes) for the rules matching path, as
+        :meth:`parse_directory` would for this single path. Results are
+        cached by path in parse_path_cache.
+        '''
+        if log is None and self.parse_path_cache is not None:
+            key = (path, single_match)
+            result = self.parse_path_cache.get(key)
+            if result is None:
+                result = list(self._parse_path(path, single_match, None))
+                self.parse_path_cache.put(key, result)
+            for p, s, a in result:
+                yield list(p), s, a.copy()
+            return
+        for i in self._parse_path(path, single_match, log):
+            yield i
+
+    def _parse_path(self, path, single_match, log):
+        # Walk the hierarchical patterns along the path components: parent
+        # components are only matched as directories.
         spath = split_path(path)
-        for p, s, a in self.parse_directory(dirdict, single_match=single_match, log=log):
-            if spath == p:
-                yield (p, s, a)
+        parsing_list = [([], self.hierarchical_patterns, {})]
+        for name in spath[:-1]:
+            parsing_list = self._match_name(name, parsing_list, True, True,
+                                            single_match, log,
+                                            files=False)[1]
+            if not parsing_list:
+                return
+        for p, a in self._match_name(spath[-1], parsing_list, False, False,
+                                     single_match, log)[0]:
+            yield p, None, a
+
+
+class AttributesIndex(object):
+
+    '''
+    Persistent index of the files of a directory recognized by a FOM. Each
+    ``(path, stat, attributes)`` produced by
+    :meth:`PathToAttributes.parse_directory` is stored in an sqlite database
+    with one indexed column per FOM attribute, which allows to query files by
+    attributes values without parsing the directory again.
+
+    ::
+
+        index = AttributesIndex('/tmp/study.sqlite', foms)
+        index.build('/data/study')
+        for path, st, attributes in index.find(subject='s1', fom_format='NIFTI'):
+            print(path)
+        delta = cache.refresh('/data/study')
+        index.update(delta)
+
+    Paths are stored relative to the indexed directory (with "/" separators)
+    and returned as full paths. An existing index written with another
+    format version or with other FOM attributes is emptied when it is
+    opened, and has to be built again.
+    '''
+
+    version = 1
+
+    def __init__(self, database, foms, selection=None):
+        self.database = database
+        self.path_to_attributes = PathToAttributes(foms, selection)
+        self.attributes = sorted(i for i in foms.attribute_definitions
+                                 if i != 'fom_formats')
+        self._columns = dict((i, '"_%s"' % i.replace('"', '""'))
+                             for i in self.attributes)
+        self._db = ThreadSafeSQLiteConnection(database,
+                                              check_same_thread=False)
+        db = self._db.get_connection()
+        db.execute('CREATE TABLE IF NOT EXISTS info (key PRIMARY KEY, value)')
+        attributes = json.dumps(self.attributes)
+        if self._get_info('version') != self.version \
+                or self._get_info('attributes') != attributes:
+            # the files table does not match the FOM: start from scratch
+            db.execute('DROP TABLE IF EXISTS files')
+            db.execute('DELETE FROM info')
+            db.executemany('INSERT INTO info VALUES (?, ?)',
+                           (('version', self.version),
+                            ('attributes', attributes)))
+        db.execute('CREATE TABLE IF NOT EXISTS files (_path, _st, _attributes'
+                   '%s)' % ''.join(', ' + self._columns[i]
+                                   for i in self.attributes))
+        db.execute('CREATE INDEX IF NOT EXISTS files_path_index '
+                   'ON files (_path)')
+        for i, attribute in enumerate(self.attributes):
+            db.execute('CREATE INDEX IF NOT EXISTS files_%d_index ON files '
+                       '(%s)' % (i, self._columns[attribute]))
+        db.commit()
+        self.directory = self._get_info('directory')
+
+    def close(self):
+        self._db.delete_connection()
+        self._db.close()
+
+    def _get_info(self, key):
+        row = self._db.get_connection().execute(
+            'SELECT value FROM info WHERE key = ?', (key, )).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def build(self, directory, single_match=False):
+        '''(Re)build the index with the files of directory recognized by
+        the FOM. The directory is walked with
+        :meth:`PathToAttributes.parse_live_directory`.
+        '''
+        db = self._db.get_connection()
+        with db:
+            db.execute('DELETE FROM files')
+            db.execute('INSERT OR REPLACE INTO info VALUES (?, ?)',
+                       ('directory', directory))
+            self.directory = directory
+            self._insert(db, self.path_to_attributes.parse_live_directory(
+                directory, single_match=single_match))
+
+    def update(self, delta, single_match=False):
+        '''Update the index from a :class:`DirectoryDelta` of the indexed
+        directory, as returned by :meth:`DirectoriesCache.refresh`.
+        '''
+        if self.directory is None:
+            raise RuntimeError('The index must be built before being updated')
+        if osp.abspath(delta.directory) != osp.abspath(self.directory):
+            raise ValueError('Delta of %s cannot update the index of %s'
+                             % (delta.directory, self.directory))
+        db = self._db.get_connection()
+        with db:
+            db.executemany('DELETE FROM files WHERE _path = ?',
+                           ((i, ) for i in delta.removed + delta.modified))
+            self._insert(db, self.path_to_attributes.parse_directory(
+                delta.get_directory(), single_match=single_match))
+
+    def _insert(self, db, parsing):
+        sql = 'INSERT INTO files VALUES (?, ?, ?%s)' \
+            % (', ?' * len(self.attributes))
+        attributes_list = self.attributes
+
+        def rows():
+            for path, st, attributes in parsing:
+                if attributes is None:
+                    continue
+                row = ['/'.join(path), json.dumps(st and list(st)),
+                       json.dumps(attributes)]
+                row.extend(attributes.get(i) for i in attributes_list)
+                yield row
+
+        db.executemany(sql, rows())
+
+    def _where(self, attributes):
+        conditions = []
+        values = []
+        for attribute, value in six.iteritems(attributes):
+            column = self._columns.get(attribute)
+            if column is None:
+                raise ValueError('Unknown attribute: %s' % attribute)
+            if isinstance(value, (list, tuple, set)):
+                conditions.append('%s IN (%s)'
+                                  % (column, ','.join('?' for i in value)))
+                values.extend(value)
+            elif value is None:
+                conditions.append('%s IS NULL' % column)
+            else:
+                conditions.append('%s = ?' % column)
+                values.append(value)
+        if conditions:
+            return ' WHERE ' + ' AND '.join(conditions), values
+        return '', values
+
+    def find(self, **attributes):
+        '''Yield (path, stat, attributes) for indexed files having the given
+        attributes values. A list value matches any of its values.
+        '''
+        where, values = self._where(attributes)
+        directory = self.directory
+        for path, st, file_attributes in self._db.get_connection().execute(
+                'SELECT _path, _st, _attributes FROM files%s ORDER BY rowid'
+                % where, values):
+            st = json.loads(st)
+            yield (osp.join(directory, *path.split('/')),
+                   st and tuple(st), json.loads(file_attributes))
+
+    def count(self, **attributes):
+        '''Number of indexed files having the given attributes values'''
+        where, values = self._where(attributes)
+        return self._db.get_connection().execute(
+            'SELECT COUNT(*) FROM files%s' % where, values).fetchone()[0]
+
+    def distinct_values(self, attribute, **attributes):
+        '''Sorted list of the values of an attribute among indexed files
+        having the given attributes values.
+        '''
+        column = self._columns.get(attribute)
+        if column is None:
+            raise ValueError('Unknown attribute: %s' % attribute)
+        where, values = self._where(attributes)
+        return [i[0] for i in self._db.get_connection().execute(
+            'SELECT DISTINCT %s FROM files%s ORDER BY %s'
+            % (column, where, column), values)]
 
 
 class AttributesToPaths(object):
@@ -1066,38 +2894,111 @@ class AttributesToPaths(object):
     '''
     Utility class for attributes set -> file paths transformation.
     Part of the FOM engine.
+
+    Queries of :meth:`find_paths` are cached by their shape (the given
+    attributes names and fom_format mode) in plan_cache. If
+    results_cache_size is not 0, their results are also cached by
+    attributes values in results_cache (both are :class:`LRUCache`
+    instances): this is only useful when the same requests are repeated,
+    since results are then computed in full before being cached.
+    plan_cache_size and results_cache_size set their sizes, 0 disables a
+    cache. The attributes values returned by
+    :meth:`find_attributes_values` and :meth:`find_discriminant_attributes`
+    are cached per selection in values_cache (values_cache_size).
+
+    The time spent building the rules database is stored in
+    construction_time, and passed to timing_hook(atp, seconds) when this
+    class attribute is set.
+
+    The rules database is read-only once built, so it is shared by all
+    instances built in the same thread from the same FOM files, selection
+    and preferred formats (see rules_key; FOMs are not expected to be
+    modified once loaded): it is kept in the shared_rules class
+    :class:`LRUCache`. Each thread gets its own sqlite connection, and an
+    instance, as any sqlite connection, must not be used concurrently by
+    several threads. When the rules_cache_directory class attribute is
+    set, rules databases are also written there as sqlite files, which
+    other processes open in immutable (read-only, memory mapped) mode
+    instead of building them again.
     '''
 
-    def __init__(self, foms, selection=None, directories={}, preferred_formats=set(), debug=None):
+    # called as timing_hook(atp, seconds) after each construction
+    timing_hook = None
+    # columns of the rules database which get an index
+    indexed_attributes = ('fom_parameter', 'fom_process', 'fom_format')
+    # rules databases shared between instances, None disables sharing
+    shared_rules = LRUCache(16)
+    # directory of rules database files shared between processes
+    rules_cache_directory = None
+    rules_database_version = 1
+    rules_mmap_size = 256 * 1024 * 1024
+
+    def __init__(self, foms, selection=None, directories={}, preferred_formats=set(), debug=None,
+                 plan_cache_size=128, results_cache_size=0,
+                 values_cache_size=128):
+        start_time = time.time()
         self.foms = foms
         self.selection = selection or {}
         self.directories = directories
-        self._db = sqlite3.connect(':memory:', check_same_thread=False)
-        self._db.execute('PRAGMA journal_mode = OFF;')
-        self._db.execute('PRAGMA synchronous = OFF;')
+        self.plan_cache = LRUCache(plan_cache_size) if plan_cache_size \
+            else None
+        self.results_cache = LRUCache(results_cache_size) \
+            if results_cache_size else None
+        self.values_cache = LRUCache(values_cache_size) \
+            if values_cache_size else None
         self.all_attributes = tuple(
             i for i in self.foms.attribute_definitions if i != 'fom_formats')
         self.default_values = dict(
             (i, self.foms.attribute_definitions[i]['default_value']) for i in self.all_attributes if 'default_value' in self.foms.attribute_definitions[i])
         self.non_discriminant_attributes = set(
             i for i in self.all_attributes if not self.foms.attribute_definitions[i].get('discriminant', True))
+        self.rules_key = None
+        shared = None
+        if self.shared_rules is not None or self.rules_cache_directory:
+            self.rules_key = self._rules_key(preferred_formats)
+            shared = self._get_shared_rules(self.rules_key, debug)
+        if shared is not None:
+            self.rules, self._db, self._rules_index = shared
+            row_count = None
+        else:
+            # lazily built indexes of self.rules, shared with self.rules
+            self._rules_index = {}
+            row_count = self._build_rules(preferred_formats, debug)
+            if self.rules_key is not None:
+                self._put_shared_rules(self.rules_key, debug)
+        self.construction_time = time.time() - start_time
+        if debug:
+            if row_count is None:
+                debug.debug('AttributesToPaths: %d shared rules, loaded in %f s'
+                            % (len(self.rules), self.construction_time))
+            else:
+                debug.debug('AttributesToPaths: %d rules, %d rows, built in %f s'
+                            % (len(self.rules), row_count,
+                               self.construction_time))
+        # read on the class so that a plain function set as class attribute
+        # is not bound to the instance
+        timing_hook = type(self).timing_hook
+        if timing_hook is not None:
+            timing_hook(self, self.construction_time)
+
+    def _build_rules(self, preferred_formats, debug):
+        '''Build self.rules and the rules database, return the number of
+        inserted rows.
+        '''
+        self._db = sqlite3.connect(':memory:', check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode = OFF;')
+        self._db.execute('PRAGMA synchronous = OFF;')
         fom_format_index = self.all_attributes.index('fom_format')
         sql = 'CREATE TABLE rules ( %s, _fom_first, _fom_preferred_format, _fom_rule )' % ','.join(repr('_' + str(i))
                                 for i in self.all_attributes)
         if debug:
             debug.debug(sql)
         self._db.execute(sql)
-        columns = ['_%s' %
-                   i for i in self.all_attributes + ('fom_first', 'fom_preferred_format')]
-        sql = 'CREATE INDEX rules_index ON rules (%s)' % ','.join(columns)
-        self._db.execute(sql)
-        for i in columns:
-            sql = 'CREATE INDEX rules%s_index ON rules (%s)' % (i, i)
-            self._db.execute(sql)
         sql_insert = 'INSERT INTO rules VALUES ( %s )' % ','.join(
             '?' for i in xrange(len(self.all_attributes) + 3))
         self.rules = []
-        for pattern, rule_attributes in foms.selected_rules(self.selection, debug=debug):
+        rows = []
+        for pattern, rule_attributes in self.foms.selected_rules(self.selection, debug=debug):
             if debug:
                 debug.debug(
                     'pattern: ' + pattern + ' ' + repr(rule_attributes))
@@ -1123,20 +3024,146 @@ class AttributesToPaths(object):
                         break
                 else:
                     preferred_format = fom_formats[0]
-                sys.stdout.flush()
                 for format in fom_formats:
                     values[fom_format_index] = format
                     values[-3] = first
                     values[-2] = bool(format == preferred_format)
                     first = False
-                    if debug:
-                        debug.debug(sql_insert + ' ' + repr(values))
-                    self._db.execute(sql_insert, values)
+                    rows.append(list(values))
             else:
-                if debug:
-                    debug.debug(sql_insert + ' ' + repr(values))
-                self._db.execute(sql_insert, values)
+                rows.append(values)
+        if debug:
+            for values in rows:
+                debug.debug(sql_insert + ' ' + repr(values))
+        with self._db:
+            self._db.executemany(sql_insert, rows)
+        # Indexes are created after the bulk insertion. Only the columns
+        # whose values are given in almost every find_paths request are
+        # indexed: other conditions are not selective enough for sqlite to
+        # use an index.
+        for attribute in self.indexed_attributes:
+            if attribute in self.all_attributes:
+                self._db.execute('CREATE INDEX rules_%s_index ON rules (_%s)'
+                                 % (attribute, attribute))
+        self._db.execute('ANALYZE')
         self._db.commit()
+        return len(rows)
+
+    def _rules_key(self, preferred_formats):
+        '''Fingerprint of everything the rules database depends on, stable
+        across processes: the FOM files (path, mtime and size), selection
+        and preferred formats. FOMs which were (also) imported from dicts
+        are fingerprinted by their content (rules, formats and attributes
+        definitions), which is much slower to compute.
+        '''
+        def default(value):
+            if isinstance(value, (set, frozenset)):
+                return sorted(value, key=repr)
+            return repr(value)
+
+        if self.foms.source_files and not self.foms.imported_dicts:
+            files = []
+            for path in self.foms.source_files:
+                st = os.stat(path)
+                files.append((osp.abspath(path), st.st_mtime, st.st_size))
+            foms = [self.foms.fom_names, files]
+        else:
+            foms = [self.foms.fom_names, self.foms.rules, self.foms.formats,
+                    self.foms.format_lists, self.foms.attribute_definitions]
+        content = json.dumps(
+            [self.rules_database_version, foms, self.selection,
+             sorted(preferred_formats)],
+            sort_keys=True, default=default)
+        return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+    def _rules_file(self, key):
+        return osp.join(self.rules_cache_directory, 'rules-%s.sqlite' % key)
+
+    def _get_shared_rules(self, key, debug):
+        '''Return (rules, database, rules index) from the shared caches, or
+        None.
+        '''
+        if self.shared_rules is not None:
+            shared = self.shared_rules.get(self._shared_rules_key(key))
+            if shared is not None:
+                return shared
+        if not self.rules_cache_directory:
+            return None
+        rules_file = self._rules_file(key)
+        if not osp.exists(rules_file):
+            return None
+        try:
+            db = sqlite3.connect('file:%s?immutable=1' % pathname2url(rules_file),
+                                 uri=True, check_same_thread=False)
+            db.execute('PRAGMA mmap_size = %d' % self.rules_mmap_size)
+            rules = [(pattern, json.loads(attributes)) for pattern, attributes
+                     in db.execute('SELECT pattern, attributes FROM fom_rules '
+                                   'ORDER BY rule')]
+        except (TypeError, ValueError, sqlite3.Error) as e:
+            # TypeError: no uri support (Python 2)
+            if debug:
+                debug.debug('AttributesToPaths: cannot read %s: %s'
+                            % (rules_file, e))
+            return None
+        if debug:
+            debug.debug('AttributesToPaths: rules read from %s' % rules_file)
+        rules_index = {}
+        if self.shared_rules is not None:
+            self.shared_rules.put(self._shared_rules_key(key),
+                                  (rules, db, rules_index))
+        return rules, db, rules_index
+
+    @staticmethod
+    def _shared_rules_key(key):
+        # An sqlite connection must not be used across a fork, nor
+        # concurrently by several threads: each thread of each process gets
+        # its own connection.
+        return (key, os.getpid(), threading.current_thread().ident)
+
+    def _put_shared_rules(self, key, debug):
+        if self.shared_rules is not None:
+            self.shared_rules.put(self._shared_rules_key(key),
+                                  (self.rules, self._db, self._rules_index))
+        if not self.rules_cache_directory:
+            return
+        rules_file = self._rules_file(key)
+        if osp.exists(rules_file):
+            return
+        tmp = None
+        try:
+            rules = [(i, pattern, json.dumps(attributes))
+                     for i, (pattern, attributes) in enumerate(self.rules)]
+            if not osp.isdir(self.rules_cache_directory):
+                os.makedirs(self.rules_cache_directory)
+            fd, tmp = tempfile.mkstemp(dir=self.rules_cache_directory,
+                                       suffix='.tmp')
+            os.close(fd)
+            db = sqlite3.connect(tmp)
+            try:
+                self._db.backup(db)
+                db.execute('CREATE TABLE fom_rules '
+                           '( rule INTEGER PRIMARY KEY, pattern, attributes )')
+                with db:
+                    db.executemany('INSERT INTO fom_rules VALUES ( ?, ?, ? )',
+                                   rules)
+            finally:
+                db.close()
+            # atomic: concurrent readers either see no file or a complete one
+            replace_file(tmp, rules_file)
+            tmp = None
+            if debug:
+                debug.debug('AttributesToPaths: rules written to %s'
+                            % rules_file)
+        except (AttributeError, TypeError, ValueError, EnvironmentError,
+                sqlite3.Error) as e:
+            # AttributeError: no backup API (Python < 3.7), TypeError /
+            # ValueError: rule attributes not JSON serializable
+            if debug:
+                debug.debug('AttributesToPaths: cannot write %s: %s'
+                            % (rules_file, e))
+        finally:
+            if tmp is not None and osp.exists(tmp):
+                os.remove(tmp)
 
     def find_paths(self, attributes={}, debug=None):
         if debug:
@@ -1144,127 +3171,528 @@ class AttributesToPaths(object):
         d = self.selection.copy()
         d.update(attributes)
         attributes = d
-        select = []
+        if debug is None and self.results_cache is not None:
+            key = self._results_key(attributes)
+            if key is not None:
+                results = self.results_cache.get(key)
+                if results is not None:
+                    for path, path_attributes in results:
+                        yield path, copy.deepcopy(path_attributes)
+                    return
+                # results are cached only if the iteration is complete, and
+                # the caller gets its own copy of each attributes dict
+                results = []
+                for path, path_attributes in self._find_paths(attributes,
+                                                              None):
+                    results.append((path, copy.deepcopy(path_attributes)))
+                    yield path, path_attributes
+                self.results_cache.put(key, results)
+                return
+        for r in self._find_paths(attributes, debug):
+            yield r
+
+    def _find_paths(self, attributes, debug):
+        sql, bound, default_values = self._plan(attributes)
         values = []
-        selection_attributes = {}
+        for attribute, kind in bound:
+            value = attributes[attribute]
+            if kind in ('list', 'format_list'):
+                values.extend(value)
+            else:
+                values.append(value)
+        selection_attributes = self._selection_attributes(attributes, bound)
+        if debug:
+            debug.debug('!sql! %s' %
+                        (sql.replace('?', '%s') % tuple(repr(i) for i in values)))
+        for row in self._db.execute(sql, values):
+            for r in self._row_paths(row, default_values, attributes,
+                                     selection_attributes, debug):
+                yield r
+
+    def _plan(self, attributes):
+        '''Return (sql, bound, default_values) for a find_paths request,
+        using plan_cache. See :meth:`_query_plan` for bound and
+        default_values.
+        '''
+        if self.plan_cache is not None:
+            fom_format = attributes.get('fom_format')
+            if fom_format not in ('fom_first', 'fom_preferred'):
+                fom_format = None
+            key = (frozenset((name, len(value))
+                             if isinstance(value, list) else name
+                             for name, value in six.iteritems(attributes)
+                             if value is not None), fom_format)
+            plan = self.plan_cache.get(key)
+            if plan is not None:
+                return plan
+        conditions, bound, default_values = self._query_plan(attributes)
+        select = list(conditions)
+        for attribute, kind in bound:
+            select.append(self._bound_condition(attribute, kind,
+                                                attributes[attribute]))
+        columns = ['_fom_rule', '_fom_format'] + ['_' + i[0]
+                                                  for i in default_values]
+        plan = (self._select_sql(columns, select), bound, default_values)
+        if self.plan_cache is not None:
+            self.plan_cache.put(key, plan)
+        return plan
+
+    def _results_key(self, attributes):
+        '''Key of a request in results_cache, or None if some values cannot
+        be used in a key.
+        '''
+        try:
+            key = (tuple(sorted((name, tuple(value)
+                                 if isinstance(value, list) else value)
+                                for name, value in six.iteritems(attributes))),
+                   tuple(sorted(six.iteritems(self.directories))))
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def find_paths_batch(self, attributes_list, debug=None):
+        '''Find paths for a sequence of attributes dicts, as
+        :meth:`find_paths` would for each of them, and yield
+        ``(index, path, attributes)`` where index is the position of the
+        attributes dict in attributes_list.
+
+        Requests are grouped according to the shape of their query (which
+        attributes are given, as single values or lists, and the fom_format
+        mode). Each group runs a single query on the rules database, whose
+        rows are then filtered for each request with its own values. Results
+        are yielded group by group, in the order of find_paths within each
+        request.
+        '''
+        groups = OrderedDict()
+        for index, attributes in enumerate(attributes_list):
+            d = self.selection.copy()
+            d.update(attributes)
+            conditions, bound, default_values = self._query_plan(d)
+            key = (tuple(conditions), tuple(bound))
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = (conditions, bound, default_values, [])
+            group[3].append((index, d))
+        for conditions, bound, default_values, requests in \
+                six.itervalues(groups):
+            columns = ['_fom_rule', '_fom_format'] + \
+                ['_' + i[0] for i in default_values] + \
+                ['_' + i[0] for i in bound]
+            sql = self._select_sql(columns, conditions)
+            if debug:
+                debug.debug('!batch sql! %s (%d requests)'
+                            % (sql, len(requests)))
+            rows = list(self._db.execute(sql))
+            first_bound = 2 + len(default_values)
+            # attributes whose column only contains '' accept any value
+            checks = []
+            for i, (attribute, kind) in enumerate(bound):
+                column = first_bound + i
+                if kind in ('value', 'list') \
+                        and all(row[column] == '' for row in rows):
+                    continue
+                checks.append((attribute, kind, column))
+            selected_rows_cache = {}
+            for index, attributes in requests:
+                key = tuple(
+                    tuple(attributes[attribute])
+                    if kind in ('list', 'format_list')
+                    else attributes[attribute]
+                    for attribute, kind, column in checks)
+                selected_rows = selected_rows_cache.get(key)
+                if selected_rows is None:
+                    selected_rows = [
+                        row[:first_bound] for row in rows
+                        if self._check_row(row, checks, attributes)]
+                    selected_rows_cache[key] = selected_rows
+                selection_attributes = self._selection_attributes(
+                    attributes, bound)
+                for row in selected_rows:
+                    for path, path_attributes in self._row_paths(
+                            row, default_values, attributes,
+                            selection_attributes, debug):
+                        yield index, path, path_attributes
+
+    @staticmethod
+    def _listing_cache(listing):
+        if isinstance(listing, DirectoryListingCache):
+            return listing
+        return DirectoryListingCache(listing)
+
+    def find_existing_paths(self, attributes={}, listing=None, first=False,
+                            debug=None):
+        '''Yield the (path, attributes) of :meth:`find_paths` whose path
+        exists, or only the first one if first is True.
+
+        Existence is checked with listing: a :class:`DirectoryListingCache`,
+        a :class:`DirectoriesCache` snapshot, or None to list directories on
+        the file system. Each directory is listed at most once by a
+        DirectoryListingCache, which can be reused between calls.
+        '''
+        listing = self._listing_cache(listing)
+        for path, path_attributes in self.find_paths(attributes, debug=debug):
+            if listing.exists(path):
+                yield path, path_attributes
+                if first:
+                    return
+
+    def find_first_existing_path(self, attributes={}, listing=None,
+                                 debug=None):
+        '''Return the (path, attributes) of the first existing path of
+        :meth:`find_paths` (see :meth:`find_existing_paths`), or None.
+        '''
+        for result in self.find_existing_paths(attributes, listing,
+                                               first=True, debug=debug):
+            return result
+        return None
+
+    def find_existing_paths_batch(self, attributes_list, listing=None,
+                                  first=False, debug=None):
+        '''Same as :meth:`find_paths_batch` for the existing paths (see
+        :meth:`find_existing_paths`). A single listing cache is used for
+        the whole batch.
+        '''
+        listing = self._listing_cache(listing)
+        found = set()
+        for index, path, path_attributes in self.find_paths_batch(
+                attributes_list, debug=debug):
+            if first and index in found:
+                continue
+            if listing.exists(path):
+                found.add(index)
+                yield index, path, path_attributes
+
+    def find_paths_columns(self, attributes={}, columns={}, debug=None):
+        '''Find paths for many requests differing only by the values of a
+        few attributes, given as columns: a dict of attribute name -> list or
+        NumPy array of values (of the same length). Row i of columns,
+        together with attributes, is a :meth:`find_paths` request.
+
+        Yield (rows, paths, attributes) for each matching rule and format,
+        in :meth:`find_paths` order. rows is a NumPy array of the indices of
+        the matching rows, paths a NumPy array of their paths, and attributes
+        the dict of attributes shared by these paths (columns attributes are
+        not included).
+
+        Rule patterns are turned into templates once, and paths are rendered
+        for whole columns at once.
+        '''
+        import numpy
+
+        values = {}
+        size = None
+        for attribute, column in six.iteritems(columns):
+            if attribute == 'fom_format':
+                raise ValueError('fom_format cannot be given as a column')
+            if isinstance(column, numpy.ndarray):
+                column = column.tolist()
+            else:
+                column = list(column)
+            if six.PY3:
+                # values of 'S' arrays are bytes
+                column = [i.decode('utf-8') if isinstance(i, bytes) else i
+                          for i in column]
+            if size is None:
+                size = len(column)
+            elif len(column) != size:
+                raise ValueError('columns must have the same length')
+            values[attribute] = column
+        if size is None:
+            raise ValueError('at least one column must be given')
+        d = self.selection.copy()
+        d.update(attributes)
+        # columns attributes are bound as values (with a dummy one) so that
+        # their rules values are selected and checked for each row
+        for attribute in values:
+            d[attribute] = ''
+        conditions, bound, default_values = self._query_plan(d)
+        sql_columns = ['_fom_rule', '_fom_format'] + \
+            ['_' + i[0] for i in default_values] + \
+            ['_' + i[0] for i in bound]
+        sql = self._select_sql(sql_columns, conditions)
+        if debug:
+            debug.debug('!columns sql! %s (%d rows)' % (sql, size))
+        first_bound = 2 + len(default_values)
+        checks = []
+        column_checks = []
+        for i, (attribute, kind) in enumerate(bound):
+            if attribute in values:
+                column_checks.append((attribute, first_bound + i))
+            else:
+                checks.append((attribute, kind, first_bound + i))
+        selection_attributes = self._selection_attributes(
+            d, [i for i in bound if i[0] not in values])
+        # values which cannot be joined as a simple string concatenation
+        safe_columns = set(
+            attribute for attribute, column in six.iteritems(values)
+            if all(isinstance(i, six.string_types) and i and '/' not in i
+                   for i in column))
+        all_rows = list(xrange(size))
+        for row in self._db.execute(sql):
+            if not self._check_row(row, checks, d):
+                continue
+            rows = all_rows
+            for attribute, column in column_checks:
+                rule_value = row[column]
+                if rule_value == '':
+                    continue
+                if rule_value is None:
+                    rows = []
+                    break
+                column_values = values[attribute]
+                rows = [i for i in rows if column_values[i] == rule_value]
+            if not rows:
+                continue
+            for paths, path_attributes in self._column_paths(
+                    row[:first_bound], default_values, d,
+                    selection_attributes, rows, values, safe_columns,
+                    debug):
+                yield (numpy.array(rows, dtype=numpy.intp),
+                       numpy.array(paths, dtype=object), path_attributes)
+
+    def _rule_template(self, rule_index):
+        '''Split a rule pattern into literal text and attributes slots:
+        return a list alternating literal parts (in % format syntax) and
+        attributes names.
+        '''
+        templates = self._rules_index.setdefault('templates', {})
+        template = templates.get(rule_index)
+        if template is None:
+            template = templates[rule_index] = re.split(
+                r'%\(([^)]+)\)s', self.rules[rule_index][0])
+        return template
+
+    def _column_paths(self, row, default_values, attributes,
+                      selection_attributes, rows, values, safe_columns,
+                      debug):
+        '''Yield (paths, attributes) for a row of a find_paths_columns
+        query, as :meth:`_row_paths` does for a single request.
+        '''
+        rule_index, format = row[:2]
+        row = row[2:]
+        rule_attributes = self.rules[rule_index][1].copy()
+        default_attributes = {}
+        for i in range(len(default_values)):
+            if not row[i]:
+                rule_attributes[
+                    default_values[i][0]] = default_values[i][1]
+                default_attributes[
+                    default_values[i][0]] = default_values[i][1]
+        fom_formats = rule_attributes.pop('fom_formats', [])
+        default_attributes.update(attributes)
+        template = self._rule_template(rule_index)
+        # % format with the slots of columns left as %s
+        format_string = [template[0]]
+        slots = []
+        for i in xrange(1, len(template), 2):
+            attribute = template[i]
+            if attribute in values:
+                format_string.append('%s')
+                slots.append(attribute)
+            else:
+                try:
+                    value = default_attributes[attribute]
+                except KeyError:
+                    return
+                format_string.append(
+                    ('%s' % (value, )).replace('%', '%%'))
+            format_string.append(template[i + 1])
+        format_string = ''.join(format_string)
+        columns = [values[attribute] for attribute in slots]
+        if columns and len(rows) != len(columns[0]):
+            columns = [[column[i] for i in rows] for column in columns]
+        fom_directory = rule_attributes.get('fom_directory')
+        directory = None
+        if fom_directory:
+            directory = self.directories.get(fom_directory)
+        if format:
+            formats = [format]
+        elif fom_formats:
+            formats = fom_formats
+        else:
+            formats = [None]
+        for f in formats:
+            path_format = format_string
+            if f is not None:
+                ext = self.foms.formats[f]
+                if ext != '':
+                    path_format += ('.' + ext).replace('%', '%%')
+                rule_attributes['fom_format'] = f
+            sample = path_format % (('x', ) * len(slots))
+            if os.sep == '/' and safe_columns.issuperset(slots) \
+                    and '//' not in sample and not sample.startswith('/') \
+                    and not sample.endswith('/'):
+                # path.split('/') + osp.join are a simple concatenation
+                if directory:
+                    if not directory.endswith('/'):
+                        directory += '/'
+                    path_format = directory.replace('%', '%%') + path_format
+                paths = self._render(path_format, columns, len(rows))
+            else:
+                paths = self._render(path_format, columns, len(rows))
+                paths = [osp.join(directory, *i.split('/')) if directory
+                         else osp.join(*i.split('/')) for i in paths]
+            if debug:
+                debug.debug('!columns format! %s: %s (%d paths)'
+                            % (f, path_format, len(paths)))
+            path_attributes = selection_attributes.copy()
+            path_attributes.update(rule_attributes)
+            yield paths, path_attributes
+
+    @staticmethod
+    def _render(path_format, columns, size):
+        if not columns:
+            return [path_format % ()] * size
+        if len(columns) == 1:
+            return [path_format % (i, ) for i in columns[0]]
+        return [path_format % i for i in zip(*columns)]
+
+    def _query_plan(self, attributes):
+        '''Analyse the attributes of a find_paths request and return
+        (conditions, bound, default_values).
+
+        conditions are SQL conditions which do not depend on attributes
+        values. bound is a list of (attribute, kind) for attributes whose
+        value must be matched by the rules: kind is "value" or "list" for
+        discriminant attributes (they match the given value(s) or an empty
+        rule value), "format" or "format_list" for fom_format. default_values
+        is a list of (attribute, default_value) for attributes without value.
+        '''
+        conditions = []
+        bound = []
         default_values = []
         for attribute in self.all_attributes:
             value = attributes.get(attribute)
-            if value is None:
-                value = self.selection.get(attribute)
             if value is None:
                 default_value = self.default_values.get(attribute)
                 if default_value is not None:
                     default_values.append((attribute, default_value))
                     if attribute not in self.non_discriminant_attributes:
-                        select.append(
+                        conditions.append(
                             '(_' + attribute + " IN ('','%s') OR _" % default_value + attribute + ' IS NULL )')
                 else:
                     if attribute not in self.non_discriminant_attributes:
-                        select.append(
+                        conditions.append(
                             '(_' + attribute + " != '' OR _" + attribute + ' IS NULL )')
             elif attribute == 'fom_format':
-                selected_format = attributes.get('fom_format')
-                if selected_format == 'fom_first':
-                    select.append('_fom_first = 1')
-                elif selected_format == 'fom_preferred':
-                    select.append('_fom_preferred_format = 1')
+                if value == 'fom_first':
+                    conditions.append('_fom_first = 1')
+                elif value == 'fom_preferred':
+                    conditions.append('_fom_preferred_format = 1')
                 elif isinstance(value, list):
-                    select.append('_' + attribute + " IN (%s)" %
-                                  ','.join('?' for i in value))
-                    values.extend(value)
+                    bound.append((attribute, 'format_list'))
                 else:
-                    select.append('_' + attribute + " = ?")
-                    values.append(value)
-            elif isinstance(value, list):
-                if attribute not in self.non_discriminant_attributes:
-                    select.append('_' + attribute + " IN ( %s, '' )" %
-                                  ','.join('?' for i in value))
-                    values.extend(value)
-            else:
-                if attribute not in self.non_discriminant_attributes:
-                    select.append('_' + attribute + " IN ( ?, '' )")
-                    values.append(value)
-                    selection_attributes[attribute] = value
-        columns = ['_fom_rule', '_fom_format'] + ['_' + i[0]
-                                                  for i in default_values]
-        sql = 'SELECT %s FROM rules WHERE %s' % (','.join(columns), ' AND '.join(
-            select))
-        if debug:
-            debug.debug('!sql! %s' %
-                        (sql.replace('?', '%s') % tuple(repr(i) for i in values)))
-        for row in self._db.execute(sql, values):
-            rule_index, format = row[:2]
-            row = row[2:]
-            # bool_output = False
-            rule, rule_attributes = self.rules[rule_index]
-            rule_attributes = rule_attributes.copy()
-            default_attributes = {}
-            for i in range(len(default_values)):
-                if not row[i]:
-                    rule_attributes[
-                        default_values[i][0]] = default_values[i][1]
-                    default_attributes[
-                        default_values[i][0]] = default_values[i][1]
-            # rule_attributes = self.foms.rules[ rule_index ][ 1 ].copy()
-            fom_formats = rule_attributes.pop('fom_formats', [])
-
-            # if rule_attributes.get( 'fom_directory' ) == 'output':
-                # bool_output=True
+                    bound.append((attribute, 'format'))
+            elif attribute not in self.non_discriminant_attributes:
+                if isinstance(value, list):
+                    bound.append((attribute, 'list'))
+                else:
+                    bound.append((attribute, 'value'))
+        return conditions, bound, default_values
 
+    @staticmethod
+    def _bound_condition(attribute, kind, value):
+        if kind == 'value':
+            return '_' + attribute + " IN ( ?, '' )"
+        elif kind == 'list':
+            return '_' + attribute + " IN ( %s, '' )" % \
+                ','.join('?' for i in value)
+        elif kind == 'format':
+            return '_' + attribute + " = ?"
+        return '_' + attribute + " IN (%s)" % ','.join('?' for i in value)
+
+    @staticmethod
+    def _check_row(row, checks, attributes):
+        '''Python equivalent of the SQL conditions of bound attributes'''
+        for attribute, kind, column in checks:
+            rule_value = row[column]
+            value = attributes[attribute]
+            if kind == 'value':
+                if rule_value != value and rule_value != '':
+                    return False
+            elif kind == 'list':
+                if rule_value is None or (rule_value not in value
+                                          and rule_value != ''):
+                    return False
+            elif kind == 'format':
+                if rule_value != value:
+                    return False
+            elif rule_value is None or rule_value not in value:
+                return False
+        return True
+
+    @staticmethod
+    def _selection_attributes(attributes, bound):
+        return dict((attribute, attributes[attribute])
+                    for attribute, kind in bound if kind == 'value')
+
+    @staticmethod
+    def _select_sql(columns, conditions):
+        sql = 'SELECT %s FROM rules' % ','.join(columns)
+        if conditions:
+            sql += ' WHERE %s' % ' AND '.join(conditions)
+        return sql + ' ORDER BY rowid'
+
+    def _row_paths(self, row, default_values, attributes,
+                   selection_attributes, debug):
+        '''Yield (path, attributes) for a row of a find_paths query'''
+        rule_index, format = row[:2]
+        row = row[2:]
+        # bool_output = False
+        rule, rule_attributes = self.rules[rule_index]
+        rule_attributes = rule_attributes.copy()
+        default_attributes = {}
+        for i in range(len(default_values)):
+            if not row[i]:
+                rule_attributes[
+                    default_values[i][0]] = default_values[i][1]
+                default_attributes[
+                    default_values[i][0]] = default_values[i][1]
+        # rule_attributes = self.foms.rules[ rule_index ][ 1 ].copy()
+        fom_formats = rule_attributes.pop('fom_formats', [])
+
+        # if rule_attributes.get( 'fom_directory' ) == 'output':
+            # bool_output=True
+
+        if debug:
+            debug.debug('!rule matching! %s' %
+                        repr((rule, fom_formats, rule_attributes)))
+        if format:
+            ext = self.foms.formats[format]
+            if ext != '':
+                ext = '.' + ext
+            rule_attributes['fom_format'] = format
+            default_attributes.update(attributes)
+            try:
+                path = rule % default_attributes + ext
+            except KeyError:
+                return
             if debug:
-                debug.debug('!rule matching! %s' %
-                            repr((rule, fom_formats, rule_attributes)))
-            if format:
-                ext = self.foms.formats[format]
-                if ext != '':
-                    ext = '.' + ext
-                rule_attributes['fom_format'] = format
-                default_attributes.update(attributes)
-                try:
-                    path = rule % default_attributes + ext
-                except KeyError:
-                    continue
+                debug.debug('!single format! %s: %s' % (
+                    format, path))
+            r = self._join_directory(
+                path, rule_attributes,
+                selection_attributes)
+            if r:
                 if debug:
-                    debug.debug('!single format! %s: %s' % (
-                        format, path))
-                r = self._join_directory(
-                    path, rule_attributes,
-                    selection_attributes)
-                if r:
-                    if debug:
-                        debug.debug('!-->! %s' % repr(r))
-                    yield r
-            else:
-                if fom_formats:
-                    for f in fom_formats:
-                        ext = self.foms.formats[f]
-                        if ext != '':
-                            ext = '.' + ext
-                        rule_attributes['fom_format'] = f
-                        default_attributes.update(attributes)
-                        try:
-                            path = rule % default_attributes + ext
-                        except KeyError:
-                            continue
-                        if debug:
-                            debug.debug('!format from fom_formats! %s: %s' %
-                                        (f, path))
-                        r = self._join_directory(
-                            path, rule_attributes,
-                            selection_attributes)
-                        if r:
-                            if debug:
-                                debug.debug('!-->! %s' % repr(r))
-                            yield r
-                else:
+                    debug.debug('!-->! %s' % repr(r))
+                yield r
+        else:
+            if fom_formats:
+                for f in fom_formats:
+                    ext = self.foms.formats[f]
+                    if ext != '':
+                        ext = '.' + ext
+                    rule_attributes['fom_format'] = f
                     default_attributes.update(attributes)
                     try:
-                        path = rule % default_attributes
+                        path = rule % default_attributes + ext
                     except KeyError:
                         continue
                     if debug:
-                        debug.debug('!no format! %s' % path)
+                        debug.debug('!format from fom_formats! %s: %s' %
+                                    (f, path))
                     r = self._join_directory(
                         path, rule_attributes,
                         selection_attributes)
@@ -1272,19 +3700,27 @@ class AttributesToPaths(object):
                         if debug:
                             debug.debug('!-->! %s' % repr(r))
                         yield r
+            else:
+                default_attributes.update(attributes)
+                try:
+                    path = rule % default_attributes
+                except KeyError:
+                    return
+                if debug:
+                    debug.debug('!no format! %s' % path)
+                r = self._join_directory(
+                    path, rule_attributes,
+                    selection_attributes)
+                if r:
+                    if debug:
+                        debug.debug('!-->! %s' % repr(r))
+                    yield r
 
     def find_discriminant_attributes(self, **selection):
         result = []
         if self.rules:
-            for attribute in self.all_attributes:
-                sql = 'SELECT DISTINCT "%s" FROM rules' % ('_' + attribute)
-                if selection:
-                    sql += ' WHERE ' + \
-                        ' AND '.join('_' + i + ' = ?' for i in selection)
-                    values = list(self._db.execute(sql,
-                                                   list(selection.values())))
-                else:
-                    values = list(self._db.execute(sql))
+            for attribute, values in zip(self.all_attributes,
+                                         self._attributes_values(selection)):
                 if values and (len(values) > 1 or ('',) in values):
                     result.append(attribute)
         return result
@@ -1292,16 +3728,37 @@ class AttributesToPaths(object):
     def find_attributes_values(self, **selection):
         result = {}
         if self.rules:
-            for attribute in self.all_attributes:
-                sql = 'SELECT DISTINCT "%s" FROM rules' % ('_' + attribute)
-                if selection:
-                    sql += ' WHERE ' + \
-                        ' AND '.join('_' + i + ' = ?' for i in selection)
-                    values = list(self._db.execute(sql,
-                                                   list(selection.values())))
-                else:
-                    values = list(self._db.execute(sql))
-                result[attribute] = values
+            for attribute, values in zip(self.all_attributes,
+                                         self._attributes_values(selection)):
+                result[attribute] = list(values)
+        return result
+
+    def _attributes_values(self, selection):
+        '''Distinct values (as 1-tuples, in rules order) of every attribute
+        among the rules matching selection. They are computed in a single
+        scan of the rules table and cached per selection in values_cache.
+        '''
+        try:
+            key = tuple(sorted(selection.items()))
+            hash(key)
+        except TypeError:
+            key = None
+        if key is not None and self.values_cache is not None:
+            result = self.values_cache.get(key)
+            if result is not None:
+                return result
+        sql = 'SELECT DISTINCT %s FROM rules' % ','.join(
+            '"_%s"' % i for i in self.all_attributes)
+        if selection:
+            sql += ' WHERE ' + \
+                ' AND '.join('_' + i + ' = ?' for i in selection)
+        distinct = [OrderedDict() for i in self.all_attributes]
+        for row in self._db.execute(sql, list(selection.values())):
+            for value, values in zip(row, distinct):
+                values[(value,)] = None
+        result = tuple(tuple(values) for values in distinct)
+        if key is not None and self.values_cache is not None:
+            self.values_cache.put(key, result)
         return result
 
     def _join_directory(self, path, rule_attributes, selection_attributes):
@@ -1317,15 +3774,8 @@ class AttributesToPaths(object):
         #return (path, attributes)
 
     def allowed_formats_for_parameter(self, process_name, param):
-        formats = []
-        for rule, attributes in self.rules:
-            if attributes.get('fom_process') == process_name \
-                    and attributes.get('fom_parameter') == param:
-                rformats = attributes.get('fom_formats', [])
-                for format in rformats:
-                    if format not in formats:
-                        formats.append(format)
-        return formats
+        formats = self._formats_index().get((process_name, param))
+        return list(formats) if formats else []
 
     def allowed_extensions_for_parameter(self, **kwargs):
         '''
@@ -1340,25 +3790,61 @@ class AttributesToPaths(object):
             name of the process parameter
         '''
         if 'formats' in kwargs:
-            formats = list(kwargs['formats'])
+            exts = set()
+            for format in kwargs['formats']:
+                exts.update(self._format_extensions(format))
+            return sorted(exts)
         elif 'process_name' in kwargs and 'param' in kwargs:
-            process_name = kwargs['process_name']
-            param = kwargs['param']
-            formats = self.allowed_formats_for_parameter(process_name, param)
+            key = (kwargs['process_name'], kwargs['param'])
+            index = self._rules_index.setdefault('parameter_extensions', {})
+            exts = index.get(key)
+            if exts is None:
+                exts = set()
+                for format in self._formats_index().get(key, ()):
+                    exts.update(self._format_extensions(format))
+                exts = index[key] = sorted(exts)
+            return list(exts)
         else:
             raise KeyError('Either formats or (process_name and param) should '
                            'be passed')
-        exts = set()
-        while formats:
-            format = formats.pop(0)
-            if format not in self.foms.formats \
-                    and format in self.foms.format_lists:
-                formats += self.foms.format_lists[format]
-                continue
-            exts.add(self.foms.formats[format])
-
-        return sorted(exts)
 
+    def _formats_index(self):
+        '''Index of the formats of self.rules: (process, parameter) -> list
+        of formats, in rules order.
+        '''
+        index = self._rules_index.get('formats')
+        if index is None:
+            index = {}
+            for rule, attributes in self.rules:
+                formats = index.setdefault((attributes.get('fom_process'),
+                                            attributes.get('fom_parameter')),
+                                           [])
+                for format in attributes.get('fom_formats', []):
+                    if format not in formats:
+                        formats.append(format)
+            self._rules_index['formats'] = index
+        return index
+
+    def _format_extensions(self, format):
+        '''Extensions of a format or, recursively, of a format list.'''
+        index = self._rules_index.setdefault('extensions', {})
+        exts = index.get(format)
+        if exts is None:
+            exts = set()
+            formats = [format]
+            done = set()
+            while formats:
+                format_name = formats.pop(0)
+                if format_name in done:
+                    continue
+                done.add(format_name)
+                if format_name not in self.foms.formats \
+                        and format_name in self.foms.format_lists:
+                    formats += self.foms.format_lists[format_name]
+                    continue
+                exts.add(self.foms.formats[format_name])
+            exts = index[format] = frozenset(exts)
+        return exts
 
 
 def call_before_application_initialization(application):
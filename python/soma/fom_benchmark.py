@@ -0,0 +1,391 @@
+# -*- coding: utf-8 -*-
+
+'''
+Benchmarks of the File Organization Model engine (:mod:`soma.fom`) on
+synthetic FOMs and synthetic directory trees.
+
+A synthetic FOM is made of rules_count rules (one file parameter per rule,
+grouped in processes), whose patterns use shared_depth levels of directories
+built from a chain of shared patterns, and a file name using one of the
+remaining attributes. Rules use either a single format or a format list. A
+synthetic directory tree (a :meth:`DirectoryAsDict.paths_to_dict
+<soma.fom.DirectoryAsDict.paths_to_dict>` dict) contains files matching
+these rules.
+
+The benchmark times the main steps of the FOM engine and reports, for each
+one, the duration, the throughput and optionally the peak of allocated
+memory, as a JSON document::
+
+    python -m soma.fom_benchmark --rules 1000 --entries 1000000 \\
+        --memory --output fom_benchmark.json
+'''
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import sys
+import os
+import os.path as osp
+import json
+import time
+import random
+import shutil
+import tempfile
+import itertools
+import platform
+
+from soma import fom
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+try:
+    import resource
+except ImportError:
+    resource = None
+
+timer = getattr(time, 'perf_counter', time.time)
+
+
+def synthetic_fom(attributes_count=10, rules_count=1000, parameters_count=20,
+                  formats_count=4, format_lists_count=2, shared_depth=3,
+                  name='synthetic_fom'):
+    '''Return the definition (as loaded from a JSON file) of a synthetic FOM.
+    Attributes are named a0, a1... The shared_depth first ones are used in
+    directory levels, the others in file names.
+    '''
+    if attributes_count <= shared_depth:
+        raise ValueError('attributes_count must be greater than shared_depth')
+    formats = dict(('F%d' % i, 'e%d' % i) for i in range(formats_count))
+    format_lists = dict(
+        ('L%d' % i, ['F%d' % ((i + j) % formats_count)
+                     for j in range(min(3, formats_count))])
+        for i in range(format_lists_count))
+    shared_patterns = {'level0': '<a0>'}
+    for level in range(1, shared_depth):
+        shared_patterns['level%d' % level] = '{level%d}/<a%d>' \
+            % (level - 1, level)
+    processes = {}
+    for rule in range(rules_count):
+        process = processes.setdefault(
+            'P%d' % (rule // parameters_count), {})
+        attribute = 'a%d' % (shared_depth
+                             + rule % (attributes_count - shared_depth))
+        if format_lists_count and rule % 2 == 0:
+            format = 'L%d' % (rule % format_lists_count)
+        else:
+            format = 'F%d' % (rule % formats_count)
+        process['p%d' % rule] = [[
+            '%s:{level%d}/p%d_<%s>' % ('input' if rule % 3 == 0 else 'output',
+                                       shared_depth - 1, rule, attribute),
+            format]]
+    return {
+        'fom_name': name,
+        'formats': formats,
+        'format_lists': format_lists,
+        'attribute_definitions': dict(
+            ('a%d' % i, {}) for i in range(attributes_count)),
+        'shared_patterns': shared_patterns,
+        'processes': processes,
+    }
+
+
+def write_fom(definition, directory):
+    '''Write a FOM definition as a JSON file in directory and return its
+    path.
+    '''
+    path = osp.join(directory, definition['fom_name'] + '.json')
+    with open(path, 'w') as f:
+        json.dump(definition, f, indent=1)
+    return path
+
+
+def _rule_files(definition):
+    '''List (rule pattern attribute, file name prefix, extensions) for each
+    rule of a synthetic FOM.
+    '''
+    formats = definition['formats']
+    format_lists = definition['format_lists']
+    result = []
+    for process in sorted(definition['processes']):
+        for parameter, rules in sorted(
+                definition['processes'][process].items()):
+            pattern, format = rules[0]
+            attribute = pattern[pattern.rindex('<') + 1:-1]
+            extensions = [formats[i]
+                          for i in format_lists.get(format, [format])]
+            result.append((attribute, parameter + '_', extensions))
+    return result
+
+
+def synthetic_tree(definition, entries=100000, values_count=10,
+                   seed=0):
+    '''Return a :meth:`DirectoryAsDict.paths_to_dict
+    <soma.fom.DirectoryAsDict.paths_to_dict>` dict of about entries files
+    (it is completed up to the end of the last directory) matching the
+    rules of a synthetic FOM. Each attribute takes values_count values.
+    '''
+    random.seed(seed)
+    shared_depth = len(definition['shared_patterns'])
+    rule_files = _rule_files(definition)
+    values = [['a%dv%d' % (level, i) for i in range(values_count)]
+              for level in range(shared_depth)]
+    file_values = ['v%d' % i for i in range(values_count)]
+    result = {}
+    count = 0
+    for levels in itertools.product(*values):
+        content = result
+        for name in levels:
+            content = content.setdefault(name, [None, {}])[1]
+        for attribute, prefix, extensions in rule_files:
+            for value in random.sample(file_values,
+                                       max(1, values_count // 2)):
+                for extension in extensions:
+                    content[prefix + value + '.' + extension] = [None, None]
+                    count += 1
+        if count >= entries:
+            break
+    return result
+
+
+def write_tree(dirdict, directory):
+    '''Create the directories and (empty) files of dirdict in directory.'''
+    for name, (st, content) in dirdict.items():
+        path = osp.join(directory, name)
+        if content is None:
+            open(path, 'w').close()
+        else:
+            os.mkdir(path)
+            write_tree(content, path)
+
+
+def tree_files(dirdict):
+    '''Number of files of a dirdict.'''
+    count = 0
+    stack = [dirdict]
+    while stack:
+        for st, content in stack.pop().values():
+            if content is None:
+                count += 1
+            else:
+                stack.append(content)
+    return count
+
+
+def synthetic_requests(definition, count=10000, values_count=10, seed=0):
+    '''Return count random find_paths requests for a synthetic FOM.'''
+    random.seed(seed)
+    shared_depth = len(definition['shared_patterns'])
+    rules = []
+    for process in sorted(definition['processes']):
+        for parameter, patterns in sorted(
+                definition['processes'][process].items()):
+            pattern = patterns[0][0]
+            rules.append((process, parameter,
+                          pattern[pattern.rindex('<') + 1:-1]))
+    requests = []
+    for i in range(count):
+        process, parameter, attribute = random.choice(rules)
+        request = {'fom_process': process, 'fom_parameter': parameter,
+                   attribute: 'v%d' % random.randrange(values_count)}
+        for level in range(shared_depth):
+            request['a%d' % level] = 'a%dv%d' % (
+                level, random.randrange(values_count))
+        requests.append(request)
+    return requests
+
+
+class _Stage(object):
+
+    '''Time (and optionally trace memory of) a benchmark stage.'''
+
+    def __init__(self, results, name, memory):
+        self.results = results
+        self.name = name
+        self.memory = memory
+        self.items = None
+
+    def __enter__(self):
+        if self.memory:
+            tracemalloc.start()
+        self.start = timer()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = timer() - self.start
+        stage = {'seconds': seconds, 'items': self.items,
+                 'items_per_second': (self.items / seconds
+                                      if self.items and seconds else None),
+                 'peak_memory': None}
+        if self.memory:
+            stage['peak_memory'] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        if exc_type is None:
+            self.results[self.name] = stage
+        return False
+
+
+def run_benchmark(attributes_count=10, rules_count=1000, parameters_count=20,
+                  formats_count=4, format_lists_count=2, shared_depth=3,
+                  entries=100000, values_count=10, requests_count=10000,
+                  live=False, memory=False, work_directory=None):
+    '''Run the benchmark stages and return the results as a JSON
+    serializable dict.
+
+    Stages are load_foms, path_to_attributes (construction),
+    parse_directory (of a synthetic tree dict), parse_live_directory (of
+    the same tree written on disk, if live is True), attributes_to_paths
+    (construction, without shared rules databases), find_paths (without
+    query plans and results caches, so that every request is resolved) and
+    find_paths_warm (the same requests again, with plans and results
+    caches filled by a first pass). If memory is True, the peak of memory
+    allocated by Python during each stage is measured with tracemalloc,
+    which slows stages down.
+    '''
+    if memory and tracemalloc is None:
+        raise RuntimeError('tracemalloc is needed to measure memory')
+    config = {
+        'attributes_count': attributes_count,
+        'rules_count': rules_count,
+        'parameters_count': parameters_count,
+        'formats_count': formats_count,
+        'format_lists_count': format_lists_count,
+        'shared_depth': shared_depth,
+        'entries': entries,
+        'values_count': values_count,
+        'requests_count': requests_count,
+        'live': live,
+        'memory': memory,
+    }
+    stages = {}
+    results = {
+        'config': config,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'stages': stages,
+    }
+    tmp = tempfile.mkdtemp(prefix='fom_benchmark', dir=work_directory)
+    try:
+        definition = synthetic_fom(attributes_count, rules_count,
+                                   parameters_count, formats_count,
+                                   format_lists_count, shared_depth)
+        fom_directory = osp.join(tmp, 'foms')
+        os.mkdir(fom_directory)
+        write_fom(definition, fom_directory)
+
+        with _Stage(stages, 'load_foms', memory) as stage:
+            foms = fom.FileOrganizationModelManager(
+                [fom_directory]).load_foms(definition['fom_name'])
+            stage.items = len(foms.rules)
+
+        with _Stage(stages, 'path_to_attributes', memory) as stage:
+            pta = fom.PathToAttributes(foms)
+            stage.items = len(foms.rules)
+
+        dirdict = synthetic_tree(definition, entries, values_count)
+        results['tree_files'] = tree_files(dirdict)
+        with _Stage(stages, 'parse_directory', memory) as stage:
+            stage.items = sum(1 for i in pta.parse_directory(dirdict))
+        results['parsed_files'] = stage.items
+
+        if live:
+            tree = osp.join(tmp, 'tree')
+            os.mkdir(tree)
+            write_tree(dirdict, tree)
+            with _Stage(stages, 'parse_live_directory', memory) as stage:
+                stage.items = sum(1 for i in pta.parse_live_directory(tree))
+        del dirdict
+
+        shared_rules = fom.AttributesToPaths.shared_rules
+        fom.AttributesToPaths.shared_rules = None
+        try:
+            with _Stage(stages, 'attributes_to_paths', memory) as stage:
+                atp = fom.AttributesToPaths(foms, plan_cache_size=0,
+                                            results_cache_size=0)
+                stage.items = len(atp.rules)
+        finally:
+            fom.AttributesToPaths.shared_rules = shared_rules
+
+        requests = synthetic_requests(definition, requests_count,
+                                      values_count)
+        with _Stage(stages, 'find_paths', memory) as stage:
+            paths = 0
+            for request in requests:
+                for path in atp.find_paths(request):
+                    paths += 1
+            stage.items = len(requests)
+        results['found_paths'] = paths
+
+        atp.plan_cache = fom.LRUCache(len(requests))
+        atp.results_cache = fom.LRUCache(len(requests))
+        for request in requests:
+            for path in atp.find_paths(request):
+                pass
+        with _Stage(stages, 'find_paths_warm', memory) as stage:
+            for request in requests:
+                for path in atp.find_paths(request):
+                    pass
+            stage.items = len(requests)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    if resource is not None:
+        # kilobytes on Linux, bytes on MacOS
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform != 'darwin':
+            max_rss *= 1024
+        results['max_rss'] = max_rss
+    return results
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark the FOM engine on synthetic FOMs and '
+        'directory trees, and print the results as JSON.')
+    parser.add_argument('--attributes', type=int, default=10,
+                        help='number of FOM attributes')
+    parser.add_argument('--rules', type=int, default=1000,
+                        help='number of FOM rules')
+    parser.add_argument('--parameters', type=int, default=20,
+                        help='number of rules per process')
+    parser.add_argument('--formats', type=int, default=4,
+                        help='number of formats')
+    parser.add_argument('--format-lists', type=int, default=2,
+                        help='number of format lists')
+    parser.add_argument('--depth', type=int, default=3,
+                        help='number of directory levels (shared patterns)')
+    parser.add_argument('--entries', type=int, default=100000,
+                        help='number of files of the synthetic tree')
+    parser.add_argument('--values', type=int, default=10,
+                        help='number of values of each attribute')
+    parser.add_argument('--requests', type=int, default=10000,
+                        help='number of find_paths requests')
+    parser.add_argument('--live', action='store_true',
+                        help='also write the tree on disk and parse it with '
+                        'parse_live_directory')
+    parser.add_argument('--memory', action='store_true',
+                        help='measure the peak memory of each stage')
+    parser.add_argument('--work-directory',
+                        help='directory of temporary files')
+    parser.add_argument('--output', help='JSON output file (default: '
+                        'standard output)')
+    options = parser.parse_args(argv)
+    results = run_benchmark(
+        attributes_count=options.attributes, rules_count=options.rules,
+        parameters_count=options.parameters, formats_count=options.formats,
+        format_lists_count=options.format_lists, shared_depth=options.depth,
+        entries=options.entries, values_count=options.values,
+        requests_count=options.requests, live=options.live,
+        memory=options.memory, work_directory=options.work_directory)
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
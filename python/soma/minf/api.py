@@ -35,13 +35,14 @@
 '''
 This module contains all the framework necessary to customize, read and
 write minf files. A minf file is composed of structured data saved in
-XML or Python format. The minf framework provides tools to read and write
+XML, binary or Python format. The minf framework provides tools to read and write
 minf files but also to customize the way Python objects are read an written.
 
 There are several submodules in this package but main functions and classes
 can be imported from :py:mod:`soma.minf.api`:
 
-- for reading minf files: :func:`iterateMinf`, :func:`readMinf`
+- for reading minf files: :func:`iterateMinf`, :func:`readMinf`,
+  :func:`readMinfItem`, :func:`minfIndex`
 - for writing minf files: :func:`createMinfWriter`, :func:`writeMinf`
 - for customizing minf files: :func:`createReducerAndExpander`, :func:`registerClass`, :func:`registerClassAs`
 
@@ -53,11 +54,16 @@ from __future__ import print_function
 
 __docformat__ = "restructuredtext en"
 
+import os
 import gzip
+import collections
+import json
+import itertools
 import six
 import sys
 
 from soma.translation import translate as _
+from soma.path import replace_file
 from soma.minf.error import MinfError
 from soma.bufferandfile import BufferAndFile
 from soma.minf.reader import MinfReader
@@ -66,6 +72,7 @@ from soma.minf.tree import createReducerAndExpander, registerClass, \
     registerClassAs, createMinfExpander, \
     EndStructure, MinfReducer, MinfExpander, \
     listStructure, dictStructure
+from soma.minf.binary_tags import binaryMagic
 from soma.undefined import Undefined
 defaultReducer = MinfReducer.defaultReducer
 
@@ -78,8 +85,8 @@ def minfFormat(source):
     '''
     Return a pair (format, reduction) identifying the minf format. If
     source is not a minf file, (None, None) is returned. Otherwise,
-    format is a string representing the format of the minf file: 'XML' or
-    'python'. reduction is the name of the reducer used to write the minf
+    format is a string representing the format of the minf file: 'XML',
+    'binary' or 'python'. reduction is the name of the reducer used to write the minf
     file or None if format is 'python'.
 
     Example:
@@ -112,6 +119,21 @@ def minfFormat(source):
       Input file name or file object. If it is a file name, it is
       opened with open(source).
     '''
+    binarySource, source = _binarySource(source)
+    if binarySource is not None:
+        r = MinfReader.createReader('binary')
+        buffer = b''
+        try:
+            reduction, buffer = r.reduction(binarySource)
+        finally:
+            if binarySource is not source:
+                binarySource.close()
+            elif isinstance(source, BufferAndFile):
+                source.unread(buffer)
+            else:
+                source.seek(0)
+        return ('binary', reduction)
+
     if not hasattr(source, 'readline'):
         source = BufferAndFile(open(source))
     elif not isinstance(source, BufferAndFile):
@@ -145,6 +167,46 @@ def minfFormat(source):
     return('XML', reduction)
 
 
+#------------------------------------------------------------------------------
+def _binarySource(source):
+    '''
+    Return a pair (binarySource, source). binarySource is a file object
+    opened in binary mode and positioned at the begining of source if source
+    is a binary minf file, otherwise it is None. The format is identified
+    without seeking in :class:`BufferAndFile` instances and in file objects
+    that cannot be seeked (such as pipes): these are read through a
+    :class:`BufferAndFile`, which is returned as source, and the bytes read
+    are put back in it.
+    '''
+    if not hasattr(source, 'read'):
+        f = open(source, 'rb')
+        if f.read(len(binaryMagic)) == binaryMagic:
+            f.seek(0)
+            return f, source
+        f.close()
+        return None, source
+    seekable = getattr(source, 'seekable', None)
+    if isinstance(source, BufferAndFile) \
+            or (seekable is not None and not seekable()):
+        if not isinstance(source, BufferAndFile):
+            source = BufferAndFile(source)
+        start = source.read(len(binaryMagic))
+        while start and len(start) < len(binaryMagic):
+            # a pipe may return less data than requested
+            data = source.read(len(binaryMagic) - len(start))
+            if not data:
+                break
+            start += data
+        source.unread(start)
+    else:
+        source.seek(0)
+        start = source.read(len(binaryMagic))
+        source.seek(0)
+    if start == binaryMagic:
+        return source, source
+    return None, source
+
+
 #------------------------------------------------------------------------------
 def _setTarget(target, source):
     try:
@@ -169,7 +231,8 @@ def _setTarget(target, source):
 
 
 #------------------------------------------------------------------------------
-def iterateMinf(source, targets=None, stop_on_error=True, exceptions=[]):
+def iterateMinf(source, targets=None, stop_on_error=True, exceptions=[],
+                start=None, stop=None):
     '''
     Returns an iterator over all objects stored in a minf file.
 
@@ -187,10 +250,35 @@ def iterateMinf(source, targets=None, stop_on_error=True, exceptions=[]):
     source: string
       Input file name or file object. If it is a file name, it is
       opened with C{open( source )}.
+    start: int
+      index of the first object to return. When start or stop is given
+      and source is a file name, the objects are read directly from their
+      position in the file using :func:`minfIndex`. Otherwise previous
+      objects are read and skipped.
+    stop: int
+      index following the last object to return.
     '''
+    if start is not None or stop is not None:
+        for item in _iterateMinfSlice(source, targets, stop_on_error,
+                                      exceptions, start, stop):
+            yield item
+        return
+
     if targets is not None:
         targets = iter(targets)
 
+    binarySource, source = _binarySource(source)
+    if binarySource is not None:
+        r = MinfReader.createReader('binary')
+        try:
+            for item in _expandMinf(r.nodeIterator(binarySource), targets,
+                                    stop_on_error, exceptions):
+                yield item
+        finally:
+            if binarySource is not source:
+                binarySource.close()
+        return
+
     initial_source = source
 
     if sys.version_info[0] >= 3 and not hasattr(initial_source, 'readline'):
@@ -260,23 +348,9 @@ def iterateMinf(source, targets=None, stop_on_error=True, exceptions=[]):
                 source.unread('<?xml')
 
             r = MinfReader.createReader('XML')
-            iterator = r.nodeIterator(source)
-            minfNode = next(iterator)
-            expander = createMinfExpander(minfNode.attributes['reduction'])
-            count = 0
-            for nodeItem in iterator:
-                count += 1
-                if isinstance(nodeItem, EndStructure):
-                    break
-                target = None
-                if targets is not None:
-                    try:
-                        target = next(targets)
-                    except StopIteration:
-                        targets = None
-                yield expander.expand(iterator, nodeItem, target=target,
-                                      stop_on_error=stop_on_error,
-                                      exceptions=exceptions)
+            for item in _expandMinf(r.nodeIterator(source), targets,
+                                    stop_on_error, exceptions):
+                yield item
         except UnicodeDecodeError as e:
             if encoding == try_encodings[-1]:
                 raise
@@ -284,8 +358,210 @@ def iterateMinf(source, targets=None, stop_on_error=True, exceptions=[]):
         break # no error, don't process next encoding
 
 #------------------------------------------------------------------------------
+def _expandMinf(iterator, targets, stop_on_error, exceptions):
+    '''
+    Expand the objects of a minf nodes iterator, as read by a
+    :class:`~soma.minf.reader.MinfReader`.
+    '''
+    minfNode = next(iterator)
+    expander = createMinfExpander(minfNode.attributes['reduction'])
+    for nodeItem in iterator:
+        if isinstance(nodeItem, EndStructure):
+            break
+        target = None
+        if targets is not None:
+            try:
+                target = next(targets)
+            except StopIteration:
+                targets = None
+        yield expander.expand(iterator, nodeItem, target=target,
+                              stop_on_error=stop_on_error,
+                              exceptions=exceptions)
+
+
+#------------------------------------------------------------------------------
+def _iterateMinfSlice(source, targets, stop_on_error, exceptions, start, stop):
+    index = None
+    if isinstance(source, six.string_types):
+        index = minfIndex(source)
+    if index is None:
+        if (start is not None and start < 0) \
+                or (stop is not None and stop < 0):
+            # Negative indices are relative to the end of the file, which
+            # must be read entirely. Only the last objects are kept when
+            # possible.
+            iterator = iterateMinf(source, stop_on_error=stop_on_error,
+                                   exceptions=exceptions)
+            if start is not None and start < 0 \
+                    and (stop is None or stop < 0):
+                items = list(collections.deque(iterator, maxlen=-start))
+                items = items[:stop]
+            else:
+                items = list(iterator)[start:stop]
+            if targets is not None:
+                targets = iter(targets)
+            for item in items:
+                if targets is not None:
+                    try:
+                        target = next(targets)
+                    except StopIteration:
+                        targets = None
+                    else:
+                        if _setTarget(target, item):
+                            item = target
+                yield item
+            return
+        if start and targets is not None:
+            targets = itertools.chain(itertools.repeat(None, start), targets)
+        for item in itertools.islice(
+                iterateMinf(source, targets=targets,
+                            stop_on_error=stop_on_error,
+                            exceptions=exceptions), start, stop):
+            yield item
+        return
+    items = range(len(index['offsets']))[slice(start, stop)]
+    if not items:
+        return
+    if targets is not None:
+        targets = iter(targets)
+    r = MinfReader.createReader(index['format'])
+    with open(source, 'rb') as f:
+        iterator = r.itemNodeIterator(f, index, items[0], items[-1] + 1)
+        for item in itertools.islice(_expandMinf(iterator, targets,
+                                                 stop_on_error, exceptions),
+                                     len(items)):
+            yield item
+
+
+#------------------------------------------------------------------------------
+def readMinfItem(source, n, target=None, stop_on_error=True, exceptions=[]):
+    '''
+    Reads the object number n of a minf file. If source is a file name,
+    the object is read directly from its position in the file (see
+    :func:`minfIndex`).
+
+    Example:
+
+    ::
+
+      from soma.minf.api import readMinfItem
+
+      record = readMinfItem('processes_log.minf', 1000)
+
+    see: :func:`iterateMinf`
+    '''
+    if target is None:
+        targets = None
+    else:
+        targets = [target]
+    for item in iterateMinf(source, targets=targets,
+                            stop_on_error=stop_on_error,
+                            exceptions=exceptions, start=n,
+                            stop=(n + 1) or None):
+        return item
+    raise IndexError(_('minf object index out of range: %d') % (n, ))
+
+
+#------------------------------------------------------------------------------
+#: indexes computed by minfIndex (keys are absolute file names and values
+#: are pairs (index, True if saved in the sidecar file))
+_minfIndexes = {}
+#: version of the content of indexes, sidecar files with another version
+#: are ignored
+_minfIndexVersion = 1
 
 
+def minfIndexFileName(source):
+    '''
+    Return the name of the sidecar file used to store the index of a minf
+    file (see :func:`minfIndex`).
+    '''
+    return source + '.index'
+
+
+def minfIndex(source, sidecar=False):
+    '''
+    Return a dictionary containing the byte offsets of the top-level
+    objects of a minf file (in its 'offsets' item). This index allows
+    :func:`iterateMinf` and :func:`readMinfItem` to start reading at any
+    object.
+
+    The index is computed by reading the whole file on first call and is
+    kept in memory. It is recomputed when the size or the modification
+    time of the file change. If a valid sidecar index file exists (see
+    :func:`minfIndexFileName`), it is used instead of reading the file.
+
+    Returns None if the format of the file does not allow random access
+    (python format, compressed XML, obsolete minf 1.0 XML or binary format
+    version 1).
+
+    Parameters
+    ----------
+    source: string
+      minf file name.
+    sidecar: bool
+      if True, the index is saved in a sidecar file when it is computed,
+      in order to be used by other processes.
+    '''
+    fileName = os.path.abspath(source)
+    stat = os.stat(fileName)
+    indexFileName = minfIndexFileName(fileName)
+    index, saved = _minfIndexes.get(fileName, (None, False))
+    if not _validMinfIndex(index, stat):
+        index = None
+        if os.path.exists(indexFileName):
+            try:
+                with open(indexFileName) as f:
+                    index = json.load(f)
+            except ValueError:
+                index = None
+            if not _validMinfIndex(index, stat):
+                index = None
+        saved = index is not None
+        if index is None:
+            index = _buildMinfIndex(fileName)
+            index.update(version=_minfIndexVersion, size=stat.st_size,
+                         mtime=stat.st_mtime)
+    if sidecar and not saved:
+        tmpFileName = '%s.%d.tmp' % (indexFileName, os.getpid())
+        with open(tmpFileName, 'w') as f:
+            json.dump(index, f)
+        replace_file(tmpFileName, indexFileName)
+        saved = True
+    if fileName not in _minfIndexes and len(_minfIndexes) >= 128:
+        del _minfIndexes[next(iter(_minfIndexes))]
+    _minfIndexes[fileName] = (index, saved)
+    if index['format'] is None:
+        return None
+    return index
+
+
+def _validMinfIndex(index, stat):
+    return index is not None and index.get('version') == _minfIndexVersion \
+        and index.get('size') == stat.st_size \
+        and index.get('mtime') == stat.st_mtime
+
+
+def _buildMinfIndex(fileName):
+    with open(fileName, 'rb') as f:
+        start = f.read(len(binaryMagic))
+        f.seek(0)
+        if start == binaryMagic:
+            format = 'binary'
+        elif start[:5] == b'<?xml':
+            format = 'XML'
+        else:
+            format = None
+        index = None
+        if format is not None:
+            index = MinfReader.createReader(format).indexItems(f)
+    if index is None:
+        return {'format': None}
+    index['format'] = format
+    return index
+
+
+#------------------------------------------------------------------------------
 def readMinf(source, targets=None, stop_on_error=True, exceptions=[]):
     '''
     Entirerly reads a minf file and returns its content in a tuple.
@@ -315,7 +591,7 @@ def createMinfWriter(destFile, format='XML', reducer='minf_2.0'):
     Parameters
     ----------
     format: string
-      name of the format to write.
+      name of the format to write: 'XML' or 'binary'.
     reducer: string
       name of the reducer to use (see L{soma.minf.tree} for
       more information about reducers).
@@ -366,10 +642,12 @@ def writeMinf(destFile, args, format='XML', reducer=None):
 
 
 #------------------------------------------------------------------------------
-# xml_reader and xml_writer are not used directly but importing
-# them register the XML minf format
+# xml_reader, xml_writer, binary_reader and binary_writer are not used
+# directly but importing them register the XML and binary minf formats
 import soma.minf.xml_reader
 import soma.minf.xml_writer
+import soma.minf.binary_reader
+import soma.minf.binary_writer
 
 
 #------------------------------------------------------------------------------
@@ -398,6 +676,11 @@ minf_2_0_expander.registerStructure(
 
 registerClass('minf_2.0', Uuid, 'Uuid')
 
+from soma.minf.arrays import numpy, ndarrayReducer
+if numpy is not None:
+    minf_2_0_reducer.registerClass(numpy.ndarray, ndarrayReducer)
+    minf_2_0_reducer.registerClass(numpy.memmap, ndarrayReducer)
+
 
 #------------------------------------------------------------------------------
 minf_1_0_reducer = MinfReducer('minf_1.0', ('minf_2.0', ))
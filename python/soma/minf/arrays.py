@@ -0,0 +1,155 @@
+# -*- coding: iso-8859-1 -*-
+
+#  This software and supporting documentation are distributed by
+#      Institut Federatif de Recherche 49
+#      CEA/NeuroSpin, Batiment 145,
+#      91191 Gif-sur-Yvette cedex
+#      France
+#
+# This software is governed by the CeCILL-B license under
+# French law and abiding by the rules of distribution of free software.
+# You can  use, modify and/or redistribute the software under the
+# terms of the CeCILL-B license as circulated by CEA, CNRS
+# and INRIA at the following URL "http://www.cecill.info".
+#
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty  and the software's author,  the holder of the
+# economic rights,  and the successive licensors  have only  limited
+# liability.
+#
+# In this respect, the user's attention is drawn to the risks associated
+# with loading,  using,  modifying and/or developing or reproducing the
+# software by the user in light of its specific status of free software,
+# that may mean  that it is complicated to manipulate,  and  that  also
+# therefore means  that it is reserved for developers  and  experienced
+# professionals having in-depth computer knowledge. Users are therefore
+# encouraged to load and test the software's suitability as regards their
+# requirements in conditions enabling the security of their systems and/or
+# data to be ensured and,  more generally, to use and operate it in the
+# same conditions as regards security.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL-B license and that you accept its terms.
+
+
+'''
+Support of numpy arrays in minf files.
+
+An array is stored in a minf tree as a single atom node containing its
+dtype, its shape and its data (in C order). XML minf files contain the data
+encoded in base64 and binary minf files contain raw data. When the size of
+an array is at least the ``arraySidecarSize`` of the writer (see
+:class:`~soma.minf.writer.MinfWriter`), its data are saved in a ``.npy``
+file next to the minf file instead, and this file is memory mapped when
+the minf file is read.
+
+Arrays containing Python objects are stored as lists.
+
+* license: `CeCILL B <http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html>`_
+'''
+__docformat__ = "restructuredtext en"
+
+import ast
+import os.path as osp
+import six
+
+from soma.translation import translate as _
+from soma.minf.error import MinfError
+
+try:
+    import numpy
+    from numpy.lib import format as npy_format
+except ImportError:
+    numpy = None
+
+
+#------------------------------------------------------------------------------
+def isArray(value):
+    '''
+    Return True if value is a numpy array that can be stored as a minf array
+    node.
+    '''
+    return numpy is not None and isinstance(value, numpy.ndarray) \
+        and not value.dtype.hasobject
+
+
+def ndarrayReducer(reducer, array):
+    '''
+    :class:`~soma.minf.tree.MinfReducer` function for numpy arrays.
+    '''
+    if array.dtype.hasobject:
+        return reducer.reduce(array.tolist())
+    return (array, )
+
+
+def dtypeDescription(dtype):
+    '''
+    Return a string describing a numpy dtype (see :func:`dtypeFromDescription`).
+    '''
+    descr = npy_format.dtype_to_descr(dtype)
+    if isinstance(descr, list):
+        return repr(descr)
+    return descr
+
+
+def dtypeFromDescription(description):
+    '''
+    Return the numpy dtype described by a string returned by
+    :func:`dtypeDescription`.
+    '''
+    if numpy is None:
+        raise MinfError(_('numpy is required to read arrays in minf files'))
+    if description.startswith('['):
+        description = ast.literal_eval(description)
+    return npy_format.descr_to_dtype(description)
+
+
+def arrayFromBuffer(buffer, dtype, shape):
+    '''
+    Return an array using the data in buffer without copy.
+    '''
+    return numpy.frombuffer(buffer, dtype=dtype).reshape(shape)
+
+
+def arrayData(array):
+    '''
+    Return the raw data of an array in C order.
+    '''
+    return array.tobytes()
+
+
+def saveArraySidecar(writer, file, array):
+    '''
+    Save array in a .npy file next to the minf file written by writer in
+    file if the size of the array is at least writer.arraySidecarSize.
+    Return the name of the .npy file relative to the minf file directory or
+    None if the array must be saved in the minf file.
+    '''
+    sidecarSize = writer.arraySidecarSize
+    if sidecarSize is None or array.nbytes < sidecarSize \
+            or array.nbytes == 0:
+        return None
+    minfFileName = getattr(file, 'name', None)
+    if not isinstance(minfFileName, six.string_types):
+        return None
+    index = getattr(writer, '_arraySidecarCount', 0)
+    writer._arraySidecarCount = index + 1
+    fileName = '%s.%d.npy' % (osp.basename(minfFileName), index)
+    numpy.save(osp.join(osp.dirname(minfFileName), fileName),
+               numpy.require(array, requirements='C'))
+    return fileName
+
+
+def loadArraySidecar(source, fileName):
+    '''
+    Memory map a .npy file whose name is relative to the directory of the
+    minf file read from source. The returned array is writable but the
+    changes are not saved in the file.
+    '''
+    if numpy is None:
+        raise MinfError(_('numpy is required to read arrays in minf files'))
+    minfFileName = getattr(source, 'name', None)
+    if isinstance(minfFileName, six.string_types):
+        fileName = osp.join(osp.dirname(minfFileName), fileName)
+    return numpy.load(fileName, mmap_mode='c')
@@ -0,0 +1,357 @@
+# -*- coding: iso-8859-1 -*-
+
+#  This software and supporting documentation are distributed by
+#      Institut Federatif de Recherche 49
+#      CEA/NeuroSpin, Batiment 145,
+#      91191 Gif-sur-Yvette cedex
+#      France
+#
+# This software is governed by the CeCILL-B license under
+# French law and abiding by the rules of distribution of free software.
+# You can  use, modify and/or redistribute the software under the
+# terms of the CeCILL-B license as circulated by CEA, CNRS
+# and INRIA at the following URL "http://www.cecill.info".
+#
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty  and the software's author,  the holder of the
+# economic rights,  and the successive licensors  have only  limited
+# liability.
+#
+# In this respect, the user's attention is drawn to the risks associated
+# with loading,  using,  modifying and/or developing or reproducing the
+# software by the user in light of its specific status of free software,
+# that may mean  that it is complicated to manipulate,  and  that  also
+# therefore means  that it is reserved for developers  and  experienced
+# professionals having in-depth computer knowledge. Users are therefore
+# encouraged to load and test the software's suitability as regards their
+# requirements in conditions enabling the security of their systems and/or
+# data to be ensured and,  more generally, to use and operate it in the
+# same conditions as regards security.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL-B license and that you accept its terms.
+
+
+'''
+Reading of binary minf format (see :mod:`soma.minf.binary_tags`).
+
+* license: `CeCILL B <http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html>`_
+'''
+__docformat__ = "restructuredtext en"
+
+import struct
+import itertools
+
+from soma.translation import translate as _
+from soma.minf.error import MinfError
+from soma.minf.reader import MinfReader
+from soma.minf.tree import minfStructure, StartStructure, EndStructure, \
+    Reference
+from soma.minf.xhtml import XHTML
+from soma.minf.arrays import dtypeFromDescription, arrayFromBuffer, \
+    loadArraySidecar
+
+# This module only contains a definition of binary codes.
+# It is designed to allow "import *".
+from soma.minf.binary_tags import *
+
+_int8 = struct.Struct('<b')
+_int32 = struct.Struct('<i')
+_int64 = struct.Struct('<q')
+_uint32 = struct.Struct('<I')
+_uint64 = struct.Struct('<Q')
+_float = struct.Struct('<d')
+
+
+#------------------------------------------------------------------------------
+class MinfBinaryReader(MinfReader):
+
+    '''
+    Specialization of L{MinfReader} class for reading binary minf format. The
+    source must be a file object opened in binary mode. It is read by blocks
+    of L{blockSize} bytes.
+    '''
+    name = 'binary'
+    #: number of bytes read from the source at each read
+    blockSize = 64 * 1024
+
+    def _reset(self, source):
+        self._source = source
+        self._data = bytearray()
+        self._pos = 0
+        # offset in source of the first byte of self._data
+        self._base = 0
+        self._strings = []
+        self._structures = []
+        # when not None, bytes dropped from self._data are kept there
+        self._consumed = None
+
+    def _fill(self, size):
+        '''
+        Make sure that at least size bytes following the current position are
+        in the buffer. Return False if the end of file is reached before.
+        '''
+        if self._pos:
+            self._base += self._pos
+            if self._consumed is not None:
+                self._consumed += self._data[:self._pos]
+            del self._data[:self._pos]
+            self._pos = 0
+        while len(self._data) < size:
+            block = self._source.read(max(self.blockSize,
+                                          size - len(self._data)))
+            if not block:
+                return False
+            self._data += block
+        return True
+
+    def _take(self, size):
+        pos = self._pos
+        if len(self._data) - pos < size:
+            if not self._fill(size):
+                raise MinfError(_('Truncated binary minf file: %s') %
+                                (getattr(self._source, 'name', '<unknown>'), ))
+            pos = 0
+        self._pos = pos + size
+        return pos
+
+    def _readInto(self, buffer):
+        '''
+        Fill buffer with the following bytes of the source.
+        '''
+        size = len(buffer)
+        available = min(size, len(self._data) - self._pos)
+        buffer[:available] = self._data[self._pos:self._pos + available]
+        self._pos += available
+        view = memoryview(buffer)[available:]
+        self._base += len(view)
+        while len(view):
+            if hasattr(self._source, 'readinto'):
+                count = self._source.readinto(view)
+            else:
+                block = self._source.read(len(view))
+                count = len(block)
+                view[:count] = block
+            if not count:
+                raise MinfError(_('Truncated binary minf file: %s') %
+                                (getattr(self._source, 'name', '<unknown>'), ))
+            view = view[count:]
+
+    def _readHeader(self):
+        pos = self._take(len(binaryMagic) + 1)
+        if self._data[pos:pos + len(binaryMagic)] != binaryMagic:
+            raise MinfError(_('Invalid binary minf file: %s') %
+                            (getattr(self._source, 'name', '<unknown>'), ))
+        version = self._data[pos + len(binaryMagic)]
+        if version > binaryVersion:
+            raise MinfError(_('Unsupported binary minf version: %d') %
+                            (version, ))
+        return version
+
+    def reduction(self, source):
+        self._reset(source)
+        self._consumed = bytearray()
+        self._readHeader()
+        minfNode = self._readRecord()
+        if not isinstance(minfNode, StartStructure) \
+                or minfNode.type != minfStructure:
+            raise MinfError(_('Invalid binary minf file: %s') %
+                            (getattr(self._source, 'name', '<unknown>'), ))
+        # all the bytes read from source
+        return (minfNode.attributes['reduction'],
+                bytes(self._consumed + self._data))
+
+    def nodeIterator(self, source):
+        self._reset(source)
+        self._readHeader()
+        return self._iterateNodes()
+
+    def indexItems(self, source):
+        self._reset(source)
+        if self._readHeader() < 2:
+            # top-level objects may be packed in runs
+            return None
+        minfNode = self._readRecord()
+        offsets = []
+        stringCounts = []
+        while self._structures:
+            if self._pos >= len(self._data) and not self._fill(1):
+                # end of file
+                break
+            code = self._data[self._pos]
+            if len(self._structures) == 1 and code != endStructureCode:
+                offsets.append(self._base + self._pos)
+                stringCounts.append(len(self._strings))
+            self._pos += 1
+            reader = self._readers.get(code)
+            if reader is None:
+                reader = self._runReaders.get(code)
+                if reader is None:
+                    self._invalidCode(code)
+            reader(self)
+        return {'reduction': minfNode.attributes['reduction'],
+                'offsets': offsets,
+                'stringCounts': stringCounts,
+                'strings': self._strings}
+
+    def itemNodeIterator(self, source, index, n, stop=None):
+        self._reset(source)
+        self._strings = index['strings'][:index['stringCounts'][n]]
+        self._structures = [minfStructure]
+        self._base = index['offsets'][n]
+        source.seek(self._base)
+        return itertools.chain(
+            [StartStructure(minfStructure, reduction=index['reduction'])],
+            self._iterateNodes())
+
+    def _iterateNodes(self):
+        readers = self._readers
+        runReaders = self._runReaders
+        while True:
+            if self._pos >= len(self._data) and not self._fill(1):
+                # end of file
+                break
+            code = self._data[self._pos]
+            self._pos += 1
+            reader = readers.get(code)
+            if reader is not None:
+                yield reader(self)
+            else:
+                runReader = runReaders.get(code)
+                if runReader is None:
+                    self._invalidCode(code)
+                for value in runReader(self):
+                    yield value
+
+    def _invalidCode(self, code):
+        raise MinfError(_('Invalid record code in binary minf file: %d') %
+                        (code, ))
+
+    def _readRecord(self):
+        pos = self._take(1)
+        code = self._data[pos]
+        reader = self._readers.get(code)
+        if reader is None:
+            self._invalidCode(code)
+        return reader(self)
+
+    def _readNone(self):
+        return None
+
+    def _readTrue(self):
+        return True
+
+    def _readFalse(self):
+        return False
+
+    def _readInt8(self):
+        return _int8.unpack_from(self._data, self._take(1))[0]
+
+    def _readInt32(self):
+        return _int32.unpack_from(self._data, self._take(4))[0]
+
+    def _readInt64(self):
+        return _int64.unpack_from(self._data, self._take(8))[0]
+
+    def _readBigInt(self):
+        return int(self._readBytes().decode('ascii'))
+
+    def _readFloat(self):
+        return _float.unpack_from(self._data, self._take(8))[0]
+
+    def _readBytes(self):
+        size = _uint32.unpack_from(self._data, self._take(4))[0]
+        pos = self._take(size)
+        return self._data[pos:pos + size]
+
+    def _readString(self):
+        return self._readBytes().decode('utf-8')
+
+    def _readNewString(self):
+        value = self._readBytes().decode('utf-8')
+        self._strings.append(value)
+        return value
+
+    def _readStringReference(self):
+        index = _uint32.unpack_from(self._data, self._take(4))[0]
+        return self._strings[index]
+
+    def _readRun(self, format, itemSize):
+        count = _uint32.unpack_from(self._data, self._take(4))[0]
+        return struct.unpack_from('<%d%s' % (count, format), self._data,
+                                  self._take(count * itemSize))
+
+    def _readInt32Run(self):
+        return self._readRun('i', 4)
+
+    def _readInt64Run(self):
+        return self._readRun('q', 8)
+
+    def _readFloatRun(self):
+        return self._readRun('d', 8)
+
+    def _readStartStructure(self):
+        type = self._readRecord()
+        identifier = self._readRecord()
+        attributes = {}
+        for i in range(_uint32.unpack_from(self._data, self._take(4))[0]):
+            attributeName = self._readRecord()
+            attributes[str(attributeName)] = self._readRecord()
+        self._structures.append(type)
+        return StartStructure(type, identifier=identifier, **attributes)
+
+    def _readEndStructure(self):
+        if not self._structures:
+            raise MinfError(_('Minf structure ended but not started'))
+        return EndStructure(self._structures.pop())
+
+    def _readReference(self):
+        return Reference(identifier=self._readRecord())
+
+    def _readXHTML(self):
+        tag = self._readRecord()
+        attributes = {}
+        for i in range(_uint32.unpack_from(self._data, self._take(4))[0]):
+            attributeName = self._readRecord()
+            attributes[attributeName] = self._readRecord()
+        content = [self._readRecord()
+                   for i in range(_uint32.unpack_from(self._data,
+                                                      self._take(4))[0])]
+        return XHTML(tag, attributes, content)
+
+    def _readArray(self):
+        dtype = dtypeFromDescription(self._readRecord())
+        ndim = _uint32.unpack_from(self._data, self._take(4))[0]
+        shape = struct.unpack_from('<%dQ' % ndim, self._data,
+                                   self._take(8 * ndim))
+        if self._data[self._take(1)]:
+            return loadArraySidecar(self._source, self._readRecord())
+        data = bytearray(_uint64.unpack_from(self._data, self._take(8))[0])
+        self._readInto(data)
+        return arrayFromBuffer(data, dtype, shape)
+
+    _readers = {
+        noneCode: _readNone,
+        trueCode: _readTrue,
+        falseCode: _readFalse,
+        int8Code: _readInt8,
+        int32Code: _readInt32,
+        int64Code: _readInt64,
+        bigIntCode: _readBigInt,
+        floatCode: _readFloat,
+        newStringCode: _readNewString,
+        stringCode: _readString,
+        stringReferenceCode: _readStringReference,
+        startStructureCode: _readStartStructure,
+        endStructureCode: _readEndStructure,
+        referenceCode: _readReference,
+        xhtmlCode: _readXHTML,
+        arrayCode: _readArray,
+    }
+
+    _runReaders = {
+        int32RunCode: _readInt32Run,
+        int64RunCode: _readInt64Run,
+        floatRunCode: _readFloatRun,
+    }
@@ -0,0 +1,95 @@
+# -*- coding: iso-8859-1 -*-
+
+#  This software and supporting documentation are distributed by
+#      Institut Federatif de Recherche 49
+#      CEA/NeuroSpin, Batiment 145,
+#      91191 Gif-sur-Yvette cedex
+#      France
+#
+# This software is governed by the CeCILL-B license under
+# French law and abiding by the rules of distribution of free software.
+# You can  use, modify and/or redistribute the software under the
+# terms of the CeCILL-B license as circulated by CEA, CNRS
+# and INRIA at the following URL "http://www.cecill.info".
+#
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty  and the software's author,  the holder of the
+# economic rights,  and the successive licensors  have only  limited
+# liability.
+#
+# In this respect, the user's attention is drawn to the risks associated
+# with loading,  using,  modifying and/or developing or reproducing the
+# software by the user in light of its specific status of free software,
+# that may mean  that it is complicated to manipulate,  and  that  also
+# therefore means  that it is reserved for developers  and  experienced
+# professionals having in-depth computer knowledge. Users are therefore
+# encouraged to load and test the software's suitability as regards their
+# requirements in conditions enabling the security of their systems and/or
+# data to be ensured and,  more generally, to use and operate it in the
+# same conditions as regards security.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL-B license and that you accept its terms.
+
+
+'''
+This module defines only "constants" used in binary minf format.
+
+A binary minf file starts with :data:`binaryMagic` followed by one byte
+containing the format version. Then comes a series of records encoding the
+minf nodes. Each record starts with a one byte code followed by its payload.
+All numbers are little endian and lengths are unsigned 32 bits integers:
+
+- atoms: ``none``, ``true``, ``false``, ``int8``, ``int32``, ``int64``,
+  ``bigInt`` (decimal string), ``float`` (64 bits). Strings are encoded in
+  UTF-8 and prefixed by their length. A ``newString`` is added to the table
+  of interned strings of the file and can be referenced later by its index
+  with a ``stringReference``, a ``string`` is not interned.
+- packed runs: a series of consecutive integers or floats is stored as a
+  count followed by an array of ``int32``, ``int64`` or ``float`` values.
+  Since version 2, runs are only used inside structures: each top-level
+  object starts with its own record, so that it can be read directly from
+  its offset (see :func:`soma.minf.api.minfIndex`). Version 1 files may
+  contain top-level runs, they are read but cannot be indexed.
+- ``startStructure``: type (string), identifier (string or none), number of
+  attributes then name (string) and value (atom) of each attribute.
+- ``endStructure``: no payload, the type is the one of the last opened
+  structure.
+- ``reference``: identifier (string).
+- ``xhtml``: tag (string or none), number of attributes, name and value
+  of each attribute, number of content items then items (strings or
+  ``xhtml`` records).
+- ``array``: dtype (string, see :func:`soma.minf.arrays.dtypeDescription`),
+  number of dimensions, dimensions (unsigned 64 bits integers) then either
+  a zero byte followed by the size and the raw data of the array or a one
+  byte followed by the name of a .npy file (string).
+
+* license: `CeCILL B <http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html>`_
+'''
+__docformat__ = "restructuredtext en"
+
+#: First bytes of a binary minf file
+binaryMagic = b'\x89MINF\r\n\x1a\n'
+#: Version of the binary minf format written after binaryMagic
+binaryVersion = 2
+
+noneCode = ord('N')
+trueCode = ord('T')
+falseCode = ord('F')
+int8Code = ord('b')
+int32Code = ord('i')
+int64Code = ord('q')
+bigIntCode = ord('L')
+floatCode = ord('d')
+newStringCode = ord('s')
+stringCode = ord('S')
+stringReferenceCode = ord('r')
+int32RunCode = ord('I')
+int64RunCode = ord('Q')
+floatRunCode = ord('D')
+startStructureCode = ord('(')
+endStructureCode = ord(')')
+referenceCode = ord('@')
+xhtmlCode = ord('x')
+arrayCode = ord('A')
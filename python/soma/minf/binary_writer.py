@@ -0,0 +1,253 @@
+# -*- coding: iso-8859-1 -*-
+
+#  This software and supporting documentation are distributed by
+#      Institut Federatif de Recherche 49
+#      CEA/NeuroSpin, Batiment 145,
+#      91191 Gif-sur-Yvette cedex
+#      France
+#
+# This software is governed by the CeCILL-B license under
+# French law and abiding by the rules of distribution of free software.
+# You can  use, modify and/or redistribute the software under the
+# terms of the CeCILL-B license as circulated by CEA, CNRS
+# and INRIA at the following URL "http://www.cecill.info".
+#
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty  and the software's author,  the holder of the
+# economic rights,  and the successive licensors  have only  limited
+# liability.
+#
+# In this respect, the user's attention is drawn to the risks associated
+# with loading,  using,  modifying and/or developing or reproducing the
+# software by the user in light of its specific status of free software,
+# that may mean  that it is complicated to manipulate,  and  that  also
+# therefore means  that it is reserved for developers  and  experienced
+# professionals having in-depth computer knowledge. Users are therefore
+# encouraged to load and test the software's suitability as regards their
+# requirements in conditions enabling the security of their systems and/or
+# data to be ensured and,  more generally, to use and operate it in the
+# same conditions as regards security.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL-B license and that you accept its terms.
+
+
+'''
+Writing of binary minf format (see :mod:`soma.minf.binary_tags`).
+
+* license: `CeCILL B <http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html>`_
+'''
+__docformat__ = "restructuredtext en"
+
+import struct
+import six
+
+from soma.translation import translate as _
+from soma.minf.tree import createMinfReducer
+from soma.minf.writer import MinfWriter
+from soma.minf.tree import minfStructure, StartStructure, EndStructure, \
+    Reference
+from soma.minf.xhtml import XHTML
+from soma.minf.error import MinfError
+from soma.minf.arrays import isArray, dtypeDescription, arrayData, \
+    saveArraySidecar
+
+# This module only contains a definition of binary codes.
+# It is designed to allow "import *".
+from soma.minf.binary_tags import *
+
+_int8Min, _int8Max = -2 ** 7, 2 ** 7 - 1
+_int32Min, _int32Max = -2 ** 31, 2 ** 31 - 1
+_int64Min, _int64Max = -2 ** 63, 2 ** 63 - 1
+_codeAndUInt32 = struct.Struct('<BI')
+
+
+#------------------------------------------------------------------------------
+class MinfBinaryWriter(MinfWriter):
+
+    '''
+    Specialization of L{MinfWriter} class for writing binary minf format.
+
+    Output is accumulated in memory and written to the file by chunks of at
+    least L{bufferSize} bytes. Series of at least L{packedRunMinimum}
+    consecutive numbers are written as packed runs and strings that are not
+    longer than L{internMaximumLength} are written only once.
+    '''
+
+    name = 'binary'
+    fileMode = 'wb'
+    #: size of the output buffer
+    bufferSize = 64 * 1024
+    #: minimum number of consecutive numbers written as a packed run
+    packedRunMinimum = 8
+    #: strings longer than this are not interned
+    internMaximumLength = 64
+
+    def __init__(self, file, reducer):
+        self.__file = file
+        self.reducer = createMinfReducer(reducer)
+        self._chunks = []
+        self._bufferedSize = 0
+        self._strings = {}
+        self._structures = []
+        self._run = []
+        self._runType = None
+        self._write(binaryMagic + struct.pack('<B', binaryVersion))
+        self._writeNode(StartStructure(minfStructure, reduction=reducer))
+
+    def close(self):
+        if self.__file is not None:
+            self._writeNode(EndStructure(minfStructure))
+            self.flush()
+            self.__file = None
+
+    def write(self, value):
+        for minfNode in self.reducer.reduce(value):
+            self._writeNode(minfNode)
+
+    def flush(self):
+        self._flushRun()
+        if self._chunks:
+            self.__file.write(b''.join(self._chunks))
+            self._chunks = []
+            self._bufferedSize = 0
+        self.__file.flush()
+
+    def change_file(self, file):
+        self.__file = file
+
+    def _write(self, data):
+        self._chunks.append(data)
+        self._bufferedSize += len(data)
+        if self._bufferedSize >= self.bufferSize:
+            self.__file.write(b''.join(self._chunks))
+            self._chunks = []
+            self._bufferedSize = 0
+
+    def _writeNode(self, minfNode):
+        nodeType = type(minfNode)
+        if len(self._structures) < 2:
+            # since version 2, top-level objects start on a record (see
+            # MinfBinaryReader.indexItems)
+            runType = None
+        elif nodeType is float:
+            runType = float
+        elif nodeType in six.integer_types \
+                and _int64Min <= minfNode <= _int64Max:
+            runType = int
+        else:
+            runType = None
+        if runType is not self._runType:
+            self._flushRun()
+            self._runType = runType
+        if runType is not None:
+            self._run.append(minfNode)
+            if len(self._run) >= 65536:
+                self._flushRun()
+        elif isinstance(minfNode, StartStructure):
+            self._write(struct.pack('<B', startStructureCode))
+            self._writeString(minfNode.type)
+            self._writeAtom(minfNode.identifier)
+            self._write(struct.pack('<I', len(minfNode.attributes)))
+            for attributeName, value in six.iteritems(minfNode.attributes):
+                self._writeString(attributeName)
+                self._writeAtom(value)
+            self._structures.append(minfNode.type)
+        elif isinstance(minfNode, EndStructure):
+            if not self._structures:
+                raise MinfError(
+                    _('Unexpected Minf structure ending: %s') % (minfNode.type, ))
+            ntype = self._structures.pop()
+            if ntype != minfNode.type:
+                raise MinfError(_('Wrong Minf structure ending, expecting %(exp)s instead of %(rcv)s') %
+                                {'exp': ntype, 'rcv': minfNode.type})
+            self._write(struct.pack('<B', endStructureCode))
+        elif isinstance(minfNode, Reference):
+            self._write(struct.pack('<B', referenceCode))
+            self._writeString(minfNode.identifier)
+        else:
+            self._writeAtom(minfNode)
+
+    def _flushRun(self):
+        run = self._run
+        if not run:
+            return
+        if len(run) >= self.packedRunMinimum:
+            if self._runType is float:
+                code, format = floatRunCode, 'd'
+            elif min(run) >= _int32Min and max(run) <= _int32Max:
+                code, format = int32RunCode, 'i'
+            else:
+                code, format = int64RunCode, 'q'
+            self._write(_codeAndUInt32.pack(code, len(run)) +
+                        struct.pack('<%d%s' % (len(run), format), *run))
+        else:
+            for value in run:
+                self._writeAtom(value)
+        self._run = []
+
+    def _writeAtom(self, value):
+        if value is None:
+            self._write(struct.pack('<B', noneCode))
+        elif value is True:
+            self._write(struct.pack('<B', trueCode))
+        elif value is False:
+            self._write(struct.pack('<B', falseCode))
+        elif isinstance(value, six.integer_types):
+            if _int8Min <= value <= _int8Max:
+                self._write(struct.pack('<Bb', int8Code, value))
+            elif _int32Min <= value <= _int32Max:
+                self._write(struct.pack('<Bi', int32Code, value))
+            elif _int64Min <= value <= _int64Max:
+                self._write(struct.pack('<Bq', int64Code, value))
+            else:
+                data = str(value).encode('ascii')
+                self._write(_codeAndUInt32.pack(bigIntCode, len(data)) + data)
+        elif isinstance(value, float):
+            self._write(struct.pack('<Bd', floatCode, value))
+        elif isinstance(value, six.string_types):
+            self._writeString(value)
+        elif isinstance(value, XHTML):
+            self._write(struct.pack('<B', xhtmlCode))
+            self._writeAtom(value.tag)
+            self._write(struct.pack('<I', len(value.attributes)))
+            for attributeName, attributeValue in six.iteritems(value.attributes):
+                self._writeString(attributeName)
+                self._writeString(six.text_type(attributeValue))
+            self._write(struct.pack('<I', len(value.content)))
+            for item in value.content:
+                self._writeAtom(item)
+        elif isArray(value):
+            self._write(struct.pack('<B', arrayCode))
+            self._writeString(dtypeDescription(value.dtype))
+            self._write(struct.pack('<I%dQ' % value.ndim, value.ndim,
+                                    *value.shape))
+            fileName = saveArraySidecar(self, self.__file, value)
+            if fileName is None:
+                self._write(struct.pack('<BQ', 0, value.nbytes))
+                self._write(arrayData(value))
+            else:
+                self._write(struct.pack('<B', 1))
+                self._writeString(fileName)
+        else:
+            raise MinfError(
+                _('Cannot save an object of type %s as a binary atom') % (str(type(value)), ))
+
+    def _writeString(self, value):
+        if isinstance(value, bytes):
+            try:
+                value = value.decode('utf-8')
+            except UnicodeDecodeError:
+                value = value.decode('iso-8859-1')
+        index = self._strings.get(value)
+        if index is not None:
+            self._write(_codeAndUInt32.pack(stringReferenceCode, index))
+            return
+        if len(value) <= self.internMaximumLength:
+            self._strings[value] = len(self._strings)
+            code = newStringCode
+        else:
+            code = stringCode
+        data = value.encode('utf-8')
+        self._write(_codeAndUInt32.pack(code, len(data)) + data)
@@ -113,3 +113,29 @@ class MinfReader(six.with_metaclass(RegisterMinfReaderClass, object)):
         @param source: source of the minf file.
         @type  source: string of file object
         '''
+
+    def indexItems(self, source):
+        '''
+        Read a whole minf file and return a dictionary allowing
+        L{itemNodeIterator} to start reading at any top-level object. It
+        contains at least the name of the reduction ('reduction' key) and
+        the byte offsets of the top-level objects ('offsets' key), and it
+        must be serializable in JSON. Returns C{None} if the format does not
+        support random access.
+        @param source: minf file opened in binary mode.
+        @type  source: file object
+        '''
+
+    def itemNodeIterator(self, source, index, n, stop=None):
+        '''
+        Return an iterator on the nodes of a minf file starting with the
+        top-level object number C{n}. Like L{nodeIterator}, the first node is
+        the start of the minf structure.
+        @param source: minf file opened in binary mode.
+        @type  source: file object
+        @param index: dictionary returned by L{indexItems} for this file.
+        @type  index: dict
+        @param stop: if not C{None}, objects from number C{stop} may not be
+          read.
+        @type  stop: int
+        '''
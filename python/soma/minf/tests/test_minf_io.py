@@ -4,7 +4,9 @@ import unittest
 import shutil
 import os
 import tempfile
+import json
 import soma.minf.api as minf
+from soma.minf.binary_tags import binaryMagic
 
 
 
@@ -28,6 +30,197 @@ class TestMinfIO(unittest.TestCase):
         dd = minf.readMinf(minf_file)
         self.assertEqual(d, dd[0])
 
+    def test_minf_xml_blocks(self):
+        from soma.minf.xml_reader import MinfXMLReader
+        d = {'a': [1, 2.5, u'x<&>', None, True, False], 'b': {'c': []}}
+        minf_file = os.path.join(self.directory, 'minf_xml_blocks.minf')
+        minf.writeMinf(minf_file, (d, 'second'))
+        with open(minf_file, 'a') as f:
+            f.write('trailing data is ignored\n')
+        block_size = MinfXMLReader.blockSize
+        try:
+            # elements are split across parser blocks
+            MinfXMLReader.blockSize = 3
+            self.assertEqual(minf.readMinf(minf_file), (d, 'second'))
+        finally:
+            MinfXMLReader.blockSize = block_size
+        self.assertEqual(minf.readMinf(minf_file), (d, 'second'))
+        log_file = os.path.join(self.directory, 'minf_log.minf')
+        with open(log_file, 'w') as f:
+            f.write('<?xml version="1.0" encoding="utf-8" ?>\n')
+        self.assertEqual(minf.readMinf(log_file), ())
+
+    def test_minf_binary_io(self):
+        d = {
+            'titi': {'bubu': '50', 'turlute': 12},
+            'toto': 'val"u\'e',
+            'tutu': [0, 1, 2, [u'papa', 5]],
+            'ints': list(range(-5, 100)) + [2 ** 40, 2 ** 70],
+            'floats': [i / 3. for i in range(20)],
+            'records': [{'name': u'n\xe9', 'value': None, 'ok': True}] * 3}
+        minf_file = os.path.join(self.directory, 'minf_binary_file.minf')
+        minf.writeMinf(minf_file, (d, 'second'), format='binary')
+        self.assertEqual(minf.minfFormat(minf_file), ('binary', 'minf_2.0'))
+        self.assertEqual(minf.readMinf(minf_file), (d, 'second'))
+        with open(minf_file, 'rb') as f:
+            self.assertEqual(minf.readMinf(f), (d, 'second'))
+        xml_file = os.path.join(self.directory, 'minf_xml_file.minf')
+        minf.writeMinf(xml_file, (d, 'second'))
+        self.assertEqual(minf.minfFormat(xml_file), ('XML', 'minf_2.0'))
+        self.assertLess(os.path.getsize(minf_file), os.path.getsize(xml_file))
+
+    def test_minf_non_seekable_io(self):
+        import io
+
+        class Pipe(io.RawIOBase):
+            # non seekable stream returning small blocks, as a pipe
+            def __init__(self, data):
+                self.data = io.BytesIO(data)
+
+            def readable(self):
+                return True
+
+            def readinto(self, b):
+                data = self.data.read(min(len(b), 7))
+                b[:len(data)] = data
+                return len(data)
+
+        d = {'a': [1, 2.5, u'x'], 'b': None}
+        minf_file = os.path.join(self.directory, 'minf_pipe.minf')
+        minf.writeMinf(minf_file, (d, 'second'), format='binary')
+        with open(minf_file, 'rb') as f:
+            data = f.read()
+        pipe = Pipe(data)
+        self.assertRaises(io.UnsupportedOperation, pipe.seek, 0)
+        self.assertEqual(minf.readMinf(pipe), (d, 'second'))
+        # the bytes read by minfFormat are put back in the BufferAndFile
+        from soma.bufferandfile import BufferAndFile
+        source = BufferAndFile(Pipe(data))
+        self.assertEqual(minf.minfFormat(source), ('binary', 'minf_2.0'))
+        self.assertEqual(minf.readMinf(source), (d, 'second'))
+        minf.writeMinf(minf_file, (d, 'second'))
+        with open(minf_file) as f:
+            text = f.read()
+        pipe = io.TextIOWrapper(io.BufferedReader(Pipe(text.encode('utf-8'))),
+                                encoding='utf-8')
+        self.assertFalse(pipe.seekable())
+        self.assertEqual(minf.readMinf(pipe), (d, 'second'))
+
+    def test_minf_numpy_io(self):
+        import numpy
+        arrays = [numpy.arange(12, dtype='>i2').reshape(3, 4),
+                  numpy.asfortranarray(numpy.random.rand(3, 5)),
+                  numpy.array(3.5),
+                  numpy.array([(1, 2.5)], dtype=[('a', '<i4'), ('b', '<f8')])]
+        for format in ('XML', 'binary'):
+            for sidecar_size in (None, 0):
+                minf_file = os.path.join(self.directory, 'minf_numpy_%s_%s.minf'
+                                         % (format, sidecar_size))
+                writer = minf.createMinfWriter(minf_file, format=format)
+                writer.arraySidecarSize = sidecar_size
+                writer.write({'arrays': arrays, 'objects': numpy.array(
+                    [1, 'x'], dtype=object)})
+                writer.close()
+                d = minf.readMinf(minf_file)[0]
+                self.assertEqual(d['objects'], [1, 'x'])
+                for array, read_array in zip(arrays, d['arrays']):
+                    self.assertEqual(read_array.dtype, array.dtype)
+                    self.assertEqual(read_array.shape, array.shape)
+                    self.assertTrue((read_array == array).all())
+                self.assertEqual(
+                    isinstance(d['arrays'][0], numpy.memmap),
+                    sidecar_size is not None)
+
+    def test_minf_xml_writer_buffer(self):
+        import io
+        from soma.minf.xml_writer import MinfXMLWriter
+        d = {'a': [1, 2.5, u'x<&>\xe9\x01', None, True, False],
+             'b': {'c': []}}
+        outputs = []
+        for stream, buffer_size in ((io.StringIO(), 1), (io.StringIO(), None),
+                                    (io.BytesIO(), None)):
+            writer = MinfXMLWriter(stream, 'minf_2.0')
+            if buffer_size is not None:
+                writer.bufferSize = buffer_size
+            writer.write(d)
+            writer.flush()
+            # flush writes the buffered lines
+            self.assertEqual(len(stream.getvalue().splitlines()), 16)
+            writer.close()
+            value = stream.getvalue()
+            if not isinstance(value, bytes):
+                value = value.encode('utf-8')
+            outputs.append(value)
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual(outputs[0], outputs[2])
+        self.assertEqual(minf.readMinf(io.StringIO(outputs[0].decode('utf-8'))),
+                         (dict(d, a=[1, 2.5, u'x<&>\xe9', None, True, False]), ))
+
+    def test_minf_index(self):
+        records = [{'id': i, 'name': u'process %d' % i, 'values': list(range(i))}
+                   for i in range(30)] + [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 'end']
+        for format in ('XML', 'binary'):
+            minf_file = os.path.join(self.directory,
+                                     'minf_index_%s.minf' % format)
+            minf.writeMinf(minf_file, records, format=format)
+            index = minf.minfIndex(minf_file, sidecar=True)
+            self.assertEqual(len(index['offsets']), len(records))
+            self.assertTrue(os.path.exists(minf.minfIndexFileName(minf_file)))
+            for n in (0, 17, 30, 35, -1):
+                self.assertEqual(minf.readMinfItem(minf_file, n), records[n])
+            self.assertEqual(list(minf.iterateMinf(minf_file, start=28, stop=33)),
+                             records[28:33])
+            self.assertRaises(IndexError, minf.readMinfItem, minf_file, 100)
+            # the index is updated when the file changes
+            minf.writeMinf(minf_file, records[:3], format=format)
+            os.utime(minf_file, (0, 0))
+            self.assertEqual(list(minf.iterateMinf(minf_file, start=1)),
+                             records[1:3])
+            self.assertEqual(len(minf.minfIndex(minf_file)['offsets']), 3)
+            # an existing sidecar index is replaced
+            index = minf.minfIndex(minf_file, sidecar=True)
+            with open(minf.minfIndexFileName(minf_file)) as f:
+                self.assertEqual(len(json.load(f)['offsets']), 3)
+        # version 1 binary files may pack top-level numbers: no index
+        with open(minf_file, 'r+b') as f:
+            f.seek(len(binaryMagic))
+            f.write(b'\x01')
+        os.utime(minf_file, (1, 1))
+        self.assertEqual(minf.minfIndex(minf_file), None)
+        self.assertEqual(minf.readMinfItem(minf_file, -2), records[1])
+
+    def test_minf_item_stream(self):
+        import io
+        records = [{'id': i} for i in range(5)] + ['end']
+        stream = io.StringIO()
+        writer = minf.createMinfWriter(stream)
+        for record in records:
+            writer.write(record)
+        writer.close()
+        py_file = os.path.join(self.directory, 'minf_py_file.minf')
+        with open(py_file, 'w') as f:
+            f.write('attributes = ' + repr(records[0]) + '\n')
+        for source, items in ((stream, records), (py_file, records[:1])):
+            for n in (-1, -len(items), len(items) - 1):
+                if hasattr(source, 'seek'):
+                    source.seek(0)
+                self.assertEqual(minf.readMinfItem(source, n), items[n])
+            self.assertRaises(IndexError, minf.readMinfItem, source,
+                              -len(items) - 1)
+            self.assertRaises(IndexError, minf.readMinfItem, source,
+                              len(items))
+        stream.seek(0)
+        self.assertEqual(list(minf.iterateMinf(stream, start=-4, stop=-1)),
+                         records[-4:-1])
+        stream.seek(0)
+        self.assertEqual(list(minf.iterateMinf(stream, start=1, stop=-2)),
+                         records[1:-2])
+        stream.seek(0)
+        target = {'previous': True}
+        self.assertTrue(minf.readMinfItem(stream, -2, target=target)
+                        is target)
+        self.assertEqual(target, {'previous': True, 'id': 4})
+
     def test_minf_py_io(self):
         d = {
             'titi': {'bubu': '50', 'turlute': 12},
@@ -82,6 +82,15 @@ class MinfWriter(six.with_metaclass(RegisterMinfWriterClass, object)):
     #: class derived from L{MinfWriter} must set a format name in this attribute.
     name = None
 
+    #: mode used to open the destination file when a file name is given to
+    #: L{createWriter}.
+    fileMode = 'w'
+
+    #: numpy arrays whose size in bytes is at least this value are saved in
+    #: a .npy file next to the minf file (see L{soma.minf.arrays}). None
+    #: means that arrays are always saved in the minf file.
+    arraySidecarSize = None
+
     def __init__(self, file, reducer):
         '''
         Constructor of classes derived from L{MinfWriter} must be callable with two
@@ -115,7 +124,7 @@ class MinfWriter(six.with_metaclass(RegisterMinfWriterClass, object)):
         @returns: L{MinfWriter} derived class instance.
         @param file: file name or file object (opened for writing) where the minf
           file is written. If it is a file name, it is opened with
-          C{open( destFile, 'wb' )}.
+          C{open( destFile, writer.fileMode )}.
         @type  file: string or any object respecting Python file object API
         @param reducer: name of the reducer to use (see L{soma.minf.tree} for
           more information about reducers).
@@ -131,6 +140,6 @@ class MinfWriter(six.with_metaclass(RegisterMinfWriterClass, object)):
                                         for i in
                                         MinfWriter._allWriterClasses])})
         if not hasattr(destFile, 'write'):
-            destFile = open(destFile, 'w')
+            destFile = open(destFile, writer.fileMode)
         return writer(destFile, reducer, )
     createWriter = staticmethod(createWriter)
@@ -42,117 +42,136 @@ Reading of XML minf format.
 __docformat__ = "restructuredtext en"
 
 import sys
-import os
-import operator
-import codecs
-import types
-import gzip
-from xml.sax.saxutils import quoteattr as xml_quoteattr
-from xml.sax.saxutils import escape as xml_escape
-from xml.sax import make_parser
-from xml.sax.handler import ContentHandler
-from xml.sax.handler import ErrorHandler
+import base64
+from collections import deque
+from xml.parsers import expat
 
 from soma.translation import translate as _
-from soma.undefined import Undefined
 from soma.minf.error import MinfError
 
 from soma.minf.reader import MinfReader
 from soma.minf.tree import minfStructure, listStructure, dictStructure, \
     StartStructure, EndStructure, Reference
 from soma.minf.xhtml import XHTML
+from soma.minf.arrays import dtypeFromDescription, arrayFromBuffer, \
+    loadArraySidecar
 
 # This module only contains a definition of XML tags and attributes.
 # It is designed to allow "import *".
 from soma.minf.xml_tags import *
 if sys.version_info[0] >= 3:
     # python3
-    from io import StringIO
     unicode = str
-else:
-    from cStringIO import StringIO
+    long = int
 
 #------------------------------------------------------------------------------
 
 
-class MinfXMLReader(MinfReader, ErrorHandler):
+class MinfXMLReader(MinfReader):
 
     '''
     Specialization of L{MinfReader} class for reading XML minf format.
+
+    The source is read by blocks of L{blockSize} characters that are fed to
+    an expat parser. Each open element is represented by a frame
+    C{[startChild, end, data, characters]} where C{startChild} and C{end} are
+    the functions called for child elements and for the element end. Minf
+    nodes are queued until the iterator consumes them.
     '''
     name = 'XML'
-
-    class SaxHandler(ContentHandler):
-
-        def __init__(self, parser):
-            self.parser = parser
-            self.parser._handler = MinfXMLHandler(parser)
-            self.parser._stack = []
-
-        def startElement(self, name, attrs):
-            # Convert to builtin Python types
-            name = unicode(name)
-            attrs = dict([(unicode(i[0]), unicode(i[1]))
-                         for i in attrs.items()])
-            self.parser._stack.append(name)
-            self.parser._handler.startElement(self.parser, name, attrs)
-
-        def endElement(self, name):
-            self.parser._handler.endElement(self.parser, unicode(name))
-            self.parser._stack.pop()
-
-        def characters(self, content):
-            self.parser._handler.characters(self.parser, unicode(content))
-
-    def reduction(self, source):
-        self._nodesToProduce = []
-        self._sax_parser = make_parser()
-        self._sax_parser.setContentHandler(MinfXMLReader.SaxHandler(self))
-        self._sax_parser.setErrorHandler(self)
-        self._sax_parser.reset()
+    #: number of characters read from the source at each parsing step
+    blockSize = 64 * 1024
+    # list where indexItems stores the offsets of top-level objects
+    _itemOffsets = None
+
+    def _reset(self):
+        self._nodesToProduce = deque()
+        self._stack = []
+        self._frames = []
+        self._characters = None
         self._minfStarted = False
         self._minfFinished = False
+        self._obsoleteFormat = False
         self._nodeIdentifier = 0
+        parser = expat.ParserCreate()
+        parser.buffer_text = True
+        parser.StartElementHandler = self._startElement
+        parser.EndElementHandler = self._endElement
+        parser.CharacterDataHandler = self._charactersData
+        self._parser = parser
+
+    def _feed(self, data):
+        try:
+            self._parser.Parse(data, False)
+        except expat.ExpatError as e:
+            # Data following the end of the minf element is ignored
+            if not self._minfFinished:
+                self.fatalError(e)
+
+    def reduction(self, source):
+        self._reset()
         buffer = []
         while not self._nodesToProduce:
-            line = source.readline()
-            buffer.append(line)
-            if not line:
+            block = source.read(self.blockSize)
+            buffer.append(block)
+            if not block:
                 # end of file
                 break
-            self._sax_parser.feed(line)
+            self._feed(block)
         if self._nodesToProduce:
             return (self._nodesToProduce[0].attributes['reduction'], ''.join(buffer))
         return (None, ''.join(buffer))
 
     def nodeIterator(self, source):
-        self._nodesToProduce = []
-        self._sax_parser = make_parser()
-        self._sax_parser.setContentHandler(MinfXMLReader.SaxHandler(self))
-        self._sax_parser.setErrorHandler(self)
-        self._sax_parser.reset()
-        # self._sax_parser.feed( encodingLine )
-        self._minfStarted = False
-        self._minfFinished = False
-        self._nodeIdentifier = 0
+        self._reset()
+        self._source = source
+        nodes = self._nodesToProduce
         while not self._minfFinished:
-            while self._nodesToProduce:
-                node = self._nodesToProduce.pop(0)
-                yield node
-            line = source.readline()
-            if not line:
+            while nodes:
+                yield nodes.popleft()
+            block = source.read(self.blockSize)
+            if not block:
                 # end of file
                 if not self._minfStarted:
                     # Log files may be read while not finished, therefore the closing
                     # tag is missing. It is append to avoid XML parser error
                     # message.
-                    self._sax_parser.feed('<' + minfTag + '/>')
+                    self._feed('<' + minfTag + '/>')
                 self._minfFinished = True
                 break
-            self._sax_parser.feed(line)
-        while self._nodesToProduce:
-            node = self._nodesToProduce.pop(0)
-            yield node
+            self._feed(block)
+        while nodes:
+            yield nodes.popleft()
+
+    def indexItems(self, source):
+        offsets = []
+        self._itemOffsets = offsets
+        try:
+            iterator = self.nodeIterator(source)
+            minfNode = next(iterator)
+            for node in iterator:
+                pass
+        finally:
+            self._itemOffsets = None
+        if self._obsoleteFormat:
+            # minf 1.0 files contain a single dictionary
+            return None
+        return {'reduction': minfNode.attributes['reduction'],
+                'offsets': offsets}
+
+    def itemNodeIterator(self, source, index, n, stop=None):
+        # the parser is given the begining of the file up to the first
+        # top-level object then the file from the object number n up to the
+        # object number stop
+        offsets = index['offsets']
+        source.seek(0)
+        prolog = source.read(offsets[0])
+        source.seek(offsets[n])
+        if stop is not None and stop < len(offsets):
+            size = offsets[stop] - offsets[n]
+        else:
+            size = None
+        return self.nodeIterator(_PrologFile(prolog, source, size))
 
     def parseError(self, errorMessage):
         self.fatalError(errorMessage)
@@ -167,61 +186,108 @@ class MinfXMLReader(MinfReader, ErrorHandler):
             self.parseError(_('Invalid attribute": %(attributes)s') %
                             {'attributes': ', '.join(['"' + n + '"' for n in attributes])})
 
+    # expat callbacks
 
-#------------------------------------------------------------------------------
-class XMLHandler:
-
-    def __init__(self, parser, parent, name, attributes):
-        self.parent = parent
-        parser.checkNoMoreAttributes(attributes)
-
-    def startElement(self, parser, name, attributes):
-        parser.parseError(_('Unexpected tag "%s"') % (name, ))
-
-    def endElement(self, parser, name):
-        parser._handler = self.parent
-        self.parent = None
-
-    def characters(self, parser, content):
-        pass
-
-
-#------------------------------------------------------------------------------
-class NoneXMLHandler(XMLHandler):
-
-    def endElement(self, parser, name):
-        parser._nodesToProduce.append(None)
-        XMLHandler.endElement(self, parser, name)
-
-
-#------------------------------------------------------------------------------
-class TrueXMLHandler(XMLHandler):
-
-    def endElement(self, parser, name):
-        parser._nodesToProduce.append(True)
-        XMLHandler.endElement(self, parser, name)
-
-
-#------------------------------------------------------------------------------
-class FalseXMLHandler(XMLHandler):
-
-    def endElement(self, parser, name):
-        parser._nodesToProduce.append(False)
-        XMLHandler.endElement(self, parser, name)
-
+    def _startElement(self, name, attributes):
+        self._stack.append(name)
+        if self._frames:
+            self._frames[-1][0](name, attributes)
+        else:
+            self._startMinf(name, attributes)
 
-#------------------------------------------------------------------------------
-class NumberXMLHandler(XMLHandler):
+    def _endElement(self, name):
+        frame = self._frames[-1]
+        frame[1](frame, name)
+        self._stack.pop()
 
-    def __init__(self, parser, parent, name, attributes):
-        XMLHandler.__init__(self, parser, parent, name, attributes)
-        self._stringValue = []
+    def _charactersData(self, content):
+        if self._characters is not None:
+            self._characters.append(content)
 
-    def characters(self, parser, content):
-        self._stringValue.append(content)
+    def _pushFrame(self, startChild, end, data=None, characters=None):
+        self._frames.append([startChild, end, data, characters])
+        self._characters = characters
 
-    def endElement(self, parser, name):
-        stringValue = ''.join(self._stringValue)
+    def _popFrame(self):
+        self._frames.pop()
+        if self._frames:
+            self._characters = self._frames[-1][3]
+        else:
+            self._characters = None
+
+    # minf element
+
+    def _startMinf(self, name, attributes):
+        if name != minfTag:
+            # Document is not a minf file
+            self.parseError(
+                _('Wrong document type, expecting "%(minf)s" instead of '
+                  '"%(other)s>"') % {'minf': minfTag, 'other': name})
+        # Checking minf format
+        expanderName = attributes.pop(expanderAttribute, None)
+        if expanderName is None:
+            # Compatibility with obsolete minf 1.0 XML format
+            version = attributes.pop('version', None)
+            if version is None:
+                expanderName = 'minf_2.0'
+            else:
+                if version != '1.0':
+                    self.parseError(_('Wrong value for attribute "version", found '
+                                      '"%s" but only "1.0" is accepted') %
+                                    (version, ))
+                self._obsoleteFormat = True
+                expanderName = 'minf_1.0'
+        self._nodesToProduce.append(
+            StartStructure(minfStructure, reduction=expanderName))
+        # Compatibility with obsolete minf 1.0 XML format
+        if self._obsoleteFormat:
+            self._nodesToProduce.append(StartStructure(dictStructure))
+        self._minfStarted = True
+        self._pushFrame(self._startMinfChild, self._endMinf)
+        # Check attributes
+        self.checkNoMoreAttributes(attributes)
+
+    def _startMinfChild(self, name, attributes):
+        if self._itemOffsets is not None:
+            self._itemOffsets.append(self._parser.CurrentByteIndex)
+        nameAttr = attributes.pop(nameAttribute, None)
+        if nameAttr is None:
+            if self._obsoleteFormat:
+                self.parseError(
+                    _('%s attribute required for minf_1.0') % (nameAttribute,))
+        else:
+            if self._obsoleteFormat:
+                self._nodesToProduce.append(nameAttr)
+            else:
+                self.parseError(
+                    _('Unexpected attribute %s') % (nameAttribute, ))
+        self._startValue(name, attributes)
+
+    def _endMinf(self, frame, name):
+        # Compatibility with obsolete minf 1.0 XML format
+        if self._obsoleteFormat:
+            self._nodesToProduce.append(EndStructure(dictStructure))
+        self._nodesToProduce.append(EndStructure(minfStructure))
+        self._popFrame()
+        self._minfFinished = True
+
+    # value elements
+
+    def _startValue(self, name, attributes):
+        start = self._valueStarts.get(name)
+        if start is None:
+            self.parseError(_('Unexpected tag "%s"') % (name, ))
+        start(self, name, attributes)
+
+    def _unexpectedChild(self, name, attributes):
+        self.parseError(_('Unexpected tag "%s"') % (name, ))
+
+    def _endValue(self, frame, name):
+        self._nodesToProduce.append(frame[2])
+        self._popFrame()
+
+    def _endNumber(self, frame, name):
+        stringValue = ''.join(frame[3])
         try:
             value = int(stringValue)
         except:
@@ -229,231 +295,178 @@ class NumberXMLHandler(XMLHandler):
                 value = long(stringValue)
             except:
                 value = float(stringValue)
-        parser._nodesToProduce.append(value)
-        XMLHandler.endElement(self, parser, name)
-
+        self._nodesToProduce.append(value)
+        self._popFrame()
 
-#------------------------------------------------------------------------------
-class StringXMLHandler(XMLHandler):
-
-    def __init__(self, parser, parent, name, attributes):
-        XMLHandler.__init__(self, parser, parent, name, attributes)
-        self._value = []
+    def _endString(self, frame, name):
+        self._nodesToProduce.append(''.join(frame[3]))
+        self._popFrame()
 
-    def characters(self, parser, content):
-        self._value.append(content)
+    def _endStructure(self, frame, name):
+        self._nodesToProduce.append(EndStructure(frame[2]))
+        self._popFrame()
 
-    def endElement(self, parser, name):
-        parser._nodesToProduce.append(''.join(self._value))
-        XMLHandler.endElement(self, parser, name)
+    def _startDictChild(self, name, attributes):
+        nameAttr = attributes.pop(nameAttribute, None)
+        if nameAttr is not None:
+            self._nodesToProduce.append(nameAttr)
+        self._startValue(name, attributes)
 
+    def _startFactoryChild(self, name, attributes):
+        self._nodesToProduce.append(attributes.pop(nameAttribute, None))
+        self._startValue(name, attributes)
 
-#------------------------------------------------------------------------------
-class ListXMLHandler(XMLHandler):
+    def _startXHTMLChild(self, name, attributes):
+        stack = self._frames[-1][2]
+        characters = self._frames[-1][3]
+        c = ''.join(characters)
+        if c:
+            stack[-1].content.append(c)
+        del characters[:]
+        newItem = XHTML(name, attributes)
+        stack[-1].content.append(newItem)
+        stack.append(newItem)
+
+    def _endXHTML(self, frame, name):
+        item = frame[2].pop()
+        characters = frame[3]
+        c = ''.join(characters)
+        del characters[:]
+        if c:
+            item.content.append(c)
+        if not frame[2]:
+            self._nodesToProduce.append(item)
+            self._popFrame()
 
-    def __init__(self, parser, parent, name, attributes):
-        length = attributes.pop(lengthAttribute, None)
-        identifier = attributes.pop(identifierAttribute, None)
-        if length is not None:
-            parser._nodesToProduce.append(StartStructure(listStructure,
-                                                         identifier=identifier,
-                                                         length=length))
-        else:
-            parser._nodesToProduce.append(StartStructure(listStructure,
-                                                         identifier=identifier))
-        XMLHandler.__init__(self, parser, parent, name, attributes)
+    def _startNone(self, name, attributes):
+        self.checkNoMoreAttributes(attributes)
+        self._pushFrame(self._unexpectedChild, self._endValue, None)
 
-    def startElement(self, parser, name, attributes):
-        newHandler = MinfXMLHandler.getHandler(parser, self, name, attributes)
-        if newHandler is None:
-            parser.parseError(_('Unexpected tag "%s"') % (name, ))
-        parser._handler = newHandler
+    def _startTrue(self, name, attributes):
+        self.checkNoMoreAttributes(attributes)
+        self._pushFrame(self._unexpectedChild, self._endValue, True)
 
-    def endElement(self, parser, name):
-        parser._nodesToProduce.append(EndStructure(listStructure))
-        XMLHandler.endElement(self, parser, name)
+    def _startFalse(self, name, attributes):
+        self.checkNoMoreAttributes(attributes)
+        self._pushFrame(self._unexpectedChild, self._endValue, False)
 
+    def _startNumber(self, name, attributes):
+        self.checkNoMoreAttributes(attributes)
+        self._pushFrame(self._unexpectedChild, self._endNumber,
+                        characters=[])
 
-#------------------------------------------------------------------------------
-class DictionaryXMLHandler(XMLHandler):
+    def _startString(self, name, attributes):
+        self.checkNoMoreAttributes(attributes)
+        self._pushFrame(self._unexpectedChild, self._endString,
+                        characters=[])
 
-    def __init__(self, parser, parent, name, attributes):
+    def _startCollection(self, structure, attributes):
         length = attributes.pop(lengthAttribute, None)
         identifier = attributes.pop(identifierAttribute, None)
         if length is not None:
-            parser._nodesToProduce.append(StartStructure(dictStructure,
-                                                         identifier=identifier,
-                                                         length=length))
+            self._nodesToProduce.append(StartStructure(structure,
+                                                       identifier=identifier,
+                                                       length=length))
         else:
-            parser._nodesToProduce.append(StartStructure(dictStructure,
-                                                         identifier=identifier))
-        XMLHandler.__init__(self, parser, parent, name, attributes)
-
-    def startElement(self, parser, name, attributes):
-        nameAttr = attributes.pop(nameAttribute, None)
-        if nameAttr is not None:
-            parser._nodesToProduce.append(nameAttr)
-        newHandler = MinfXMLHandler.getHandler(parser, self, name, attributes)
-        if newHandler is None:
-            parser.parseError(_('Unexpected tag "%s"') % (name, ))
-        parser._handler = newHandler
-
-    def endElement(self, parser, name):
-        parser._nodesToProduce.append(EndStructure(dictStructure))
-        XMLHandler.endElement(self, parser, name)
-
-
-#------------------------------------------------------------------------------
-class FactoryXMLHandler(XMLHandler):
-
-    def __init__(self, parser, parent, name, attributes):
-        self.type = attributes.pop(objectTypeAttribute, None)
-        if self.type is None:
-            parser.parseError(
+            self._nodesToProduce.append(StartStructure(structure,
+                                                       identifier=identifier))
+        self.checkNoMoreAttributes(attributes)
+
+    def _startList(self, name, attributes):
+        self._startCollection(listStructure, attributes)
+        self._pushFrame(self._startValue, self._endStructure, listStructure)
+
+    def _startDictionary(self, name, attributes):
+        self._startCollection(dictStructure, attributes)
+        self._pushFrame(self._startDictChild, self._endStructure,
+                        dictStructure)
+
+    def _startFactory(self, name, attributes):
+        type = attributes.pop(objectTypeAttribute, None)
+        if type is None:
+            self.parseError(
                 _('%s attribute missing') % (objectTypeAttribute, ))
         identifier = attributes.pop(identifierAttribute, None)
-        parser._nodesToProduce.append(
-            StartStructure(self.type, identifier=identifier))
-        XMLHandler.__init__(self, parser, parent, name, attributes)
-
-    def startElement(self, parser, name, attributes):
-        nameAttr = attributes.pop(nameAttribute, None)
-        parser._nodesToProduce.append(nameAttr)
-        newHandler = MinfXMLHandler.getHandler(parser, self, name, attributes)
-        if newHandler is None:
-            parser.parseError(_('Unexpected tag "%s"') % (name, ))
-        parser._handler = newHandler
-
-    def endElement(self, parser, name):
-        parser._nodesToProduce.append(EndStructure(self.type))
-        XMLHandler.endElement(self, parser, name)
-
-
-#------------------------------------------------------------------------------
-class ReferenceXMLHandler(XMLHandler):
+        self._nodesToProduce.append(
+            StartStructure(type, identifier=identifier))
+        self.checkNoMoreAttributes(attributes)
+        self._pushFrame(self._startFactoryChild, self._endStructure, type)
 
-    def __init__(self, parser, parent, name, attributes):
+    def _startReference(self, name, attributes):
         identifier = attributes.pop(identifierAttribute, None)
-        if self.type is None:
-            parser.parseError(
+        if identifier is None:
+            self.parseError(
                 _('%s attribute missing') % (identifierAttribute, ))
-        parser._nodesToProduce.append(Reference(identifier=identifier))
-        XMLHandler.__init__(self, parser, parent, name, attributes)
-
-    def endElement(self, parser, name):
-        XMLHandler.endElement(self, parser, name)
-
-
-#------------------------------------------------------------------------------
-class XHTMLHandler(XMLHandler):
-
-    def __init__(self, parser, parent, name, attributes):
-        self.stack = [XHTML(name, attributes)]
-        self._characters = []
-        XMLHandler.__init__(self, parser, parent, name, attributes)
-
-    def characters(self, parser, content):
-        self._characters.append(content)
-
-    def startElement(self, parser, name, attributes):
-        c = ''.join(self._characters)
-        if c:
-            self.stack[-1].content.append(c)
-        self._characters = []
-        newItem = XHTML(name, attributes)
-        self.stack[-1].content.append(newItem)
-        self.stack.append(newItem)
-
-    def endElement(self, parser, name):
-        item = self.stack.pop()
-        c = ''.join(self._characters)
-        self._characters = []
-        if c:
-            item.content.append(c)
-        if not self.stack:
-            parser._nodesToProduce.append(item)
-            XMLHandler.endElement(self, parser, name)
+        self._nodesToProduce.append(Reference(identifier=identifier))
+        self.checkNoMoreAttributes(attributes)
+        self._pushFrame(self._unexpectedChild, self._popFrameAtEnd)
+
+    def _popFrameAtEnd(self, frame, name):
+        self._popFrame()
+
+    def _startArray(self, name, attributes):
+        dtype = attributes.pop(dtypeAttribute, None)
+        shape = attributes.pop(shapeAttribute, None)
+        if dtype is None or shape is None:
+            self.parseError(_('%s and %s attributes are required') %
+                            (dtypeAttribute, shapeAttribute))
+        fileName = attributes.pop(fileAttribute, None)
+        self.checkNoMoreAttributes(attributes)
+        array = (dtypeFromDescription(dtype),
+                 tuple([int(i) for i in shape.split(',') if i]), fileName)
+        self._pushFrame(self._unexpectedChild, self._endArray, array, [])
+
+    def _endArray(self, frame, name):
+        dtype, shape, fileName = frame[2]
+        if fileName is None:
+            data = bytearray(base64.b64decode(''.join(frame[3])))
+            array = arrayFromBuffer(data, dtype, shape)
+        else:
+            array = loadArraySidecar(self._source, fileName)
+        self._nodesToProduce.append(array)
+        self._popFrame()
+
+    def _startXHTML(self, name, attributes):
+        item = XHTML(name, attributes)
+        self.checkNoMoreAttributes(attributes)
+        self._pushFrame(self._startXHTMLChild, self._endXHTML, [item], [])
+
+    _valueStarts = {
+        noneTag: _startNone,
+        trueTag: _startTrue,
+        falseTag: _startFalse,
+        numberTag: _startNumber,
+        stringTag: _startString,
+        listTag: _startList,
+        dictionaryTag: _startDictionary,
+        factoryTag: _startFactory,
+        referenceTag: _startReference,
+        xhtmlTag: _startXHTML,
+        arrayTag: _startArray,
+    }
 
 
 #------------------------------------------------------------------------------
-class MinfXMLHandler(XMLHandler):
-    _handlers = {
-        noneTag: NoneXMLHandler,
-        trueTag: TrueXMLHandler,
-        falseTag: FalseXMLHandler,
-        numberTag: NumberXMLHandler,
-        stringTag: StringXMLHandler,
-        listTag: ListXMLHandler,
-        dictionaryTag: DictionaryXMLHandler,
-        factoryTag: FactoryXMLHandler,
-        referenceTag: ReferenceXMLHandler,
-        xhtmlTag: XHTMLHandler,
-    }
+class _PrologFile(object):
 
-    def __init__(self, parser):
-        XMLHandler.__init__(self, parser, None, minfTag, {})
-
-    def getHandler(parser, parent, name, attributes):
-        handler = MinfXMLHandler._handlers.get(name)
-        if handler is not None:
-            handler = handler(parser, parent, name, attributes)
-        return handler
-    getHandler = staticmethod(getHandler)
-
-    def startElement(self, parser, name, attributes):
-        if parser._minfStarted:
-            nameAttr = attributes.pop(nameAttribute, None)
-            if nameAttr is None:
-                if self._obsoleteFormat:
-                    parser.parseError(
-                        _('%s attribute required for minf_1.0') % (nameAttribute,))
-            else:
-                if self._obsoleteFormat:
-                    parser._nodesToProduce.append(nameAttr)
-                else:
-                    parser.parseError(
-                        _('Unexpected attribute %s') % (nameAttribute, ))
-            newHandler = MinfXMLHandler.getHandler(
-                parser, self, name, attributes)
-            if newHandler is None:
-                parser.parseError(_('Unexpected tag "%s"') % (name, ))
-            parser._handler = newHandler
-        else:
-            if name != minfTag:
-                # Document is not a minf file
-                parser.parseError(
-                    _('Wrong document type, expecting "%(minf)s" instead of '
-                        '"%(other)s>"') % {'minf': minfTag, 'other': name})
-            # Checking minf format
-            self._obsoleteFormat = False
-            expanderName = attributes.pop(expanderAttribute, None)
-            if expanderName is None:
-                # Compatibility with obsolete minf 1.0 XML format
-                version = attributes.pop('version', None)
-                if version is None:
-                    expanderName = 'minf_2.0'
-                else:
-                    if version != '1.0':
-                        parser.parseError(_('Wrong value for attribute "version", found '
-                                            '"%s" but only "1.0" is accepted') %
-                                          (version, ))
-                    self._obsoleteFormat = True
-                    expanderName = 'minf_1.0'
-            parser._nodesToProduce.append(
-                StartStructure(minfStructure, reduction=expanderName))
-            # Compatibility with obsolete minf 1.0 XML format
-            if self._obsoleteFormat:
-                parser._nodesToProduce.append(StartStructure(dictStructure))
-            parser._minfStarted = True
-            # Check attributes
-            parser.checkNoMoreAttributes(attributes)
+    '''
+    Read only file object returning a prolog then at most size bytes of a
+    file (or all the remaining content of the file if size is None).
+    '''
 
-    def endElement(self, parser, name):
-        if name == minfTag:
-            # Compatibility with obsolete minf 1.0 XML format
-            if self._obsoleteFormat:
-                parser._nodesToProduce.append(EndStructure(dictStructure))
-            parser._nodesToProduce.append(EndStructure(minfStructure))
-            parser._minfFinished = True
-        else:
-            parser._nodesToProduce.append(EndStructure(minfStructure))
+    def __init__(self, prolog, file, size=None):
+        self._prolog = prolog
+        self._file = file
+        self._size = size
+        self.name = getattr(file, 'name', '<unknown>')
+
+    def read(self, size):
+        if self._prolog:
+            result = self._prolog[:size]
+            self._prolog = self._prolog[size:]
+            return result
+        if self._size is None:
+            return self._file.read(size)
+        result = self._file.read(min(size, self._size))
+        self._size -= len(result)
+        return result
@@ -54,9 +54,13 @@ factoryTag = u'f'
 xhtmlTag = u'xhtml'
 minfTag = u'minf'
 referenceTag = u'ref'
+arrayTag = u'array'
 
 expanderAttribute = u'expander'
 lengthAttribute = u'length'
 nameAttribute = u'name'
 objectTypeAttribute = u'type'
 identifierAttribute = u'identifier'
+dtypeAttribute = u'dtype'
+shapeAttribute = u'shape'
+fileAttribute = u'file'
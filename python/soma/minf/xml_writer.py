@@ -41,7 +41,9 @@ Writing of XML minf format.
 '''
 __docformat__ = "restructuredtext en"
 
+import io
 import codecs
+import base64
 import six
 from xml.sax.saxutils import quoteattr as xml_quoteattr
 from xml.sax.saxutils import escape as xml_escape
@@ -51,6 +53,8 @@ from soma.minf.writer import MinfWriter
 from soma.minf.tree import minfStructure, listStructure, dictStructure, \
     StartStructure, EndStructure
 from soma.minf.error import MinfError
+from soma.minf.arrays import isArray, dtypeDescription, arrayData, \
+    saveArraySidecar
 from soma.undefined import Undefined
 import sys
 if sys.version_info[0] >= 3:
@@ -79,17 +83,37 @@ class MinfXMLWriter(MinfWriter):
 
     '''
     Specialization of L{MinfWriter} class for writing XML minf format.
+
+    Lines are accumulated in a buffer that is written to the file when its
+    size reaches L{bufferSize} characters, when L{flush} is called and when
+    the writer is closed. Whether the file expects text or bytes is decided
+    on the first write.
     '''
 
     name = 'XML'
+    #: size (in characters) of the output buffer
+    bufferSize = 64 * 1024
 
     def __init__(self, file, reducer,
                  encoding='utf-8',
                  level=0,
                  append=False):
         self.__file = file
+        self._binaryFile = _isBinaryFile(file)
+        self._buffer = []
+        self._bufferedSize = 0
+        self._indents = {}
+        self._quotedNames = {}
         self.reducer = createMinfReducer(reducer)
         self.encoder = codecs.getencoder(encoding)
+        if sys.version_info[0] >= 3:
+            if codecs.lookup(encoding).name == 'utf-8':
+                # encoding then decoding lines does not change them
+                self._encode = None
+            else:
+                self._encode = lambda line: self.encoder(line)[0].decode('utf8')
+        else:
+            self._encode = lambda line: self.encoder(line)[0]
         self.level = level
         self.indentString = '  '
         if not append:
@@ -98,10 +122,26 @@ class MinfXMLWriter(MinfWriter):
             self._encodeAndWriteLine('<' + minfTag + ' ' + expanderAttribute +
                                      '=' + xml_quoteattr(reducer) + '>')
 
+    def _getLevel(self):
+        return self._level
+
+    def _setLevel(self, level):
+        self._level = level
+        self._indents = {}
+    level = property(_getLevel, _setLevel)
+
+    def _getIndentString(self):
+        return self._indentString
+
+    def _setIndentString(self, indentString):
+        self._indentString = indentString
+        self._indents = {}
+    indentString = property(_getIndentString, _setIndentString)
+
     def close(self):
         if self.__file is not None:
-            self.__file.flush()
             self._encodeAndWriteLine('</' + minfTag + '>')
+            self.flush()
             self.__file = None
 
     def write(self, value):
@@ -115,10 +155,10 @@ class MinfXMLWriter(MinfWriter):
                 minfNode = next(minfNodeIterator)
             else:
                 minfNode = minfNodeIterator.next()
-        attributes = {}
-        if name is not None:
-            attributes[nameAttribute] = name
         if isinstance(minfNode, StartStructure):
+            attributes = {}
+            if name is not None:
+                attributes[nameAttribute] = name
             if minfNode.type == listStructure:
                 naming = False
                 stringNaming = False
@@ -173,67 +213,138 @@ class MinfXMLWriter(MinfWriter):
         elif isinstance(minfNode, EndStructure):
             raise MinfError(
                 _('Unexpected Minf structure ending: %s') % (minfNode.type, ))
-            level -= 1
         else:
-            if attributes:
-                attributesXML = ' ' + \
-                    ' '.join([n + '=' + xml_quoteattr(unicode(v))
-                             for n, v in six.iteritems(attributes)])
-            else:
+            if name is None:
                 attributesXML = ''
+            else:
+                attributesXML = self._quotedNames.get(name)
+                if attributesXML is None:
+                    attributesXML = ' ' + nameAttribute + '=' + \
+                        xml_quoteattr(unicode(name))
+                    if len(self._quotedNames) >= 4096:
+                        self._quotedNames = {}
+                    self._quotedNames[name] = attributesXML
             if minfNode is None:
                 self._encodeAndWriteLine(
-                    '<' + noneTag + attributesXML + '/>', level)
-            elif isinstance(minfNode, bool):
-                if minfNode:
-                    self._encodeAndWriteLine(
-                        '<' + trueTag + attributesXML + '/>', level)
-                else:
-                    self._encodeAndWriteLine(
-                        '<' + falseTag + attributesXML + '/>', level)
+                    _noneOpen + attributesXML + '/>', level)
+            elif minfNode is True:
+                self._encodeAndWriteLine(
+                    _trueOpen + attributesXML + '/>', level)
+            elif minfNode is False:
+                self._encodeAndWriteLine(
+                    _falseOpen + attributesXML + '/>', level)
             elif isinstance(minfNode, (int, float, long)):
-                self._encodeAndWriteLine('<' + numberTag + attributesXML + '>' + unicode(minfNode) + '</' +
-                                         numberTag + '>', level)
+                self._encodeAndWriteLine(_numberOpen + attributesXML + '>' +
+                                         unicode(minfNode) + _numberClose,
+                                         level)
             elif isinstance(minfNode, six.string_types):
-
                 if type(minfNode) is byte_type:
                     try:
                         minfNode = minfNode.decode("utf-8")
                     except UnicodeDecodeError:
                         minfNode = minfNode.decode("iso-8859-1")
-                self._encodeAndWriteLine('<' + stringTag + attributesXML + '>' +
-                                         xml_escape(minfNode, xml_replacement) + '</' + stringTag + '>', level)
+                self._encodeAndWriteLine(_stringOpen + attributesXML + '>' +
+                                         _escape(minfNode) + _stringClose,
+                                         level)
+            elif isArray(minfNode):
+                self._writeArray(minfNode, attributesXML, level)
             elif hasattr(minfNode, '__minfxml__'):
+                if name is None:
+                    attributes = {}
+                else:
+                    attributes = {nameAttribute: name}
                 minfNode.__minfxml__(self, attributes, level)
             else:
                 raise MinfError(
                     _('Cannot save an object of type %s as an XML atom') % (str(type(minfNode)), ))
 
+    def _writeArray(self, array, attributesXML, level):
+        attributesXML += ' ' + dtypeAttribute + '=' + \
+            xml_quoteattr(dtypeDescription(array.dtype)) + ' ' + \
+            shapeAttribute + '=' + \
+            xml_quoteattr(','.join([str(i) for i in array.shape]))
+        fileName = saveArraySidecar(self, self.__file, array)
+        if fileName is None:
+            self._encodeAndWriteLine('<' + arrayTag + attributesXML + '>' +
+                                     base64.b64encode(arrayData(array)).decode('ascii') +
+                                     '</' + arrayTag + '>', level)
+        else:
+            self._encodeAndWriteLine('<' + arrayTag + attributesXML + ' ' +
+                                     fileAttribute + '=' +
+                                     xml_quoteattr(fileName) + '/>', level)
+
     def _encodeAndWriteLine(self, line, level=0):
-        self._writeLine(self.encoder(line)[0], level=level)
+        if self._encode is not None:
+            line = self._encode(line)
+        self._writeLine(line, level=level)
 
     def _writeLine(self, line, level=0):
-        if self.level is None:
-            indent = ''
-            nl = ''
-            level = None
+        if self._level is not None:
+            indent = self._indents.get(level)
+            if indent is None:
+                indent = self._indentString * (self._level + level)
+                self._indents[level] = indent
+            line = indent + line + '\n'
+        self._buffer.append(line)
+        self._bufferedSize += len(line)
+        if self._bufferedSize >= self.bufferSize:
+            self._flushBuffer()
+
+    def _flushBuffer(self):
+        if not self._buffer:
+            return
+        data = ''.join(self._buffer)
+        self._buffer = []
+        self._bufferedSize = 0
+        if self._binaryFile:
+            self.__file.write(data.encode())
+        elif self._binaryFile is None:
+            try:
+                self.__file.write(data)
+                self._binaryFile = False
+            except TypeError:
+                # in python3 writing in a binary stream needs to write byte
+                # objects, not strings.
+                self._binaryFile = True
+                self.__file.write(data.encode())
         else:
-            indent = self.indentString * (self.level + level)
-            nl = '\n'
-        if sys.version_info[0] >= 3 and isinstance(line, bytes):
-            line = line.decode('utf8')
-        try:
-            self.__file.write(indent + line + nl)
-        except TypeError:
-            # in python3 writing in a binary stream needs to write byte
-            # objects, not strings.
-            # however there is no [obvious] way to know if the file object
-            # is open in string or binary mode, and thus what it expects.
-            # if you want my opinion, it's completely crazy...
-            self.__file.write((indent + line + nl).encode())
+            self.__file.write(data)
 
     def flush(self):
+        self._flushBuffer()
         self.__file.flush()
 
     def change_file(self, file):
+        self._flushBuffer()
         self.__file = file
+        self._binaryFile = _isBinaryFile(file)
+
+
+_noneOpen = '<' + noneTag
+_trueOpen = '<' + trueTag
+_falseOpen = '<' + falseTag
+_numberOpen = '<' + numberTag
+_numberClose = '</' + numberTag + '>'
+_stringOpen = '<' + stringTag
+_stringClose = '</' + stringTag + '>'
+_replacementTable = dict((ord(c), None) for c in xml_replacement)
+
+
+def _escape(text):
+    '''
+    Same as xml_escape(text, xml_replacement) for unicode text.
+    '''
+    return text.replace('&', '&amp;').replace('>', '&gt;').replace(
+        '<', '&lt;').translate(_replacementTable)
+
+
+def _isBinaryFile(file):
+    '''
+    Return True if file expects bytes, False if it expects text and None if
+    it cannot be known before trying to write.
+    '''
+    if sys.version_info[0] < 3 or isinstance(file, io.TextIOBase):
+        return False
+    if isinstance(file, (io.RawIOBase, io.BufferedIOBase)):
+        return True
+    return None
@@ -523,3 +523,20 @@ def ensure_is_dir(d, clear_dir=False):
     elif clear_dir:
         shutil.rmtree(d)
         os.makedirs(d)
+
+
+def replace_file(source, destination):
+    '''
+    Rename the file source as destination, replacing destination if it
+    already exists. Unlike os.rename(), this also works on Windows, using
+    os.replace() when it is available (Python >= 3.3). On Python 2, the
+    existing destination is removed first, so the replacement is not atomic
+    there.
+    '''
+    replace = getattr(os, 'replace', None)
+    if replace is not None:
+        replace(source, destination)
+        return
+    if sys.platform.startswith('win') and os.path.exists(destination):
+        os.remove(destination)
+    os.rename(source, destination)
@@ -5,9 +5,49 @@ import unittest
 import shutil
 import os
 import tempfile
+import copy
 from soma import application
 from soma import fom
 import sys
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+test_fom_definition = '''{
+    "fom_name": "test_fom",
+
+    "formats": {
+        "NIFTI": "nii",
+        "GIS": "ima"
+    },
+
+    "format_lists": {
+        "images": ["NIFTI", "GIS"]
+    },
+
+    "attribute_definitions": {
+        "acquisition" : {"default_value" : "default_acquisition"},
+        "analysis" : {"default_value" : "default_analysis"},
+        "sulci_recognition_session" :  {"default_value" : "default_session"},
+        "graph_version": {"default_value": "3.1"}
+    },
+
+    "shared_patterns": {
+      "acquisition": "<center>/<subject>/t1mri/<acquisition>",
+      "analysis": "{acquisition}/<analysis>",
+      "recognition_analysis": "{analysis}/folds/<graph_version>/<sulci_recognition_session>_auto"
+    },
+
+    "processes": {
+        "Morphologist": {
+            "t1mri":
+                [["input:{acquisition}/<subject>", "images"]]
+        }
+    }
+}
+'''
 
 
 class TestFOM(unittest.TestCase):
@@ -70,6 +110,634 @@ class TestFOM(unittest.TestCase):
         atp = fom.AttributesToPaths(foms)
         pta = fom.PathToAttributes(foms)
 
+    def load_foms(self):
+        app = application.Application('testapp', plugin_modules=['soma.fom'])
+        if 'soma.fom' not in app.loaded_plugin_modules:
+            app.initialize()
+        app.fom_path = [os.path.join(self.work_dir, 'foms')]
+        app.fom_manager.paths = app.fom_path # BUG: should be automatic
+        app.fom_manager.clear_cache()
+        # do not leave FOMs of the temporary directory in the shared manager
+        self.addCleanup(app.fom_manager.clear_cache)
+        if not os.path.isdir(app.fom_path[0]):
+            os.mkdir(app.fom_path[0])
+        #print('fom_path:', app.fom_path, file=sys.stderr)
+        fom_filename = 'test_fom'
+        open(os.path.join(app.fom_path[0], fom_filename + '.json'), 'w').write(
+            test_fom_definition)
+        return app.fom_manager.load_foms(fom_filename)
+
+    def test_find_paths_batch(self):
+        atp = fom.AttributesToPaths(
+            self.load_foms(), directories={'input': '/input'})
+        requests = [{'center': 'c', 'subject': 's%d' % i} for i in range(5)]
+        requests += [{'subject': 's1', 'fom_format': 'fom_first'},
+                     {'subject': 's2', 'fom_format': 'GIS',
+                      'fom_parameter': 't1mri'},
+                     {'subject': 's2', 'fom_format': ['GIS', 'NIFTI']}]
+        serial = [(i, p, a) for i, r in enumerate(requests)
+                  for p, a in atp.find_paths(r)]
+        batch = sorted(atp.find_paths_batch(requests), key=lambda x: x[0])
+        self.assertEqual(batch, serial)
+        self.assertEqual(len([r for r in batch if r[0] == 0]), 2)
+        self.assertEqual(
+            batch[0][1],
+            os.path.join('/input', 'c', 's0', 't1mri', 'default_acquisition',
+                         's0.nii'))
+
+    def test_rules_database(self):
+        foms = self.load_foms()
+        timings = []
+        fom.AttributesToPaths.timing_hook = \
+            lambda atp, seconds: timings.append((atp, seconds))
+        try:
+            atp = fom.AttributesToPaths(foms, preferred_formats=set(['GIS']))
+        finally:
+            fom.AttributesToPaths.timing_hook = None
+        self.assertEqual(timings, [(atp, atp.construction_time)])
+        # one row per format of the rule, inserted in a single transaction
+        self.assertEqual(
+            list(atp._db.execute('SELECT _fom_format, _fom_first, '
+                                 '_fom_preferred_format FROM rules')),
+            [('NIFTI', 1, 0), ('GIS', 0, 1)])
+        self.assertEqual(
+            sorted(row[0] for row in atp._db.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index'")),
+            ['rules_fom_format_index', 'rules_fom_parameter_index',
+             'rules_fom_process_index'])
+        self.assertEqual(
+            [p for p, a in atp.find_paths({'center': 'c', 'subject': 's1',
+                                           'fom_format': 'fom_preferred'})],
+            [os.path.join('c', 's1', 't1mri', 'default_acquisition',
+                          's1.ima')])
+
+    def test_find_paths_caches(self):
+        foms = self.load_foms()
+        self.assertEqual(fom.AttributesToPaths(foms).results_cache, None)
+        atp = fom.AttributesToPaths(foms, results_cache_size=16)
+        request = {'center': 'c', 'subject': 's1'}
+        # an incomplete iteration is not cached
+        next(atp.find_paths(request))
+        self.assertEqual(len(atp.results_cache), 0)
+        paths = list(atp.find_paths(request))
+        paths[0][1]['subject'] = 'modified'
+        self.assertEqual(list(atp.find_paths(request))[0][1]['subject'], 's1')
+        self.assertEqual(
+            list(atp.find_paths({'center': 'c', 'subject': 's2'}))[0][0],
+            os.path.join('c', 's2', 't1mri', 'default_acquisition',
+                         's2.nii'))
+        self.assertEqual((atp.results_cache.hits, atp.results_cache.misses),
+                         (1, 3))
+        self.assertEqual((atp.plan_cache.hits, atp.plan_cache.misses),
+                         (2, 1))
+        atp = fom.AttributesToPaths(foms, results_cache_size=0,
+                                    plan_cache_size=0)
+        self.assertEqual(list(atp.find_paths(request)),
+                         [(p[0], dict(p[1], subject='s1')) for p in paths])
+
+    def test_attributes_values(self):
+        foms = self.load_foms()
+        atp = fom.AttributesToPaths(foms)
+        values = atp.find_attributes_values(fom_process='Morphologist')
+        self.assertEqual(values['fom_format'], [('NIFTI',), ('GIS',)])
+        self.assertEqual(values['acquisition'], [('',)])
+        self.assertEqual(
+            sorted(atp.find_discriminant_attributes(fom_process='Morphologist')),
+            ['acquisition', 'center', 'fom_format', 'subject'])
+        atp.find_attributes_values(fom_process='Morphologist')
+        self.assertEqual((atp.values_cache.hits, atp.values_cache.misses),
+                         (2, 1))
+
+    def test_allowed_formats(self):
+        atp = fom.AttributesToPaths(self.load_foms())
+        self.assertEqual(
+            atp.allowed_formats_for_parameter('Morphologist', 't1mri'),
+            ['NIFTI', 'GIS'])
+        self.assertEqual(atp.allowed_formats_for_parameter('Morphologist',
+                                                           'unknown'), [])
+        self.assertEqual(atp.allowed_extensions_for_parameter(
+            process_name='Morphologist', param='t1mri'), ['ima', 'nii'])
+        self.assertEqual(
+            atp.allowed_extensions_for_parameter(formats=['images']),
+            ['ima', 'nii'])
+        self.assertRaises(KeyError, atp.allowed_extensions_for_parameter,
+                          process_name='Morphologist')
+
+    @unittest.skipUnless(numpy is not None, 'numpy is not installed')
+    def test_find_paths_columns(self):
+        atp = fom.AttributesToPaths(self.load_foms(),
+                                    directories={'input': '/input'})
+        subjects = ['s1', 's2', 's3']
+        result = list(atp.find_paths_columns(
+            {'center': 'c', 'fom_format': 'fom_first'},
+            {'subject': subjects, 'acquisition': ['a', 'b', 'a']}))
+        self.assertEqual(len(result), 1)
+        rows, paths, attributes = result[0]
+        self.assertEqual(rows.tolist(), [0, 1, 2])
+        self.assertEqual(paths.tolist(), [
+            p for s, a in zip(subjects, ['a', 'b', 'a'])
+            for p, pa in atp.find_paths({'center': 'c', 'subject': s,
+                                         'acquisition': a,
+                                         'fom_format': 'fom_first'})])
+        self.assertEqual(attributes['fom_format'], 'NIFTI')
+        self.assertFalse('subject' in attributes)
+        for dtype in ('U', 'S'):
+            result = list(atp.find_paths_columns(
+                {'center': 'c'}, {'subject': numpy.array(subjects,
+                                                         dtype=dtype)}))
+            self.assertEqual([r[2]['fom_format'] for r in result],
+                             ['NIFTI', 'GIS'])
+            self.assertEqual(result[1][1][2], os.path.join(
+                '/input', 'c', 's3', 't1mri', 'default_acquisition',
+                's3.ima'))
+
+    def test_find_existing_paths(self):
+        root = os.path.join(self.work_dir, 'tree')
+        self._make_tree(root)
+        os.remove(os.path.join(root, 'c1', 's2', 't1mri', 'acq', 's2.nii'))
+        atp = fom.AttributesToPaths(self.load_foms(),
+                                    directories={'input': root})
+        requests = [{'center': 'c1', 'subject': s, 'acquisition': 'acq'}
+                    for s in ('s1', 's2', 's4')]
+        listing = fom.DirectoryListingCache()
+        self.assertEqual(
+            [os.path.basename(p) for p, a in atp.find_existing_paths(
+                requests[0], listing)], ['s1.nii', 's1.ima'])
+        self.assertEqual(
+            os.path.basename(atp.find_first_existing_path(
+                requests[1], listing)[0]), 's2.ima')
+        self.assertEqual(atp.find_first_existing_path(requests[2], listing),
+                         None)
+        self.assertEqual(listing.listed, 3)
+        directories = fom.DirectoriesCache()
+        directories.add_directory(root)
+        listing = fom.DirectoryListingCache(directories)
+        self.assertEqual(
+            [(i, os.path.basename(p)) for i, p, a in
+             atp.find_existing_paths_batch(requests, listing, first=True)],
+            [(0, 's1.nii'), (1, 's2.ima')])
+        self.assertEqual(listing.listed, 0)
+
+    def test_shared_rules(self):
+        foms = self.load_foms()
+        request = {'center': 'c', 'subject': 's1'}
+        selection = {'fom_process': 'Morphologist'}
+        atp = fom.AttributesToPaths(foms, selection=selection)
+        other = fom.AttributesToPaths(foms, selection=selection)
+        self.assertEqual(other.rules_key, atp.rules_key)
+        self.assertTrue(other._db is atp._db)
+        self.assertFalse(fom.AttributesToPaths(
+            foms, preferred_formats=set(['GIS']))._db is atp._db)
+        # another thread gets its own connection
+        import threading
+        in_thread = []
+        thread = threading.Thread(target=lambda: in_thread.append(
+            fom.AttributesToPaths(foms, selection=selection)))
+        thread.start()
+        thread.join()
+        self.assertEqual(in_thread[0].rules_key, atp.rules_key)
+        self.assertFalse(in_thread[0]._db is atp._db)
+        expected = list(atp.find_paths(request))
+        cache_dir = os.path.join(self.work_dir, 'rules')
+        fom.AttributesToPaths.rules_cache_directory = cache_dir
+        try:
+            fom.AttributesToPaths.shared_rules.clear()
+            fom.AttributesToPaths(foms, selection=selection)
+            self.assertEqual(os.listdir(cache_dir),
+                             ['rules-%s.sqlite' % atp.rules_key])
+            fom.AttributesToPaths.shared_rules.clear()
+            from_file = fom.AttributesToPaths(foms, selection=selection)
+        finally:
+            fom.AttributesToPaths.rules_cache_directory = None
+            fom.AttributesToPaths.shared_rules.clear()
+        if sys.version_info[:2] >= (3, 7):
+            self.assertEqual(from_file.rules, atp.rules)
+            self.assertEqual(len(expected), 2)
+            self.assertEqual(list(from_file.find_paths(request)), expected)
+
+    def test_compiled_foms_cache(self):
+        fom_dir = os.path.join(self.work_dir, 'foms')
+        os.mkdir(fom_dir)
+        fom_file = os.path.join(fom_dir, 'test_fom.json')
+        open(fom_file, 'w').write(test_fom_definition)
+        cache_dir = os.path.join(self.work_dir, 'cache')
+        manager = fom.FileOrganizationModelManager([fom_dir], cache_dir)
+        foms = manager.load_foms('test_fom')
+        self.assertEqual(foms.source_files, [fom_file])
+        self.assertEqual(len([i for i in os.listdir(cache_dir)
+                              if i.startswith('fom-')]), 1)
+        read_json = fom.read_json
+        try:
+            def no_read(file_name):
+                raise AssertionError('FOM file read: %s' % file_name)
+            fom.read_json = no_read
+            cached = fom.FileOrganizationModelManager(
+                [fom_dir], cache_dir).load_foms('test_fom')
+        finally:
+            fom.read_json = read_json
+        self.assertEqual(cached.rules, foms.rules)
+        self.assertEqual(cached.formats, foms.formats)
+        self.assertEqual(cached.attribute_definitions,
+                         foms.attribute_definitions)
+        self.assertEqual(cached.patterns, foms.patterns)
+        self.assertTrue(cached.rules[0][1] is
+                        cached.patterns['Morphologist']['t1mri'][0][1])
+        self.assertEqual(
+            list(fom.AttributesToPaths(cached).find_paths({'subject': 's'})),
+            list(fom.AttributesToPaths(foms).find_paths({'subject': 's'})))
+        open(fom_file, 'w').write(test_fom_definition.replace('"ima"',
+                                                              '"img"'))
+        self._touch(fom_file)
+        reloaded = fom.FileOrganizationModelManager(
+            [fom_dir], cache_dir).load_foms('test_fom')
+        self.assertEqual(reloaded.formats['GIS'], 'img')
+        # FOMs which cannot be written are not cached
+        reloaded.formats['other'] = object()
+        manager._save_compiled_foms(('other', ), reloaded)
+        self.assertEqual(sorted(i for i in os.listdir(cache_dir)
+                                if i.startswith('fom-')
+                                or i.endswith('.tmp')),
+                         [os.path.basename(
+                             manager._compiled_foms_file(('test_fom', )))])
+
+    def test_fom_catalog(self):
+        fom_dir = os.path.join(self.work_dir, 'foms')
+        os.mkdir(fom_dir)
+        fom_file = os.path.join(fom_dir, 'test_fom.json')
+        open(fom_file, 'w').write(test_fom_definition)
+        open(os.path.join(fom_dir, 'other.json'), 'w').write(
+            '{"fom_name": "other", "fom_import": ["test_fom"]}')
+        cache_dir = os.path.join(self.work_dir, 'cache')
+        manager = fom.FileOrganizationModelManager([fom_dir], cache_dir)
+        self.assertEqual(sorted(manager.find_foms()), ['other', 'test_fom'])
+        self.assertEqual(manager.fom_imports('other'), ['test_fom'])
+        definition = manager.read_definition('other')
+        self.assertEqual(definition['fom_name'], 'other')
+        self.assertEqual(definition['formats']['GIS'], 'ima')
+        read_json = fom.read_json
+        try:
+            def no_read(file_name):
+                raise AssertionError('FOM file read: %s' % file_name)
+            fom.read_json = no_read
+            # persistent catalog, in a "new process"
+            fom.FileOrganizationModelManager._catalogs.clear()
+            manager = fom.FileOrganizationModelManager([fom_dir], cache_dir)
+            self.assertEqual(sorted(manager.find_foms()),
+                             ['other', 'test_fom'])
+            self.assertEqual(manager.read_definition('other'), definition)
+        finally:
+            fom.read_json = read_json
+        open(os.path.join(fom_dir, 'other.json'), 'w').write(
+            '{"fom_name": "renamed"}')
+        self._touch(os.path.join(fom_dir, 'other.json'))
+        self.assertEqual(sorted(manager.find_foms()), ['renamed', 'test_fom'])
+        os.unlink(fom_file)
+        self._touch(fom_dir)
+        self.assertEqual(list(manager.find_foms()), ['renamed'])
+        parsed_files = fom.FileOrganizationModelManager._parsed_files
+        max_size = parsed_files.max_size
+        try:
+            # the parsed files shared by managers are bounded
+            parsed_files.max_size = 1
+            manager.read_definition('renamed')
+            self.assertEqual(len(parsed_files), 1)
+        finally:
+            parsed_files.max_size = max_size
+
+    def test_attributes_index(self):
+        root = os.path.join(self.work_dir, 'tree')
+        self._make_tree(root)
+        index = fom.AttributesIndex(os.path.join(self.work_dir, 'index.db'),
+                                    self.load_foms())
+        index.build(root)
+        self.assertEqual(index.count(), 12)
+        self.assertEqual(index.count(subject='s1', center='c2'), 2)
+        self.assertEqual(index.distinct_values('subject'), ['s1', 's2', 's3'])
+        self.assertEqual(index.distinct_values('fom_format', subject='s1'),
+                         ['GIS', 'NIFTI'])
+        path, st, attributes = list(index.find(subject='s3', center='c1',
+                                               fom_format='NIFTI'))[0]
+        self.assertEqual(path, os.path.join(root, 'c1', 's3', 't1mri', 'acq',
+                                            's3.nii'))
+        self.assertEqual(attributes['acquisition'], 'acq')
+        self.assertEqual(st[6], 1)
+        self.assertEqual(index.count(subject=['s1', 's2']), 8)
+        self.assertRaises(ValueError, index.count, unknown='x')
+
+        cache = fom.DirectoriesCache()
+        cache.add_directory(root)
+        acq = os.path.join(root, 'c1', 's1', 't1mri', 'acq')
+        os.unlink(os.path.join(acq, 's1.ima'))
+        self._touch(acq)
+        os.makedirs(os.path.join(root, 'c3', 's9', 't1mri', 'acq'))
+        open(os.path.join(root, 'c3', 's9', 't1mri', 'acq', 's9.nii'), 'w')
+        self._touch(root)
+        index.update(cache.refresh(root))
+        self.assertEqual(index.count(), 12)
+        self.assertEqual(index.distinct_values('center'), ['c1', 'c2', 'c3'])
+        self.assertEqual(index.count(subject='s1', center='c1'), 1)
+        index.close()
+        index = fom.AttributesIndex(os.path.join(self.work_dir, 'index.db'),
+                                    self.load_foms())
+        self.assertEqual(index.directory, root)
+        self.assertEqual(index.count(subject='s9'), 1)
+        index.close()
+
+        # another FOM, with another attribute: the index must be rebuilt
+        other_foms = copy.copy(self.load_foms())
+        other_foms.attribute_definitions = dict(
+            other_foms.attribute_definitions,
+            modality={'default_value': 't1mri'})
+        index = fom.AttributesIndex(os.path.join(self.work_dir, 'index.db'),
+                                    other_foms)
+        self.assertEqual(index.directory, None)
+        self.assertEqual(index.count(), 0)
+        index.build(root)
+        self.assertEqual(index.count(), 12)
+        self.assertEqual(index.distinct_values('modality'), [None])
+        index.close()
+
+    def _tree_names(self, dirdict):
+        return dict((name, None if content is None
+                     else self._tree_names(content))
+                    for name, (st, content) in dirdict.items())
+
+    def _touch(self, path, delay=10):
+        st = os.stat(path)
+        os.utime(path, (st.st_atime + delay, st.st_mtime + delay))
+
+    def test_directories_cache_refresh(self):
+        root = os.path.join(self.work_dir, 'tree')
+        self._make_tree(root)
+        cache = fom.DirectoriesCache()
+        cache.add_directory(root)
+        self.assertFalse(cache.refresh(root))
+        acq = os.path.join(root, 'c1', 's1', 't1mri', 'acq')
+        os.unlink(os.path.join(acq, 's1.ima'))
+        open(os.path.join(acq, 's1.nii'), 'w').write('modified')
+        self._touch(os.path.join(acq, 's1.nii'))
+        self._touch(acq)
+        os.makedirs(os.path.join(root, 'c2', 's4', 't1mri'))
+        open(os.path.join(root, 'c2', 's4', 't1mri', 's4.nii'), 'w')
+        self._touch(os.path.join(root, 'c2'))
+        delta = cache.refresh(root, workers=1)
+        self.assertEqual(delta.removed, ['c1/s1/t1mri/acq/s1.ima'])
+        self.assertEqual(delta.modified, ['c1/s1/t1mri/acq/s1.nii'])
+        self.assertEqual(sorted(delta.added),
+                         ['c2/s4', 'c2/s4/t1mri', 'c2/s4/t1mri/s4.nii'])
+        self.assertEqual(
+            self._tree_names(cache.get_directory(root)[1]),
+            self._tree_names(fom.DirectoryAsDict.get_directory(root)))
+        dirdict = delta.get_directory()
+        self.assertEqual(sorted(dirdict.keys()), ['c1', 'c2'])
+        self.assertEqual(
+            list(dirdict['c2'][1]['s4'][1]['t1mri'][1].keys()), ['s4.nii'])
+        self.assertFalse(cache.refresh(root))
+
+    def test_directories_cache_refresh_compact(self):
+        root = os.path.join(self.work_dir, 'tree')
+        self._make_tree(root)
+        cache = fom.DirectoriesCache()
+        cache.add_directory(root, compact=True)
+        delta = cache.refresh(root, workers=1)
+        self.assertEqual((delta.added, delta.removed, delta.modified),
+                         ([], [], []))
+        acq = os.path.join(root, 'c2', 's3', 't1mri', 'acq')
+        open(os.path.join(acq, 's3.ima'), 'w').write('modified')
+        self._touch(os.path.join(acq, 's3.ima'))
+        self._touch(acq)
+        delta = cache.refresh(root, workers=1)
+        self.assertEqual((delta.added, delta.removed, delta.modified),
+                         ([], [], ['c2/s3/t1mri/acq/s3.ima']))
+
+    def test_directories_cache_binary(self):
+        root = os.path.join(self.work_dir, 'tree')
+        self._make_tree(root)
+        cache = fom.DirectoriesCache()
+        cache.add_directory(root)
+        dirdict = cache.get_directory(root)[1]
+        for format in ('binary', 'json'):
+            cache_file = os.path.join(self.work_dir, 'cache.' + format)
+            cache.save(cache_file, format=format)
+            loaded = fom.DirectoriesCache.load(cache_file)
+            st, content = loaded.get_directory(root)
+            self.assertEqual(tuple(st), cache.get_directory(root)[0])
+            if format == 'binary':
+                self.assertEqual(len(content), 3)
+                self.assertTrue('c1' in content)
+                self.assertFalse('c3' in content)
+                content = content.to_dict()
+            self.assertEqual(
+                dict((k, v) for k, v in self._flat_stats(content)),
+                dict((k, v) for k, v in self._flat_stats(dirdict)))
+            acq = os.path.join(root, 'c2', 's3', 't1mri', 'acq')
+            self.assertEqual(
+                sorted(loaded.get_directory(acq)[1].keys()),
+                ['s3.ima', 's3.nii'])
+            self.assertEqual(
+                sorted(name for name, st_content
+                       in fom.DirectoryAsDict(acq, loaded).iteritems()),
+                ['s3.ima', 's3.nii'])
+            loaded.close()
+            self.assertEqual(loaded._snapshot, None)
+        binary_file = os.path.join(self.work_dir, 'cache.binary')
+        # saving again replaces the existing file
+        cache.save(binary_file, format='binary')
+        self.assertFalse(os.path.exists(binary_file + '.tmp'))
+        with fom.DirectoriesCache.load(binary_file) as loaded:
+            snapshot = loaded._snapshot
+            loaded.read(binary_file)
+            # the previous mapping is released by a new load
+            self.assertTrue(snapshot.mmap.closed)
+            self.assertEqual(len(loaded.get_directory(root)[1]), 3)
+            snapshot = loaded._snapshot
+        self.assertTrue(snapshot.mmap.closed)
+        self.assertTrue(snapshot.file.closed)
+
+    def _flat_stats(self, dirdict, path=''):
+        for name, (st, content) in dirdict.items():
+            yield path + name, st and tuple(st)
+            if content:
+                for i in self._flat_stats(content, path + name + '/'):
+                    yield i
+
+    def test_compact_directory_tree(self):
+        root = os.path.join(self.work_dir, 'tree')
+        self._make_tree(root)
+        dirdict = fom.DirectoryAsDict.get_directory(root)
+        compact = fom.DirectoryAsDict.get_directory(root, compact=True,
+                                                    workers=2)
+        self.assertEqual(self._tree_names(compact),
+                         self._tree_names(dirdict))
+        from_dict = fom.CompactDirectoryTree.from_dict(dirdict)
+        self.assertEqual(len(from_dict), 34)
+        for path, st in self._flat_stats(from_dict.get_directory()):
+            self.assertEqual(path in dict(self._flat_stats(compact)), True)
+        st = compact['c1'][1]['s1'][1]['t1mri'][1]['acq'][1]['s1.ima'][0]
+        ref_st = dirdict['c1'][1]['s1'][1]['t1mri'][1]['acq'][1][
+            's1.ima'][0]
+        self.assertEqual((st[0], st[1], st[6], st[8], st[9]),
+                         (ref_st[0], ref_st[1], ref_st[6], ref_st[8],
+                          ref_st[9]))
+        pta = fom.PathToAttributes(self.load_foms())
+        self.assertEqual(
+            sorted(('/'.join(p), a['subject'], a['fom_format'])
+                   for p, s, a in pta.parse_directory(compact)),
+            sorted(('/'.join(p), a['subject'], a['fom_format'])
+                   for p, s, a in pta.parse_directory(dirdict)))
+        self.assertEqual(len(list(pta.parse_directory(compact))), 12)
+
+    def test_compact_directory_tree_streaming(self):
+        root = os.path.join(self.work_dir, 'tree')
+        self._make_tree(root)
+        dirdict = fom.DirectoryAsDict.get_directory(root)
+        size = fom.CompactDirectoryTree.name_indices_size
+        try:
+            # the names table is emptied many times during the build
+            fom.CompactDirectoryTree.name_indices_size = 2
+            for workers in (1, 3):
+                compact = fom.DirectoryAsDict.get_directory(
+                    root, compact=True, workers=workers)
+                self.assertEqual(self._tree_names(compact),
+                                 self._tree_names(dirdict))
+        finally:
+            fom.CompactDirectoryTree.name_indices_size = size
+        scanner = fom.DirectoryScanner(workers=2)
+        listings = scanner.iter_listings(root)
+        path, entries = next(listings)
+        self.assertEqual(path, root)
+        self.assertEqual([e[1] for e in entries], ['c1', 'c2', 'empty'])
+        listings.close()
+        self.assertEqual(
+            len(list(fom.DirectoryScanner(workers=2).iter_listings(root))),
+            len(list(fom.DirectoryScanner(workers=1).iter_listings(root))))
+
+    def test_parse_live_directory(self):
+        root = os.path.join(self.work_dir, 'tree')
+        self._make_tree(root)
+        os.makedirs(os.path.join(root, 'c1', 's1', 'qc', 'deep'))
+        open(os.path.join(root, 'c1', 's1', 't1mri', 'acq', 'notes.txt'),
+             'w')
+        pta = fom.PathToAttributes(self.load_foms())
+        live = [('/'.join(p), s, a)
+                for p, s, a in pta.parse_live_directory(root)]
+        ref = [('/'.join(p), s, a) for p, s, a in pta.parse_directory(
+            fom.DirectoryAsDict.get_directory(root))]
+        self.assertEqual(len(live), 12)
+        self.assertEqual(sorted((p, s[6], sorted(a.items()))
+                                for p, s, a in live),
+                         sorted((p, s[6], sorted(a.items()))
+                                for p, s, a in ref))
+
+    def test_parse_path(self):
+        pta = fom.PathToAttributes(self.load_foms())
+        path = os.path.join('c', 's1', 't1mri', 'acq', 's1.nii')
+        result = list(pta.parse_path(path))
+        self.assertEqual([p for p, s, a in result],
+                         [['c', 's1', 't1mri', 'acq', 's1.nii']])
+        self.assertEqual(result[0][2]['fom_format'], 'NIFTI')
+        self.assertEqual(result[0][2]['acquisition'], 'acq')
+        result[0][2]['subject'] = 'modified'
+        self.assertEqual(list(pta.parse_path(path))[0][2]['subject'], 's1')
+        self.assertEqual(
+            (pta.parse_path_cache.hits, pta.parse_path_cache.misses), (1, 1))
+        self.assertEqual(list(pta.parse_path(os.path.join('c', 's1'))), [])
+        self.assertEqual(list(pta.parse_path(
+            os.path.join('c', 's1', 't1mri', 'acq', 's2.nii'))), [])
+
+    def test_parallel_parse_directory(self):
+        root = os.path.join(self.work_dir, 'tree')
+        self._make_tree(root)
+        os.makedirs(os.path.join(root, 'c1', 'unknown', 'deep'))
+        pta = fom.PathToAttributes(self.load_foms())
+        dirdict = fom.DirectoryAsDict.get_directory(root)
+        for kwargs in ({}, {'single_match': True}, {'all_unknown': True}):
+            serial = list(pta.parse_directory(dirdict, **kwargs))
+            for split_depth in (1, 2):
+                self.assertEqual(
+                    list(pta.parse_directory(dirdict, workers=2,
+                                             split_depth=split_depth,
+                                             **kwargs)),
+                    serial)
+        self.assertEqual(
+            list(pta.parse_live_directory(root, workers=2, split_depth=2)),
+            list(pta.parse_live_directory(root)))
+        # no fork while another thread is running
+        import threading
+        stop = threading.Event()
+        thread = threading.Thread(target=stop.wait)
+        thread.start()
+        try:
+            self.assertFalse(fom.PathToAttributes._can_fork())
+            self.assertEqual(list(pta.parse_directory(dirdict, workers=2)),
+                             list(pta.parse_directory(dirdict)))
+        finally:
+            stop.set()
+            thread.join()
+
+    def _make_tree(self, root):
+        for center in ('c1', 'c2'):
+            for subject in ('s1', 's2', 's3'):
+                d = os.path.join(root, center, subject, 't1mri', 'acq')
+                os.makedirs(d)
+                open(os.path.join(d, subject + '.nii'), 'w').write('x')
+                open(os.path.join(d, subject + '.ima'), 'w').write('xy')
+        os.mkdir(os.path.join(root, 'empty'))
+
+    def test_directory_scanner(self):
+        root = os.path.join(self.work_dir, 'tree')
+        self._make_tree(root)
+        serial = fom.DirectoryAsDict.get_directory(root, workers=1)
+        threaded = fom.DirectoryAsDict.get_directory(root, workers=4)
+        self.assertEqual(serial, threaded)
+        self.assertEqual(sorted(serial.keys()), ['c1', 'c2', 'empty'])
+        st, content = serial['c1'][1]['s2'][1]['t1mri'][1]['acq']
+        self.assertEqual(sorted(content.keys()), ['s2.ima', 's2.nii'])
+        self.assertEqual(content['s2.ima'][0][6], 2)
+        no_stat = fom.DirectoryAsDict.get_directory(root, stat_files=False)
+        content = no_stat['c1'][1]['s2'][1]['t1mri'][1]['acq'][1]
+        self.assertEqual(content['s2.nii'], [None, None])
+        self.assertTrue(no_stat['c1'][0] is not None)
+        scanner = fom.DirectoryScanner(workers=2)
+        scanner.scan(root)
+        self.assertEqual(scanner.files, 12)
+        self.assertEqual(scanner.directories, 21)
+        self.assertEqual(
+            fom.DirectoryAsDict.get_directory(
+                os.path.join(root, 'missing')), None)
+
+    def test_directory_scanner_error(self):
+        root = os.path.join(self.work_dir, 'tree')
+        self._make_tree(root)
+
+        class FailingScanner(fom.DirectoryScanner):
+            def scan_one(self, directory, st_content):
+                if os.path.basename(directory) == 's2':
+                    raise RuntimeError('scan failure')
+                return super(FailingScanner, self).scan_one(
+                    directory, st_content)
+
+        for workers in (1, 3):
+            self.assertRaises(RuntimeError,
+                              FailingScanner(workers=workers).scan, root)
+
+    def test_fom_benchmark(self):
+        from soma import fom_benchmark
+        results = fom_benchmark.run_benchmark(
+            rules_count=12, parameters_count=5, entries=200,
+            values_count=3, requests_count=20, live=True,
+            work_directory=self.work_dir)
+        self.assertEqual(results['parsed_files'], results['tree_files'])
+        self.assertTrue(results['tree_files'] >= 200)
+        self.assertEqual(
+            sorted(results['stages']),
+            ['attributes_to_paths', 'find_paths', 'find_paths_warm',
+             'load_foms', 'parse_directory', 'parse_live_directory',
+             'path_to_attributes'])
+        self.assertEqual(results['stages']['find_paths']['items'], 20)
+        self.assertEqual(results['stages']['find_paths_warm']['items'], 20)
+        self.assertTrue(results['found_paths'] >= 20)
+
 
 def test():
     suite = unittest.TestLoader().loadTestsFromTestCase(TestFOM)